@@ -83,6 +83,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'libreosteoweb.middleware.QueryInstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -219,6 +220,27 @@ LOGIN_REDIRECT_URL= '/'
 INITIALIZE_ADMIN_URL_NAME = 'install'
 NO_REROUTE_PATTERN_URL = [ r'^accounts/create-admin/$', r'^internal/restore', r'^jsi18n', r'^web-view/partials/restore', r'^web-view/partials/register' ]
 
+# Record the SQL queries of the requests (X-Query-Count and Server-Timing
+# headers, slow requests log), only to investigate a performance problem
+QUERY_INSTRUMENTATION = False
+
+# Requests longer than this threshold (in seconds) are written with their
+# slowest SQL statements into the slow requests log
+SLOW_REQUEST_THRESHOLD = 1.0
+SLOW_REQUEST_QUERIES = 5
+
+# Time (in seconds) during which the statistics of the dashboard are served
+# from the cache, any change of the activity invalidates them before
+STATISTICS_CACHE_TIMEOUT = 300
+
+# Size (in bytes) of the parsed import files kept in memory, the least
+# recently used are dropped first
+FILE_CONTENT_CACHE_SIZE = 1024 * 1024
+
+# Number of processes validating the rows of the large import files, all
+# the cores when None
+IMPORT_WORKERS = 1
+
 
 
 
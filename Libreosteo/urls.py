@@ -44,6 +44,7 @@ router.register(r'profiles', views.TherapeutSettingsViewSet)
 router.register(r'comments', views.ExaminationCommentViewSet)
 router.register(r'office-users', views.UserOfficeViewSet)
 router.register(r'file-import', views.FileImportViewSet)
+router.register(r'import-jobs', views.ImportJobViewSet)
 router.register(r'patient-documents', views.PatientDocumentViewSet, 'PatientDocuments')
 router.register(r'paiment-mean', views.PaimentMeanViewSet, 'PaimentMean')
 
@@ -58,6 +59,8 @@ urlpatterns = [
     url(r'^install/$', views.InstallView.as_view(), name='install'),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     url(r'^api/statistics[/]?$', views.StatisticsView.as_view(), name='statistics_view'),
+    url(r'^api/statistics/series[/]?$', views.StatisticsSeriesView.as_view(), name='statistics_series_view'),
+    url(r'^api/statistics/revenue[/]?$', views.RevenueStatisticsView.as_view(), name='statistics_revenue_view'),
     url(r'^api/patients/(?P<patient>.+)/documents$', views.PatientDocumentViewSet.as_view({'get' : 'list'}), name="patient_document_view"),
     url(r'^myuserid', TemplateView.as_view(template_name='account/myuserid.html')),
     url(r'^internal/dump.json', views.DbDump.as_view(), name='db_dump'),
@@ -0,0 +1,130 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+
+from django.core.exceptions import FieldDoesNotExist
+
+logger = logging.getLogger(__name__)
+
+
+def get_fields_columns(model, serializer_fields):
+    """
+    Give the model columns used by the serializer fields, or None when a
+    field does not read a model field (method field, property), so that
+    its needs cannot be known.
+    """
+    columns = set()
+    for field in serializer_fields:
+        if field.source == '*':
+            return None
+        try:
+            model_field = model._meta.get_field(field.source.split('.')[0])
+        except FieldDoesNotExist:
+            return None
+        if model_field.concrete and not model_field.many_to_many:
+            columns.add(model_field.name)
+    return columns
+
+
+def restrict_queryset(queryset, kept_fields, dropped_fields):
+    """
+    Load only the columns used by the kept serializer fields. When they
+    cannot be known, only the columns of the dropped fields are deferred.
+    """
+    model = queryset.model
+    columns = get_fields_columns(model, kept_fields)
+    if columns is not None:
+        columns.add(model._meta.pk.name)
+        # A column traversed by select_related cannot be deferred
+        if isinstance(queryset.query.select_related, dict):
+            columns.update(queryset.query.select_related)
+        return queryset.only(*columns)
+    deferred = set()
+    for field in dropped_fields:
+        deferred.update(get_fields_columns(model, [field]) or [])
+    for field in kept_fields:
+        deferred.difference_update(get_fields_columns(model, [field]) or [])
+    deferred.discard(model._meta.pk.name)
+    if isinstance(queryset.query.select_related, dict):
+        deferred.difference_update(queryset.query.select_related)
+    return queryset.defer(*deferred) if deferred else queryset
+
+
+class SparseFieldsetMixin(object):
+    """
+    Allows to select the fields of the list and retrieve representations
+    via ?fields=field1,field2 or ?exclude=field1,field2
+
+    The serializer is trimmed and the queryset only loads the columns
+    needed by the remaining fields.
+    """
+    fields_query_param = 'fields'
+    exclude_query_param = 'exclude'
+    sparse_fieldset_actions = ('list', 'retrieve')
+
+    def _get_query_list(self, param):
+        value = self.request.query_params.get(param, '')
+        return [f.strip() for f in value.split(',') if f.strip()]
+
+    def get_sparse_fieldset(self):
+        """
+        Give the (fields, exclude) top level field names asked, fields is
+        None when all the fields are asked.
+        """
+        if (getattr(self, 'request', None) is None
+                or getattr(self, 'action', None)
+                not in self.sparse_fieldset_actions):
+            return (None, set())
+        fields = self._get_query_list(self.fields_query_param)
+        exclude = self._get_query_list(self.exclude_query_param)
+        # Nested values as patient_detail.family_name select their parent
+        return ((set(f.split('.')[0] for f in fields) if fields else None),
+                set(exclude))
+
+    def is_field_selected(self, name):
+        fields, exclude = self.get_sparse_fieldset()
+        return (fields is None or name in fields) and name not in exclude
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super(SparseFieldsetMixin,
+                           self).get_serializer(*args, **kwargs)
+        fields, exclude = self.get_sparse_fieldset()
+        if fields is not None or exclude:
+            target = getattr(serializer, 'child', serializer)
+            for name in list(target.fields):
+                if not self.is_field_selected(name):
+                    target.fields.pop(name)
+        return serializer
+
+    def filter_queryset(self, queryset):
+        queryset = super(SparseFieldsetMixin, self).filter_queryset(queryset)
+        fields, exclude = self.get_sparse_fieldset()
+        if fields is None and not exclude:
+            return queryset
+        all_fields = self.get_serializer_class()(
+            context=self.get_serializer_context()).fields
+        kept = [f for n, f in all_fields.items() if self.is_field_selected(n)]
+        dropped = [
+            f for n, f in all_fields.items() if not self.is_field_selected(n)
+        ]
+        return restrict_queryset(queryset, kept, dropped)
+
+    def get_renderer_context(self):
+        # The CSV renderer uses the asked fields as header
+        context = super(SparseFieldsetMixin, self).get_renderer_context()
+        fields = self._get_query_list(self.fields_query_param)
+        if fields:
+            context['header'] = fields
+        return context
@@ -13,16 +13,59 @@ import logging
 #
 # You should have received a copy of the GNU General Public License
 # along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+import codecs
+from collections import OrderedDict, deque
+from contextlib import closing
+from itertools import chain
 import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 import random
-from libreosteoweb.models import Patient, ExaminationType, ExaminationStatus
+import sys
+import threading
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Max
+from django.db.models.fields.files import FieldFile
+from haystack import connection_router
+from haystack import connections as haystack_connections
+from haystack.exceptions import NotHandled
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.encoders import JSONEncoder
+from libreosteoweb.models import (FileImport, FileImportError, Patient,
+                                  ExaminationType, ExaminationStatus)
 from datetime import date, datetime
-from .utils import enum, Singleton, _unicode
+from . import import_worker
+from .filter import get_firstname_filters, get_name_filters
+from .statistics import get_day, rebuild_daily_statistics
+from .utils import enum, _unicode
 
 logger = logging.getLogger(__name__)
 
-_CSV_BUFFER_SIZE = 1024 * 1024 * 10
+# The dialect is guessed on the first lines of the file
+_CSV_SNIFF_SIZE = 64 * 1024
+# Number of rows integrated together
+IMPORT_CHUNK_SIZE = 500
+# Number of rows given as extract of a file
+EXTRACT_SIZE = 5
+# Number of rows from which the rows are validated by the process pool
+IMPORT_PARALLEL_MIN_ROWS = 2 * IMPORT_CHUNK_SIZE
+# Seconds waited for a chunk validated by the process pool, the rows are
+# then validated by the integration itself
+IMPORT_WORKER_TIMEOUT = 60
+# Default size in bytes of the parsed contents kept in memory
+_FILE_CONTENT_CACHE_SIZE = 1024 * 1024
+_FILE_DIGEST_BLOCK_SIZE = 64 * 1024
+# Number of files of which the digest is kept
+_FILE_DIGEST_CACHE_SIZE = 64
+# Encoding of the files, or of their lines, which are not valid utf-8
+FALLBACK_ENCODING = 'iso-8859-1'
+# The csv module of python2 reads bytes, decoded cell by cell
+_TEXT_CSV = sys.version_info.major > 2
 
 
 class Extractor(object):
@@ -80,22 +123,27 @@ class Extractor(object):
             return ('patient', False, True,
                     [_('Cannot recognize the patient file')])
 
-    def extract_file(self, internal_file):
+    def extract_file(self, internal_file, size=EXTRACT_SIZE):
+        """
+        Give size random rows of the file by line number, chosen by a
+        reservoir sampling while reading the rows once.
+        """
         if not bool(internal_file):
             return {}
-        result = {}
+        sample = []
         try:
             content = FileContentProxy().get_content(internal_file,
                                                      line_filter=filter)
-            nb_row = content['nb_row'] - 1
-            if nb_row > 0:
-                idx = sorted(
-                    random.sample(range(1, nb_row + 1), min(5, nb_row)))
-                logger.info("indexes = %s " % idx)
-                for i in idx:
-                    result['%s' % (i + 1)] = content['content'][i - 1]
+            for (idx, (line, row)) in enumerate(content.iter_rows()):
+                if idx < size:
+                    sample.append((line, row))
+                else:
+                    position = random.randint(0, idx)
+                    if position < size:
+                        sample[position] = (line, row)
         except:
             logger.exception('Extractor failed.')
+        result = dict(('%s' % line, row) for (line, row) in sample)
         logger.info("result is %s" % result)
         return result
 
@@ -107,27 +155,51 @@ class Extractor(object):
         FileContentProxy().unproxy(internal_file, line_filter=filter)
 
 
+def get_file_encoding(internal_file):
+    """ Encoding set on the file import of the file, None to detect it """
+    if not isinstance(internal_file, FieldFile):
+        return None
+    return getattr(internal_file.instance, 'encoding', None) or None
+
+
+def is_supported_encoding(encoding):
+    """
+    The lines of the files are split, then decoded : the encoding must
+    read the ascii characters, the separators and the end of lines, as
+    they are. utf-16 or utf-32 are not supported.
+    """
+    sample = u'\r\n;,\t"\' +azAZ09'
+    try:
+        return sample.encode('ascii').decode(encoding) == sample
+    except (LookupError, ValueError):
+        return False
+
+
+def detect_encoding(sample):
+    """ Give the encoding of a file from its first bytes """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # The sample may end in the middle of a character
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+
+
 def filter(line):
-    logger.debug("filtering ...")
+    """ Decode a cell read as bytes """
     if not hasattr(line, 'decode'):
-        logger.debug("no decode available")
         return line
-    result_line = None
     try:
-        logger.debug("Try to decode against utf-8")
-        result_line = line.decode('utf-8')
-    except:
-        logger.debug("Fail to decode against utf-8")
+        return line.decode('utf-8')
+    except UnicodeDecodeError:
         pass
-    if result_line is None:
-        try:
-            logger.debug("Try to decode against iso-8859-1")
-            result_line = line.decode('iso-8859-1')
-        except:
-            logger.info("Fail to decode against iso-8859-1")
-            result_line = _(
-                'Cannot read the content file. Check the encoding.')
-    return result_line
+    try:
+        return line.decode(FALLBACK_ENCODING)
+    except:
+        logger.info("Fail to decode against %s" % FALLBACK_ENCODING)
+        return _('Cannot read the content file. Check the encoding.')
 
 
 FileCsvType = enum('FileCsvType', 'PATIENT', 'EXAMINATION')
@@ -199,9 +271,18 @@ class AnalyzerExaminationFile(Analyzer):
 
 
 class FileContentAdapter(dict):
-    def __init__(self, ourfile, line_filter=None):
+    """
+    Gives the header and the number of rows of a csv file. The rows are
+    not kept in memory, they are read from the file by iter_rows or
+    iter_chunks each time they are needed.
+
+    The file is decoded line by line with its encoding, detected on its
+    first bytes when not given.
+    """
+    def __init__(self, ourfile, line_filter=None, encoding=None):
         self.file = ourfile
-        self['content'] = None
+        self['header'] = None
+        self['encoding'] = encoding
         self.filter = line_filter
         if self.filter is None:
             self.filter = self.passthrough
@@ -210,35 +291,83 @@ class FileContentAdapter(dict):
         return self[attr]
 
     def get_content(self):
-        if self['content'] is None:
+        if self['header'] is None:
             reader = self._get_reader()
             rownum = 0
             header = None
-            content = []
             for row in reader:
-                # Save header row.
+                # Save header row, the others are only counted
                 if rownum == 0:
-                    header = [self.filter(c) for c in row]
-                else:
-                    content.append([self.filter(c) for c in row])
+                    header = self._filter_row(row)
                 rownum += 1
             self.file.close()
-            self['content'] = content
             self['nb_row'] = rownum
             self['header'] = header
         return self
 
+    def iter_rows(self):
+        """
+        Give the (line number, row) of the rows after the header, the file
+        is read while iterating
+        """
+        reader = self._get_reader()
+        try:
+            next(reader, None)
+            # The header is on the first line
+            for (idx, row) in enumerate(reader):
+                yield (idx + 2, self._filter_row(row))
+        finally:
+            self.file.close()
+
+    def iter_chunks(self, size=IMPORT_CHUNK_SIZE):
+        """ Give the (line number, row) of the rows by lists of size rows """
+        chunk = []
+        for row in self.iter_rows():
+            chunk.append(row)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
     def _get_reader(self):
         if not bool(self.file):
             return None
-        self.file.open(mode='r')
+        self.file.open(mode='rb' if _TEXT_CSV else 'r')
         logger.info("* Try to guess the dialect on csv")
-        csv_buffer = self.file.read(_CSV_BUFFER_SIZE)
-        # Compatibility with python2 and python3
+        csv_buffer = self.file.read(_CSV_SNIFF_SIZE)
+        # Only complete lines are given to the sniffer
+        newline = b'\n' if isinstance(csv_buffer, bytes) else '\n'
+        if len(csv_buffer) == _CSV_SNIFF_SIZE and newline in csv_buffer:
+            csv_buffer = csv_buffer[:csv_buffer.rindex(newline)]
+        if _TEXT_CSV and isinstance(csv_buffer, bytes):
+            if self['encoding'] is None:
+                self['encoding'] = detect_encoding(csv_buffer)
+                logger.info("* Encoding detected : %s" % self['encoding'])
+            csv_buffer = self._decode(csv_buffer)
         dialect = csv.Sniffer().sniff(csv_buffer)
         self.file.seek(0)
-        reader = csv.reader(self.file, dialect)
-        return reader
+        if _TEXT_CSV:
+            return csv.reader(self._decode_lines(self.file), dialect)
+        return csv.reader(self.file, dialect)
+
+    def _decode_lines(self, lines):
+        for line in lines:
+            yield self._decode(line) if isinstance(line, bytes) else line
+
+    def _decode(self, line):
+        try:
+            return line.decode(self['encoding'] or 'utf-8')
+        except UnicodeDecodeError:
+            logger.info("* Line not in %s, decoded as %s" %
+                        (self['encoding'], FALLBACK_ENCODING))
+            return line.decode(FALLBACK_ENCODING)
+
+    def _filter_row(self, row):
+        # The lines are already decoded for the csv module of python3
+        if _TEXT_CSV:
+            return row
+        return [self.filter(c) for c in row]
 
     def passthrough(self, line):
         return line
@@ -257,15 +386,17 @@ class DecodeCsvReader(object):
 
 
 class FileContentKey(object):
-    def __init__(self, ourfile, line_filter):
-        self.file = ourfile
+    def __init__(self, digest, line_filter, encoding=None):
+        self.digest = digest
         self.line_filter = line_filter
+        self.encoding = encoding
 
     def __hash__(self):
-        return hash((self.file, self.line_filter))
+        return hash((self.digest, self.line_filter, self.encoding))
 
     def __eq__(self, other):
-        return (self.file, self.line_filter) == (other.file, other.line_filter)
+        return ((self.digest, self.line_filter, self.encoding) ==
+                (other.digest, other.line_filter, other.encoding))
 
     def __ne__(self, other):
         # Not strictly necessary, but to avoid having both x==y and x!=y
@@ -273,25 +404,141 @@ class FileContentKey(object):
         return not (self == other)
 
 
+def get_file_stat(ourfile):
+    """
+    Give the path, the modification time and the size of a file stored on
+    the file system, None when it cannot be known
+    """
+    try:
+        path = ourfile.path
+        stat = os.stat(path)
+    except (AttributeError, NotImplementedError, TypeError, ValueError,
+            OSError):
+        return None
+    return (path, stat.st_mtime, stat.st_size)
+
+
+def get_file_digest(ourfile):
+    """ Give the sha1 of the content of the file """
+    digest = hashlib.sha1()
+    ourfile.open(mode='rb')
+    try:
+        while True:
+            block = ourfile.read(_FILE_DIGEST_BLOCK_SIZE)
+            if not isinstance(block, bytes):
+                block = block.encode('utf-8')
+            digest.update(block)
+            if len(block) < _FILE_DIGEST_BLOCK_SIZE:
+                break
+    finally:
+        ourfile.close()
+    return digest.hexdigest()
+
+
+class FileContentCache(object):
+    """
+    Keeps the header and the number of rows of the parsed files, by hash
+    of their content. The least recently used entries are dropped when
+    their size exceeds max_size bytes.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        # Digest of the files by path, modification time and size
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_max_size(self):
+        if self.max_size is not None:
+            return self.max_size
+        return getattr(settings, 'FILE_CONTENT_CACHE_SIZE',
+                       _FILE_CONTENT_CACHE_SIZE)
+
+    def get_digest(self, ourfile):
+        """
+        Digest of the content of the file, computed again only when the
+        stored file changes
+        """
+        stat = get_file_stat(ourfile)
+        if stat is None:
+            return get_file_digest(ourfile)
+        with self._lock:
+            digest = self._digests.get(stat)
+        if digest is None:
+            digest = get_file_digest(ourfile)
+            with self._lock:
+                self._digests[stat] = digest
+                while len(self._digests) > _FILE_DIGEST_CACHE_SIZE:
+                    self._digests.popitem(last=False)
+        return digest
+
+    def get_content(self, ourfile, line_filter=None):
+        encoding = get_file_encoding(ourfile)
+        key = FileContentKey(self.get_digest(ourfile), line_filter, encoding)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+        if entry is None:
+            # Parsed without the lock, the other files are served meanwhile
+            content = FileContentAdapter(ourfile, line_filter,
+                                         encoding).get_content()
+            entry = (content['header'], content['nb_row'],
+                     content['encoding'], self._get_size(content['header']))
+            with self._lock:
+                # Another thread may have parsed the same content meanwhile
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    self.size -= previous[3]
+                self._entries[key] = entry
+                self.size += entry[3]
+                while (self.size > self.get_max_size()
+                       and len(self._entries) > 1):
+                    (old_key, old_entry) = self._entries.popitem(last=False)
+                    self.size -= old_entry[3]
+        # The rows are read from the given file, with the detected encoding
+        content = FileContentAdapter(ourfile, line_filter, entry[2])
+        content['header'] = entry[0]
+        content['nb_row'] = entry[1]
+        return content
+
+    def discard(self, ourfile, line_filter=None):
+        key = FileContentKey(self.get_digest(ourfile), line_filter,
+                             get_file_encoding(ourfile))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._digests.clear()
+            self.size = 0
+
+    def _get_size(self, header):
+        return sys.getsizeof(header) + sum(
+            sys.getsizeof(c) for c in header or [])
+
+
 class FileContentProxy(object):
-    __metaclass__ = Singleton
-    file_content = {}
+    """ Gives the content of the files from the cache of the process """
+    cache = FileContentCache()
 
     def get_content(self, ourfile, line_filter=None):
-        key = FileContentKey(ourfile, line_filter)
-        try:
-            return self.file_content[key]
-        except KeyError:
-            self.file_content[key] = FileContentAdapter(
-                ourfile, line_filter).get_content()
-            return self.file_content[key]
+        return self.cache.get_content(ourfile, line_filter)
 
     def unproxy(self, ourfile, line_filter=None):
-        key = FileContentKey(ourfile, line_filter)
+        if not bool(ourfile):
+            return
         try:
-            self.file_content[key] = None
+            self.cache.discard(ourfile, line_filter)
         except:
-            pass
+            logger.exception("Exception when releasing the file content.")
 
 
 class AnalyzerHandler(object):
@@ -334,8 +581,91 @@ class InvalidIntegrationFile(Exception):
         return repr(self.value)
 
 
+class IntegrationCanceled(Exception):
+    """ Raised by the progress callback to stop an integration """
+    pass
+
+
+def update_search_index(model, queryset):
+    """ Index the objects of the queryset, created without the signals """
+    for using in connection_router.for_write():
+        try:
+            index = haystack_connections[using].get_unified_index(
+            ).get_index(model)
+        except NotHandled:
+            continue
+        backend = index.get_backend(using)
+        if backend is not None:
+            backend.update(index, queryset)
+
+
+class FileImportCheckpoint(object):
+    """
+    Progress of the integration of a file of a file import : the last line
+    integrated, the number of imported rows and of errors. It is saved on
+    the FileImport in the transaction of each chunk, so that a stopped
+    integration continues after the last chunk saved. The errors of the
+    rows are added as FileImportError, the checkpoint only counts them.
+    """
+    def __init__(self, file_import, name):
+        self.file_import = file_import
+        self.name = name
+        state = file_import.get_checkpoint().get(name, {})
+        self.line = state.get('line', 1)
+        self.imported = state.get('imported', 0)
+        self.nb_error = state.get('nb_error', 0)
+        self.done = state.get('done', False)
+
+    def save(self, line, imported, errors):
+        """ Called with the rows of a chunk, in its transaction """
+        self.line = line
+        self.imported += imported
+        self.nb_error += len(errors)
+        FileImportError.objects.bulk_create(
+            FileImportError(file_import=self.file_import,
+                            name=self.name,
+                            line=line_error,
+                            errors=json.dumps(errors_row, cls=JSONEncoder))
+            for (line_error, errors_row) in errors)
+        self._write()
+
+    def get_errors(self):
+        """ The (line number, errors) of the rows saved, in file order """
+        return [(e.line, json.loads(e.errors))
+                for e in FileImportError.objects.filter(
+                    file_import=self.file_import, name=self.name).order_by(
+                        'line', 'pk')]
+
+    def finish(self):
+        self.done = True
+        self._write()
+
+    def _write(self):
+        checkpoint = self.file_import.get_checkpoint()
+        checkpoint[self.name] = {
+            'line': self.line,
+            'imported': self.imported,
+            'nb_error': self.nb_error,
+            'done': self.done,
+        }
+        self.file_import.checkpoint = json.dumps(checkpoint, cls=JSONEncoder)
+        FileImport.objects.filter(pk=self.file_import.pk).update(
+            checkpoint=self.file_import.checkpoint)
+
+
 class IntegratorHandler(object):
-    def integrate(self, file, file_additional=None, user=None):
+    def integrate(self,
+                  file,
+                  file_additional=None,
+                  user=None,
+                  progress=None,
+                  checkpoint=None):
+        """
+        With a checkpoint, the integration continues after its last line,
+        a file already integrated is not integrated again.
+        """
+        if checkpoint is not None and checkpoint.done:
+            return (checkpoint.imported, checkpoint.get_errors())
         integrator = IntegratorFactory().get_instance(file)
         if integrator is None:
             raise InvalidIntegrationFile(
@@ -343,7 +673,9 @@ class IntegratorHandler(object):
 
         result = integrator.integrate(file,
                                       file_additional=file_additional,
-                                      user=user)
+                                      user=user,
+                                      progress=progress,
+                                      checkpoint=checkpoint)
         return result
 
     def post_processing(self, files):
@@ -377,33 +709,7 @@ class FilePatientFactory(object):
 
     def get_serializer(self, row):
         try:
-            data = {
-                'family_name': row[1],
-                'original_name': row[2],
-                'first_name': row[3],
-                'birth_date': self.get_date(row[4]),
-                'sex': self.get_sex_value(row[5]),
-                'address_street': row[6],
-                'address_complement': row[7],
-                'address_zipcode': row[8],
-                'address_city': row[9],
-                'email': row[10],
-                'phone': row[11],
-                'mobile_phone': row[12],
-                'job': row[13],
-                'hobbies': row[14],
-                'smoker': self.get_boolean_value(row[15]),
-                'laterality': self.get_laterality_value(row[16]),
-                'important_info': row[17],
-                'current_treatment': row[18],
-                'surgical_history': row[19],
-                'medical_history': row[20],
-                'family_history': row[21],
-                'trauma_history': row[22],
-                'medical_report': row[23],
-                'creation_date': self.get_default_date(),
-            }
-            serializer = self.serializer_class(data=data)
+            serializer = self.serializer_class(data=self.get_data(row))
         except ValueError as e:
             logger.exception("Exception when creating examination.")
             serializer = {'errors': ["%s" % e]}
@@ -411,6 +717,44 @@ class FilePatientFactory(object):
             logger.exception("Exception when creating examination.")
         return serializer
 
+    def get_data(self, row):
+        """ Give the data of the serializer, raise ValueError if invalid """
+        return {
+            'family_name': row[1],
+            'original_name': row[2],
+            'first_name': row[3],
+            'birth_date': self.get_date(row[4]),
+            'sex': self.get_sex_value(row[5]),
+            'address_street': row[6],
+            'address_complement': row[7],
+            'address_zipcode': row[8],
+            'address_city': row[9],
+            'email': row[10],
+            'phone': row[11],
+            'mobile_phone': row[12],
+            'job': row[13],
+            'hobbies': row[14],
+            'smoker': self.get_boolean_value(row[15]),
+            'laterality': self.get_laterality_value(row[16]),
+            'important_info': row[17],
+            'current_treatment': row[18],
+            'surgical_history': row[19],
+            'medical_history': row[20],
+            'family_history': row[21],
+            'trauma_history': row[22],
+            'medical_report': row[23],
+            'creation_date': self.get_default_date(),
+        }
+
+    def get_identity(self, row):
+        """
+        Give the (family name, first name, birth date) of the row as saved
+        by the serializer, raise ValueError if invalid
+        """
+        return (get_name_filters().filter(row[1].strip()),
+                get_firstname_filters().filter(row[3].strip()),
+                self.get_date(row[4]))
+
     def get_sex_value(self, value):
         if value.upper() == 'F':
             return 'F'
@@ -439,52 +783,415 @@ class FilePatientFactory(object):
 
 
 class AbstractIntegrator(object):
-    def integrate(self, file, file_additional=None, user=None):
-        pass
-
+    """
+    Integrates the rows of a file chunk by chunk. In bulk mode, the valid
+    rows of a chunk are inserted with bulk_create in one transaction, so
+    the receivers are not called : the daily statistics of the integrated
+    days are rebuilt at the end.
+    """
+    # Date field of the integrated instances, counted by the statistics
+    date_field = None
 
-class IntegratorPatient(AbstractIntegrator):
-    def __init__(self, serializer_class=None):
+    def __init__(self, serializer_class=None, bulk=True):
         self.extractor = Extractor()
         self.serializer_class = serializer_class
+        self.bulk = bulk
+        self.days = set()
+        self._validator = None
+
+    def __getstate__(self):
+        # Given to the processes of the pool, which build their validator
+        state = self.__dict__.copy()
+        state['_validator'] = None
+        return state
+
+    def integrate(self,
+                  file,
+                  file_additional=None,
+                  user=None,
+                  progress=None,
+                  checkpoint=None):
+        """
+        progress is called after each chunk with the number of rows read
+        and of errors, it may raise IntegrationCanceled : the chunks
+        already integrated are kept.
 
-    def integrate(self, file, file_additional=None, user=None):
+        Each chunk is saved in a transaction, with the checkpoint when
+        given : the rows up to its line are not integrated again.
+        """
         content = self.extractor.get_content(file)
+        self.prepare(file_additional, user)
+        start_line = 1
         nb_line = 0
         errors = []
-        factory = FilePatientFactory()
+        if checkpoint is not None:
+            start_line = checkpoint.line
+            nb_line = checkpoint.imported
+            errors = checkpoint.get_errors()
+        try:
+            with closing(self.validate_chunks(content, file_additional, user,
+                                              start_line)) as chunks:
+                for (nb_row, last_line, valid, errors_chunk) in chunks:
+                    with transaction.atomic():
+                        (nb_chunk, errors_chunk) = self.save_validated(
+                            valid, errors_chunk)
+                        if checkpoint is not None:
+                            checkpoint.save(last_line, nb_chunk, errors_chunk)
+                    nb_line += nb_chunk
+                    errors += errors_chunk
+                    if progress is not None:
+                        progress(nb_row, len(errors_chunk))
+            if checkpoint is not None:
+                checkpoint.finish()
+        finally:
+            if self.days:
+                rebuild_daily_statistics(min(self.days), max(self.days))
+        return (nb_line, errors)
+
+    def prepare(self, file_additional=None, user=None):
+        """ Load what the validation of the rows needs, before it starts """
+        pass
+
+    def integrate_chunk(self, chunk, file_additional=None, user=None):
+        """ Integrate the (line number, row) of the chunk """
+        (valid, errors) = self.validate_chunk(chunk, file_additional, user)
+        return self.save_validated(valid, errors)
 
-        for idx, r in enumerate(content['content']):
-            serializer = factory.get_serializer(r)
+    def validate_chunk(self, chunk, file_additional=None, user=None):
+        """
+        Give the (line number, validated data) and the (line number, errors)
+        of the rows of the chunk. It may run in a process of the pool, so
+        it does not write into the database.
+        """
+        return ([], [])
+
+    def save_validated(self, valid, errors):
+        """ Save the validated rows of a chunk, in the order of the file """
+        (nb_line, errors_save) = self.save_chunk(valid)
+        return (nb_line, sorted(errors + errors_save, key=lambda e: e[0]))
+
+    def get_workers(self, content):
+        """
+        Number of processes validating the rows, the IMPORT_WORKERS setting
+        gives it for the large files (all the cores when None).
+        """
+        workers = getattr(settings, 'IMPORT_WORKERS', 1)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if (workers <= 1 or content['nb_row'] <= IMPORT_PARALLEL_MIN_ROWS
+                or _get_pool_context() is None or any(
+                    c.in_atomic_block for c in connections.all())):
+            return 1
+        return workers
+
+    def validate_chunks(self,
+                        content,
+                        file_additional=None,
+                        user=None,
+                        start_line=1):
+        """
+        Give the (number of rows, last line, valid rows, errors) of the
+        chunks after start_line, in the order of the file. With several
+        workers, the chunks are validated by a pool of processes a few
+        chunks ahead of the saved ones.
+        """
+        chunks = self._iter_chunks(content, start_line)
+        workers = self.get_workers(content)
+        if workers > 1:
+            pending = deque()
+            for validated in self._validate_in_pool(workers, chunks, pending,
+                                                    file_additional, user):
+                yield validated
+            # The chunks which the pool did not validate
+            chunks = chain((chunk for (chunk, result) in pending), chunks)
+        for chunk in chunks:
+            (valid, errors) = self.validate_chunk(chunk, file_additional, user)
+            yield (len(chunk), chunk[-1][0], valid, errors)
+
+    def _validate_in_pool(self, workers, chunks, pending, file_additional,
+                          user):
+        """
+        The processes of the pool are not forked from the server, they set
+        django up and receive the pickled integrator. It stops at the first
+        chunk not validated in IMPORT_WORKER_TIMEOUT or on error, this chunk
+        and the next ones submitted to the pool are left in pending.
+        """
+        try:
+            pool = _get_pool_context().Pool(
+                workers,
+                initializer=import_worker.init_worker,
+                initargs=(os.environ.get('DJANGO_SETTINGS_MODULE'),
+                          pickle.dumps((self, file_additional, user),
+                                       pickle.HIGHEST_PROTOCOL)))
+        except Exception:
+            logger.exception("Cannot start the processes validating the rows")
+            return
+        try:
+            for chunk in chunks:
+                pending.append(
+                    (chunk, pool.apply_async(import_worker.validate_chunk,
+                                             (chunk, ))))
+                if len(pending) >= 2 * workers:
+                    yield self._get_validated(pending)
+            while pending:
+                yield self._get_validated(pending)
+        except Exception:
+            logger.exception(
+                "The rows are validated without the process pool")
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _get_validated(self, pending):
+        (chunk, result) = pending[0]
+        (valid, errors) = result.get(IMPORT_WORKER_TIMEOUT)
+        pending.popleft()
+        return (len(chunk), chunk[-1][0], valid, errors)
+
+    def _iter_chunks(self, content, start_line):
+        for chunk in content.iter_chunks():
+            if chunk[-1][0] <= start_line:
+                continue
+            yield [r for r in chunk if r[0] > start_line]
+
+    def get_validator(self):
+        """
+        The serializer validating the rows : its fields are built once for
+        all the rows of the file.
+        """
+        if self._validator is None:
+            self._validator = self.serializer_class()
+        return self._validator
+
+    def validate(self, data):
+        """
+        Return the validated data of a row, raise a ValidationError with
+        the errors by field if invalid.
+        """
+        return self.get_validator().run_validation(data)
+
+    def get_instance(self, model, validated_data):
+        many_to_many = [f.name for f in model._meta.many_to_many]
+        return model(**dict((name, value) for (name, value) in
+                            validated_data.items()
+                            if name not in many_to_many))
+
+    def save_chunk(self, valid):
+        """
+        Save the (line number, validated data) of a chunk, one by one
+        when the bulk insert is not possible to report the failing lines.
+        Return the number of lines saved and the errors.
+        """
+        model = self.serializer_class.Meta.model
+        if self.bulk and valid:
+            instances = [self.get_instance(model, d) for (line, d) in valid]
             try:
-                serializer['errors']
-                errors.append((idx + 2, serializer['errors']))
-            except KeyError:
-                if serializer.is_valid():
-                    serializer.save()
-                    nb_line += 1
-                else:
-                    # idx + 2 because : we have header and the index start from 0
-                    # To have the line number we have to add 2 to the index....
-                    errors.append((idx + 2, serializer.errors))
-                    logger.info("errors detected, data is = %s " %
-                                serializer.initial_data)
+                with transaction.atomic():
+                    model.objects.bulk_create(instances)
+                    _set_inserted_pks(model, instances)
+                    self.bulk_created(model, instances)
+                return (len(instances), [])
+            except DatabaseError:
+                logger.exception("Bulk insert failed, save one by one.")
+        nb_line = 0
+        errors = []
+        for (line, validated_data) in valid:
+            try:
+                with transaction.atomic():
+                    self.create_instance(model, validated_data)
+                nb_line += 1
+            except DatabaseError as e:
+                logger.exception("Exception when saving the line %s." % line)
+                errors.append((line, {
+                    'general_problem':
+                    _('There is a problem when reading this line :') +
+                    _unicode(e)
+                }))
         return (nb_line, errors)
 
+    def create_instance(self, model, validated_data):
+        """
+        Save one row as the serializer would, the receivers know that the
+        instance is imported
+        """
+        instance = self.get_instance(model, validated_data)
+        instance._imported = True
+        instance.save()
+        for field in model._meta.many_to_many:
+            if field.name in validated_data:
+                getattr(instance, field.name).set(validated_data[field.name])
+        return instance
+
+    def bulk_created(self, model, instances):
+        """
+        Called in the transaction of a bulk insert, the signals are not
+        sent for the created instances
+        """
+        if self.date_field is not None:
+            self.days.update(
+                get_day(getattr(i, self.date_field)) for i in instances
+                if getattr(i, self.date_field) is not None)
+
+
+def _set_inserted_pks(model, instances):
+    """
+    Set the primary keys of the instances inserted by bulk_create when the
+    database does not give them back (SQLite) : the transaction holds the
+    write lock of the database from its first insert, its rows have the
+    consecutive keys up to the greatest one.
+    """
+    if not instances or instances[0].pk is not None:
+        return
+    last_pk = model.objects.aggregate(last_pk=Max('pk'))['last_pk']
+    for (pk, instance) in zip(
+            range(last_pk - len(instances) + 1, last_pk + 1), instances):
+        instance.pk = pk
+
+
+def _get_pool_context():
+    """
+    The processes of the pool are not forked from the threads of the
+    server : they are started by a forkserver, or spawned. A frozen
+    application cannot start them, nor python2 which only forks.
+    """
+    if getattr(sys, 'frozen', False):
+        return None
+    for method in ('forkserver', 'spawn'):
+        try:
+            return multiprocessing.get_context(method)
+        except AttributeError:
+            return None
+        except ValueError:
+            continue
+    return None
+
+
+class IntegratorPatient(AbstractIntegrator):
+    """
+    The duplicated patients are found in memory : the identities of the
+    patients in the database are loaded once, and those of the file are
+    added as they are read.
+    """
+    date_field = 'creation_date'
+
+    def __init__(self, serializer_class=None, bulk=True):
+        super(IntegratorPatient, self).__init__(serializer_class, bulk)
+        self.identities = None
+
+    def __getstate__(self):
+        # The identities are only checked when saved
+        state = super(IntegratorPatient, self).__getstate__()
+        state['identities'] = None
+        return state
+
+    def integrate(self,
+                  file,
+                  file_additional=None,
+                  user=None,
+                  progress=None,
+                  checkpoint=None):
+        self.load_identities()
+        return super(IntegratorPatient, self).integrate(
+            file, file_additional=file_additional, user=user,
+            progress=progress, checkpoint=checkpoint)
+
+    def load_identities(self):
+        self.identities = set(
+            self.get_identity(p) for p in Patient.objects.values(
+                'family_name', 'first_name', 'birth_date').iterator())
+
+    def get_validator(self):
+        if self._validator is None:
+            # The unique validator runs a query by row, replaced by the
+            # identities
+            self._validator = self.serializer_class()
+            self._validator.validators = []
+        return self._validator
+
+    def validate_chunk(self, chunk, file_additional=None, user=None):
+        """ The duplicated patients are found when saved """
+        errors = []
+        valid = []
+        factory = FilePatientFactory()
+        for (line, r) in chunk:
+            try:
+                data = factory.get_data(r)
+            except ValueError as e:
+                logger.exception("Exception when creating patient.")
+                errors.append((line, ["%s" % e]))
+                continue
+            try:
+                validated_data = self.validate(data)
+            except ValidationError as e:
+                errors.append((line, e.detail))
+                logger.info("errors detected, data is = %s " % data)
+                continue
+            valid.append((line, validated_data))
+        return (valid, errors)
+
+    def save_validated(self, valid, errors):
+        if self.identities is None:
+            self.identities = set()
+        unique = []
+        for (line, validated_data) in valid:
+            identity = self.get_identity(validated_data)
+            if identity in self.identities:
+                # Same error as the unique validator of the serializer
+                errors.append((line, {
+                    'non_field_errors': [_('This patient already exists')]
+                }))
+                continue
+            if identity is not None:
+                self.identities.add(identity)
+            unique.append((line, validated_data))
+        return super(IntegratorPatient, self).save_validated(unique, errors)
+
+    def get_identity(self, data):
+        """
+        Same fields as the unique validator of the patient serializer,
+        which does not check the patients with an empty field.
+        """
+        values = (data.get('family_name'), data.get('first_name'),
+                  data.get('birth_date'))
+        if None in values:
+            return None
+        return (_unicode(values[0]).lower(), _unicode(values[1]).lower(),
+                values[2])
+
+    def bulk_created(self, model, instances):
+        super(IntegratorPatient, self).bulk_created(model, instances)
+        update_search_index(
+            model, model.objects.filter(pk__in=[i.pk for i in instances]))
+
 
 class IntegratorExamination(AbstractIntegrator):
-    def __init__(self, serializer_class=None):
-        self.extractor = Extractor()
-        self.serializer_class = serializer_class
+    date_field = 'date'
+
+    def __init__(self, serializer_class=None, bulk=True):
+        super(IntegratorExamination, self).__init__(serializer_class, bulk)
         self.patient_table = None
 
-    def integrate(self, file, file_additional=None, user=None):
+    def integrate(self,
+                  file,
+                  file_additional=None,
+                  user=None,
+                  progress=None,
+                  checkpoint=None):
         if file_additional is None:
             return (0, [_('Missing patient file to integrate it.')])
-        content = self.extractor.get_content(file)
-        nb_line = 0
+        return super(IntegratorExamination, self).integrate(
+            file, file_additional=file_additional, user=user,
+            progress=progress, checkpoint=checkpoint)
+
+    def prepare(self, file_additional=None, user=None):
+        # The processes of the pool get the table when forked
+        if bool(file_additional) and self.patient_table is None:
+            self._build_patient_table(file_additional)
+
+    def validate_chunk(self, chunk, file_additional=None, user=None):
         errors = []
-        for idx, r in enumerate(content['content']):
+        valid = []
+        for (line, r) in chunk:
             logger.info("* Load line from content")
             try:
                 patient = self.get_patient(int(r[0]), file_additional)
@@ -508,30 +1215,25 @@ class IntegratorExamination(AbstractIntegrator):
                     'status': ExaminationStatus.NOT_INVOICED,
                     'status_reason': u'%s' % _('Imported examination'),
                 }
-                serializer = self.serializer_class(data=data)
-                if serializer.is_valid():
-                    serializer.save()
-                    nb_line += 1
-                else:
-                    # idx + 2 because : we have header and the index start from 0
-                    # To have the line number we have to add 2 to the index....
-                    errors.append((idx + 2, serializer.errors))
-                    logger.info("errors detected, data is = %s, errors = %s " %
-                                (data, serializer.errors))
+                valid.append((line, self.validate(data)))
+            except ValidationError as e:
+                errors.append((line, e.detail))
+                logger.info("errors detected, data is = %s, errors = %s " %
+                            (data, e.detail))
             except ValueError as e:
                 logger.exception("Exception when creating examination.")
-                errors.append((idx + 2, {
+                errors.append((line, {
                     'general_problem':
                     _('There is a problem when reading this line :') +
                     _unicode(e)
                 }))
             except:
                 logger.exception("Exception when creating examination.")
-                errors.append((idx + 2, {
+                errors.append((line, {
                     'general_problem':
                     _('There is a problem when reading this line.')
                 }))
-        return (nb_line, errors)
+        return (valid, errors)
 
     def get_date(self, value, with_time=False):
         f = "%d/%m/%Y"
@@ -544,20 +1246,36 @@ class IntegratorExamination(AbstractIntegrator):
             return None
         if self.patient_table is None:
             self._build_patient_table(file_patient)
-        return self.patient_table[numero]
+        try:
+            return self.patient_table[numero]
+        except KeyError:
+            raise ValueError(_('The patient %s is not found') % numero)
 
     def _build_patient_table(self, file_patient):
+        """
+        Map the numbers of the patient file to the primary keys of the
+        patients, which are found by identity.
+        """
         content = self.extractor.get_content(file_patient)
-        self.patient_table = {}
         factory = FilePatientFactory()
-        for c in content['content']:
-            serializer = factory.get_serializer(c)
-            # remove validators to get a validated data through filters
-            serializer.validators = []
-            serializer.is_valid()
-            self.patient_table[int(c[0])] = Patient.objects.filter(
-                family_name=serializer.validated_data['family_name'],
-                first_name=serializer.validated_data['first_name'],
-                birth_date=serializer.validated_data['birth_date'])
-
-            logger.info("found patient %s " % self.patient_table[int(c[0])])
+        numbers = {}
+        for (line, c) in content.iter_rows():
+            try:
+                numbers.setdefault(factory.get_identity(c), []).append(
+                    int(c[0]))
+            except (ValueError, IndexError):
+                logger.info("Invalid patient at line %s" % line)
+        birth_dates = sorted(set(i[2] for i in numbers))
+        self.patient_table = {}
+        # Bounded by the number of parameters of a query
+        for start in range(0, len(birth_dates), IMPORT_CHUNK_SIZE):
+            patients = Patient.objects.filter(
+                birth_date__in=birth_dates[start:start + IMPORT_CHUNK_SIZE]
+            ).order_by('-pk').values_list('pk', 'family_name', 'first_name',
+                                          'birth_date')
+            # The first patient created is kept when there is several
+            for (pk, family_name, first_name, birth_date) in patients:
+                for numero in numbers.get(
+                    (family_name, first_name, birth_date), []):
+                    self.patient_table[numero] = pk
+        logger.info("found %s patients" % len(self.patient_table))
@@ -0,0 +1,197 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Background integration of the file imports.
+
+The jobs are integrated one after the other by a worker thread of the
+server, as SQLite accepts only one writer at a time.
+"""
+import json
+import logging
+import threading
+
+from django.db import close_old_connections, connection
+from django.db.models import F
+from django.utils import timezone
+from django.utils.six.moves import queue
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.utils.encoders import JSONEncoder
+
+from libreosteoweb.models import ImportJob, ImportJobStatus
+from .file_integrator import (Extractor, FileImportCheckpoint,
+                              IntegrationCanceled, IntegratorHandler)
+from .utils import _unicode
+
+logger = logging.getLogger(__name__)
+
+_jobs = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_import_job(job):
+    """ Queue the job, the worker thread is started on the first job """
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work,
+                                       name='libreosteo-import')
+            _worker.daemon = True
+            _worker.start()
+    _jobs.put(job.pk)
+
+
+def cancel_import_job(job):
+    """
+    A pending job is canceled at once, a running job stops after its
+    current chunk of rows.
+    """
+    ImportJob.objects.filter(pk=job.pk,
+                             status=ImportJobStatus.PENDING).update(
+                                 status=ImportJobStatus.CANCELED,
+                                 end_date=timezone.now())
+    ImportJob.objects.filter(pk=job.pk,
+                             status=ImportJobStatus.RUNNING).update(
+                                 cancel_requested=True)
+    job.refresh_from_db()
+    return job
+
+
+def interrupt_import_jobs():
+    """ Fail the jobs left unfinished by a previous run of the server """
+    return ImportJob.objects.filter(status__in=(
+        ImportJobStatus.PENDING, ImportJobStatus.RUNNING)).update(
+            status=ImportJobStatus.FAILED, end_date=timezone.now())
+
+
+def _work():
+    while True:
+        job_id = _jobs.get()
+        close_old_connections()
+        try:
+            run_import_job(job_id)
+        except Exception:
+            logger.exception("Exception when running the import job %s" %
+                             job_id)
+        finally:
+            connection.close()
+
+
+class ImportJobProgress(object):
+    """ Saves the progress of the job, stops it when canceled """
+    def __init__(self, job):
+        self.job = job
+
+    def __call__(self, nb_row, nb_error):
+        jobs = ImportJob.objects.filter(pk=self.job.pk)
+        jobs.update(nb_row_done=F('nb_row_done') + nb_row,
+                    nb_error=F('nb_error') + nb_error)
+        if jobs.filter(cancel_requested=True).exists():
+            raise IntegrationCanceled()
+
+
+def run_import_job(job_id):
+    """ Integrate the files of the job, unless canceled before """
+    started = ImportJob.objects.filter(
+        pk=job_id, status=ImportJobStatus.PENDING).update(
+            status=ImportJobStatus.RUNNING, start_date=timezone.now())
+    if not started:
+        return
+    job = ImportJob.objects.select_related('file_import',
+                                           'user').get(pk=job_id)
+    status = ImportJobStatus.DONE
+    try:
+        if job.file_import is None:
+            raise ValueError(_('The files to import have been deleted.'))
+        (nb_row_total, nb_row_done) = get_row_count(job.file_import)
+        ImportJob.objects.filter(pk=job.pk).update(nb_row_total=nb_row_total,
+                                                   nb_row_done=nb_row_done,
+                                                   nb_row_start=nb_row_done)
+        result = integrate_file_import(job.file_import, job.user,
+                                       ImportJobProgress(job))
+    except IntegrationCanceled:
+        status = ImportJobStatus.CANCELED
+        result = None
+    except Exception as e:
+        logger.exception("Exception when integrating the files.")
+        status = ImportJobStatus.FAILED
+        result = {'general_problem': _unicode(e)}
+    ImportJob.objects.filter(pk=job.pk).update(
+        status=status,
+        end_date=timezone.now(),
+        result=json.dumps(result, cls=JSONEncoder) if result else '')
+
+
+def get_row_count(file_import):
+    """
+    Number of rows of the files without their header, and of those already
+    integrated by a previous job
+    """
+    extractor = Extractor()
+    checkpoint = file_import.get_checkpoint()
+    nb_row_total = 0
+    nb_row_done = 0
+    for (name, f) in (('patient', file_import.file_patient),
+                      ('examination', file_import.file_examination)):
+        if not bool(f):
+            continue
+        nb_row = max(extractor.get_content(f)['nb_row'] - 1, 0)
+        state = checkpoint.get(name, {})
+        nb_row_total += nb_row
+        # The header is the first line
+        nb_row_done += nb_row if state.get('done') else max(
+            state.get('line', 1) - 1, 0)
+    return (nb_row_total, nb_row_done)
+
+
+def integrate_file_import(file_import, user, progress=None):
+    """
+    Integrate the patients then the examinations of the file import, from
+    its checkpoint : integrating it again does not import the rows twice.
+    """
+    integrator = IntegratorHandler()
+    result = {
+        'patient': {
+            'imported': 0,
+            'errors': []
+        },
+        'examination': {
+            'imported': 0,
+            'errors': []
+        }
+    }
+    # The receivers stay connected for the requests of the other users,
+    # the integrators give the imported instances their side effects
+    try:
+        if file_import.file_patient:
+            # Start integration of each patient in the file
+            (nb_line, errors) = integrator.integrate(
+                file_import.file_patient,
+                progress=progress,
+                checkpoint=FileImportCheckpoint(file_import, 'patient'))
+            result['patient'] = {'imported': nb_line, 'errors': errors}
+        if file_import.file_examination:
+            # Start integration of each examination in the file
+            (nb_line, errors) = integrator.integrate(
+                file_import.file_examination,
+                file_additional=file_import.file_patient,
+                user=user,
+                progress=progress,
+                checkpoint=FileImportCheckpoint(file_import, 'examination'))
+            result['examination'] = {'imported': nb_line, 'errors': errors}
+    finally:
+        integrator.post_processing(
+            files=[file_import.file_patient, file_import.file_examination])
+    return result
@@ -0,0 +1,47 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Processes of the pool validating the rows of the imported files.
+
+They are not forked from the server, whose threads hold locks and
+database connections : they are started by a forkserver or spawned, and
+set django up themselves. This module is imported before, so it does not
+import the models, the integrator is given pickled.
+"""
+import os
+import pickle
+
+# Set in the processes of the pool, the application does not run its
+# startup maintenance (purge of the file imports, interrupted jobs) there
+WORKER_ENVIRONMENT_KEY = 'LIBREOSTEO_IMPORT_WORKER'
+
+# Integrator of the process, with the file_additional and the user of the
+# integration
+_integration = None
+
+
+def init_worker(settings_module, payload):
+    global _integration
+    os.environ[WORKER_ENVIRONMENT_KEY] = '1'
+    if settings_module:
+        os.environ['DJANGO_SETTINGS_MODULE'] = settings_module
+    import django
+    django.setup()
+    _integration = pickle.loads(payload)
+
+
+def validate_chunk(chunk):
+    (integrator, file_additional, user) = _integration
+    return integrator.validate_chunk(chunk, file_additional, user)
@@ -0,0 +1,92 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+from django.db import connection
+from django.db.models import Prefetch, prefetch_related_objects
+from libreosteoweb import models
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Keep the number of parameters under the SQLite limit (999)
+_BATCH_SIZE = 500
+
+
+class InvoiceChainResolver(object):
+    """
+    Resolve the last invoice and the invoices history of a list of
+    examinations in memory.
+
+    The invoices attached to the examinations and all the invoices of their
+    cancel/credit note chains are loaded with one recursive query, then the
+    canceled_by links are set on the loaded instances, so that
+    Examination.last_invoice and Examination.invoices_list do not hit the
+    database anymore.
+    """
+
+    def resolve(self, examinations):
+        examinations = [e for e in examinations if e.pk is not None]
+        for idx in range(0, len(examinations), _BATCH_SIZE):
+            self._resolve_batch(examinations[idx:idx + _BATCH_SIZE])
+        return examinations
+
+    def _resolve_batch(self, examinations):
+        attached = dict((e.pk, []) for e in examinations)
+        invoices = {}
+        for row in models.Invoice.objects.raw(
+                self._get_chain_query(len(attached)), list(attached.keys())):
+            # The same invoice could be returned for many examinations
+            invoice = invoices.setdefault(row.pk, row)
+            if row.chain_is_root:
+                attached[row.chain_examination_id].append(invoice)
+
+        for invoice in invoices.values():
+            if invoice.canceled_by_id in invoices:
+                invoice.canceled_by = invoices[invoice.canceled_by_id]
+        prefetch_related_objects(
+            list(invoices.values()),
+            Prefetch('paiment_set',
+                     queryset=models.Paiment.objects.order_by('-date'),
+                     to_attr='prefetched_paiments'))
+
+        for examination in examinations:
+            examination.set_invoice_chain(
+                sorted(attached[examination.pk],
+                       key=lambda i: i.date,
+                       reverse=True))
+
+    def _get_chain_query(self, nb_examinations):
+        qn = connection.ops.quote_name
+        through = models.Examination.invoices.through._meta
+        invoice = models.Invoice._meta
+        return """
+            WITH RECURSIVE chain(examination_id, invoice_id, is_root) AS (
+                SELECT {examination_col}, {invoice_col}, 1 FROM {through}
+                    WHERE {examination_col} IN ({params})
+                UNION
+                SELECT chain.examination_id, i.{canceled_by}, 0
+                    FROM chain JOIN {invoice} i ON i.{pk} = chain.invoice_id
+                    WHERE i.{canceled_by} IS NOT NULL
+            )
+            SELECT chain.examination_id AS chain_examination_id,
+                   chain.is_root AS chain_is_root, {invoice}.*
+                FROM chain JOIN {invoice} ON {invoice}.{pk} = chain.invoice_id
+            """.format(
+            through=qn(through.db_table),
+            examination_col=qn(through.get_field('examination').column),
+            invoice_col=qn(through.get_field('invoice').column),
+            invoice=qn(invoice.db_table),
+            pk=qn(invoice.pk.column),
+            canceled_by=qn(invoice.get_field('canceled_by').column),
+            params=', '.join(['%s'] * nb_examinations))
@@ -0,0 +1,91 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
+from django.db import transaction
+from libreosteoweb.models import PaimentMean
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PaimentMeanRegistry(object):
+    """
+    In-process registry of the paiment means, indexed by code.
+
+    The paiment means are loaded once from the database and kept until
+    a PaimentMean is saved or deleted, and again once committed (see
+    receivers.py). The transaction changing them reads them from the
+    database until it ends, so that a rolled back change is not kept.
+    When several paiment means share a code, an enabled one is kept.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._means = None
+        self._generation = 0
+
+    def _get_means(self):
+        if self._has_uncommitted_change():
+            return self._load()
+        means = self._means
+        if means is None:
+            with self._lock:
+                generation = self._generation
+            means = self._load()
+            with self._lock:
+                # Do not keep the loaded values if cleared in the meantime
+                if generation == self._generation:
+                    self._means = means
+        return means
+
+    def _load(self):
+        means = OrderedDict()
+        for paiment_mean in PaimentMean.objects.all().order_by('id'):
+            current = means.get(paiment_mean.code)
+            if current is None or (paiment_mean.enable
+                                   and not current.enable):
+                means[paiment_mean.code] = paiment_mean
+        return means
+
+    def _has_uncommitted_change(self):
+        """ True in the transaction of a change, until its commit """
+        return any(func == self.clear for (sids, func) in
+                   transaction.get_connection().run_on_commit)
+
+    def get(self, code):
+        """ Return the PaimentMean of this code, None if not found """
+        return self._get_means().get(code)
+
+    def get_text(self, code, default='n/a'):
+        paiment_mean = self.get(code)
+        if paiment_mean is not None:
+            return paiment_mean.text
+        return default
+
+    def get_enabled_codes(self):
+        return [
+            code for (code, paiment_mean) in self._get_means().items()
+            if paiment_mean.enable
+        ]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._means = None
+        logger.debug("Paiment means registry cleared")
+
+
+paiment_means = PaimentMeanRegistry()
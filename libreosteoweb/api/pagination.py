@@ -0,0 +1,143 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import date
+import json
+import logging
+
+from django.db.models import Q
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+logger = logging.getLogger(__name__)
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    Cursor pagination on a composite key of indexed columns.
+
+    The cursor stores the key of the last row of the page, the next page
+    is selected with a WHERE clause on this key, so that the cost of a page
+    does not depend on its position.
+
+    The pagination is opt-in : without the cursor or page_size parameter,
+    the whole list is returned as before.
+    """
+    ordering = ('-id', )
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def is_requested(self, request):
+        return (self.cursor_query_param in request.query_params
+                or self.page_size_query_param in request.query_params)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_requested(request):
+            return None
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.get_position_filter(position))
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        self.next_position = None
+        if len(results) > self.page_size:
+            self.next_position = self.get_position(self.page[-1])
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict([
+                ('next', self.get_next_link()),
+                ('results', data),
+            ]))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param,
+                                  self.page_size)
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.encode_cursor(self.next_position))
+
+    def get_position(self, instance):
+        return [
+            self._encode_value(getattr(instance, f.lstrip('-')))
+            for f in self.ordering
+        ]
+
+    def get_position_filter(self, position):
+        """
+        Build the filter selecting the rows after the position, for
+        ordering (a, b) : a > x OR (a = x AND b > y)
+        """
+        position_filter = Q()
+        equal_filter = Q()
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip('-')
+            lookup = '%s__lt' if field.startswith('-') else '%s__gt'
+            position_filter |= equal_filter & Q(**{lookup % name: value})
+            equal_filter &= Q(**{name: value})
+        return position_filter
+
+    def encode_cursor(self, position):
+        cursor = urlsafe_b64encode(json.dumps(position).encode('utf-8'))
+        return cursor.decode('ascii')
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            position = json.loads(
+                urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(
+                self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def _encode_value(self, value):
+        # Keep the microseconds of the datetime to not skip rows
+        if isinstance(value, date):
+            return value.isoformat()
+        return value
+
+
+class DateKeysetPagination(KeysetPagination):
+    ordering = ('-date', '-id')
+
+
+class NameKeysetPagination(KeysetPagination):
+    ordering = ('family_name', 'first_name', 'id')
@@ -13,9 +13,13 @@
 # You should have received a copy of the GNU General Public License
 # along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
 from django.dispatch import receiver
-from django.db.models.signals import post_save,post_delete
+from django.db import transaction
+from django.db.models.signals import post_save,post_delete,pre_save
 from django.utils.translation import ugettext_lazy as _
-from ..models import OfficeEvent, Patient, Examination, PatientDocument
+from ..models import (
+    OfficeEvent, Patient, Examination, Invoice, PatientDocument, PaimentMean)
+from .invoicing.paiment_means import paiment_means
+from .statistics import refresh_daily_statistics
 import logging
 
 # Get an instance of a logger
@@ -67,6 +71,9 @@ class temp_disconnect_signal():
 
 @receiver(post_save, sender=Patient)
 def receiver_newpatient(sender, **kwargs):
+	# The imported patients have no office event, as when inserted in bulk
+	if getattr(kwargs['instance'], '_imported', False):
+		return
 	event = OfficeEvent()
 	event.clazz = Patient.__name__
 	if kwargs['created']:
@@ -87,6 +94,9 @@ def receiver_newpatient(sender, **kwargs):
 
 @receiver(post_save, sender=Examination)
 def receiver_examination(sender, **kwargs):
+	# The imported examinations have no office event, as when inserted in bulk
+	if getattr(kwargs['instance'], '_imported', False):
+		return
 	event = OfficeEvent()
 	event.clazz = Examination.__name__
 	if kwargs['created']:
@@ -101,3 +111,60 @@ def receiver_examination(sender, **kwargs):
 def delete_document(sender, **kwargs):
     doc_instance = kwargs['instance']
     doc_instance.document.delete()
+
+@receiver([post_save, post_delete], sender=PaimentMean)
+def receiver_paiment_mean(sender, **kwargs):
+    # The transaction reads the change at once, the other ones when
+    # committed : a rolled back change is not kept by the registry
+    paiment_means.clear()
+    transaction.on_commit(paiment_means.clear)
+
+# Date of the instances counted in the daily statistics
+STATISTICS_DATE_FIELDS = {
+    Patient: 'creation_date',
+    Examination: 'date',
+    Invoice: 'date',
+}
+# Therapeut of the rollup rows of the instances, the new patients are not
+# attributed to a therapeut
+STATISTICS_THERAPEUT_FIELDS = {
+    Examination: 'therapeut_id',
+    Invoice: 'therapeut_id',
+}
+
+def get_statistics_values(sender, instance):
+    """ Give the (date, therapeut id) of the rollup row of the instance """
+    field = STATISTICS_THERAPEUT_FIELDS.get(sender)
+    return (getattr(instance, STATISTICS_DATE_FIELDS[sender]),
+            getattr(instance, field) if field is not None else None)
+
+@receiver(pre_save, sender=Patient)
+@receiver(pre_save, sender=Examination)
+@receiver(pre_save, sender=Invoice)
+def receiver_statistics_previous_day(sender, instance, **kwargs):
+    """ Keep the previous date and therapeut of an updated instance, its
+        rollup row has to be refreshed too """
+    instance._statistics_previous = None
+    if kwargs.get('raw') or instance.pk is None or instance._state.adding:
+        return
+    fields = [STATISTICS_DATE_FIELDS[sender]]
+    if sender in STATISTICS_THERAPEUT_FIELDS:
+        fields.append(STATISTICS_THERAPEUT_FIELDS[sender])
+    previous = sender.objects.filter(pk=instance.pk).values_list(
+        *fields).first()
+    if previous is not None:
+        instance._statistics_previous = (previous + (None, ))[:2]
+
+@receiver([post_save, post_delete], sender=Patient)
+@receiver([post_save, post_delete], sender=Examination)
+@receiver([post_save, post_delete], sender=Invoice)
+def receiver_statistics(sender, instance, **kwargs):
+    # Loading a dump is followed by a rebuild of the whole rollup
+    if kwargs.get('raw'):
+        return
+    rows = [get_statistics_values(sender, instance)]
+    previous = getattr(instance, '_statistics_previous', None)
+    if previous is not None and previous != rows[0]:
+        rows.append(previous)
+    for (value, therapeut) in rows:
+        refresh_daily_statistics([value], therapeuts=[therapeut])
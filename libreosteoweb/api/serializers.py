@@ -20,14 +20,21 @@ from datetime import date
 from .validators import UniqueTogetherIgnoreCaseValidator
 from .filter import get_name_filters, get_firstname_filters
 from django.core.exceptions import ObjectDoesNotExist
-from .file_integrator import Extractor
+from .file_integrator import Extractor, is_supported_encoding
+import codecs
+import json
 import logging
 from django.conf import settings
+from django.utils import timezone
 from .utils import NetworkHelper
-from django.db.models import Max
+from django.db.models import Manager, Max
 from .utils import convert_to_long
 from libreosteoweb.api.utils import _unicode
 from libreosteoweb.api.demonstration import get_demonstration_file
+from libreosteoweb.api.invoicing.chain import InvoiceChainResolver
+from libreosteoweb.api.invoicing.paiment_means import paiment_means
+from libreosteoweb.api.statistics import (
+    GRANULARITIES, MAX_PERIODS, SeriesStatistics)
 
 logger = logging.getLogger(__name__)
 
@@ -112,6 +119,9 @@ class ExaminationExtractSerializer(WithPkMixin, serializers.ModelSerializer):
         depth = 1
 
     def get_nb_comments(self, obj):
+        # Annotated by the timeline queryset, avoids a COUNT query per row
+        if hasattr(obj, 'nb_comments'):
+            return obj.nb_comments
         return ExaminationComment.objects.filter(
             examination__exact=obj.id).count()
 
@@ -120,11 +130,7 @@ class PaimentModeSerializer(serializers.Serializer):
     paiment_mode_text = serializers.SerializerMethodField()
 
     def get_paiment_mode_text(self, obj):
-        paiment_mean = PaimentMean.objects.filter(
-            code=obj.paiment_mode).first()
-        if paiment_mean is not None:
-            return paiment_mean.text
-        return 'n/a'
+        return paiment_means.get_text(obj.paiment_mode)
 
 
 class PaimentSerializer(PaimentModeSerializer):
@@ -147,6 +153,17 @@ class InvoiceSerializer(WithPkMixin, serializers.ModelSerializer,
         depth = 1
 
 
+class ExaminationListSerializer(serializers.ListSerializer):
+    invoice_fields = ('invoice_number', 'invoices_list', 'last_invoice')
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, Manager) else data
+        if set(self.child.fields) & set(self.invoice_fields):
+            iterable = InvoiceChainResolver().resolve(iterable)
+        return super(ExaminationListSerializer,
+                     self).to_representation(iterable)
+
+
 class ExaminationSerializer(serializers.ModelSerializer):
     invoice_number = serializers.CharField(source="get_invoice_number",
                                            required=False,
@@ -171,6 +188,32 @@ class ExaminationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Examination
         fields = '__all__'
+        list_serializer_class = ExaminationListSerializer
+
+
+class UnpaidInvoiceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Invoice
+        fields = ('id', 'number', 'date', 'amount', 'currency', 'status')
+
+
+class ExaminationUnpaidSerializer(ExaminationSerializer):
+    """ Examination waiting for paiement, for the reconciliation """
+    last_invoice = UnpaidInvoiceSerializer(read_only=True,
+                                           allow_null=True,
+                                           required=False)
+
+    class Meta(ExaminationSerializer.Meta):
+        fields = ('id', 'date', 'reason', 'status', 'type', 'patient',
+                  'therapeut', 'patient_detail', 'therapeut_detail',
+                  'invoice_number', 'last_invoice')
+
+
+class ExaminationSummarySerializer(ExaminationSerializer):
+    """ Examination without the anatomical findings, for the lists """
+    class Meta(ExaminationSerializer.Meta):
+        fields = None
+        exclude = Examination.FINDINGS_FIELDS
 
 
 class CheckSerializer(serializers.Serializer):
@@ -202,9 +245,8 @@ class ExaminationInvoicingSerializer(serializers.Serializer):
                     raise serializers.ValidationError(_("Amount is invalid"))
                 if attrs['paiment_mode'] is None or len(
                         attrs['paiment_mode'].strip()
-                ) == 0 or attrs['paiment_mode'] not in [
-                        p.code for p in PaimentMean.objects.filter(enable=True)
-                ] + ['notpaid']:
+                ) == 0 or attrs['paiment_mode'] not in (
+                        paiment_means.get_enabled_codes() + ['notpaid']):
                     raise serializers.ValidationError(
                         _("Paiment mode is mandatory when the examination is invoiced"
                           ))
@@ -223,6 +265,47 @@ class ExaminationInvoicingSerializer(serializers.Serializer):
             raise serializers.ValidationError(_('Missing data to continue'))
 
 
+class StatisticsSeriesSerializer(serializers.Serializer):
+    """
+    Parameters of the statistics series, the range is given by the from
+    and to days, by default from the start of the current year. The
+    statistics_class of the context computes the series.
+    """
+    to = serializers.DateField(required=False)
+    granularity = serializers.ChoiceField(choices=GRANULARITIES,
+                                          default='month')
+    therapeut = serializers.ListField(child=serializers.IntegerField(),
+                                      required=False)
+    by_therapeut = serializers.BooleanField(default=False)
+
+    def get_fields(self):
+        fields = super(StatisticsSeriesSerializer, self).get_fields()
+        # from is a keyword, it cannot be declared as an attribute
+        fields['from'] = serializers.DateField(required=False)
+        return fields
+
+    def validate(self, attrs):
+        end = attrs.get('to') or date.today()
+        start = attrs.get('from') or end.replace(month=1, day=1)
+        if start > end:
+            raise serializers.ValidationError(
+                _("The start of the range is after its end"))
+        # The days are compared to the start of the next day
+        if end >= date.max:
+            raise serializers.ValidationError(
+                _("The end of the range is too far"))
+        statistics_class = self.context.get('statistics_class',
+                                            SeriesStatistics)
+        statistics = statistics_class(start, end, attrs['granularity'],
+                                      attrs.get('therapeut'),
+                                      attrs['by_therapeut'])
+        if statistics.get_period_count() > MAX_PERIODS:
+            raise serializers.ValidationError(
+                _("Too many periods, choose a larger granularity"))
+        attrs['statistics'] = statistics
+        return attrs
+
+
 class ExaminationCommentSerializer(WithPkMixin, serializers.ModelSerializer):
     user_info = UserInfoSerializer(source="user",
                                    required=False,
@@ -233,19 +316,74 @@ class ExaminationCommentSerializer(WithPkMixin, serializers.ModelSerializer):
         fields = '__all__'
 
 
+def _get_values_by_id(queryset, ids, *fields):
+    """
+    Return a dict id -> tuple of the fields values, the ids are queried by
+    batch to keep the number of parameters under the SQLite limit.
+    """
+    ids = list(ids)
+    values = {}
+    for idx in range(0, len(ids), 500):
+        for row in queryset.filter(id__in=ids[idx:idx + 500]).values_list(
+                'id', *fields):
+            values[row[0]] = row[1:]
+    return values
+
+
+class OfficeEventListSerializer(serializers.ListSerializer):
+    """
+    Resolve the patient names and the users of the events with one query
+    by referenced class instead of queries for each event.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, Manager) else data
+        events = list(iterable)
+        references = {Patient.__name__: set(), Examination.__name__: set()}
+        for event in events:
+            if event.clazz in references:
+                references[event.clazz].add(event.reference)
+        names = {
+            Patient.__name__:
+            _get_values_by_id(Patient.objects.all(),
+                              references[Patient.__name__], 'family_name',
+                              'first_name'),
+            Examination.__name__:
+            _get_values_by_id(Examination.objects.all(),
+                              references[Examination.__name__],
+                              'patient__family_name', 'patient__first_name'),
+        }
+        users = User.objects.in_bulk(
+            set(e.user_id for e in events if e.user_id is not None))
+        for event in events:
+            name = names.get(event.clazz, {}).get(event.reference)
+            # The referenced object could have been deleted
+            event.resolved_patient_name = "%s %s" % name if name else ""
+            if event.user_id in users:
+                event.user = users[event.user_id]
+        return super(OfficeEventListSerializer,
+                     self).to_representation(events)
+
+
 class OfficeEventSerializer(WithPkMixin, serializers.ModelSerializer):
     class Meta:
         model = OfficeEvent
         fields = '__all__'
+        list_serializer_class = OfficeEventListSerializer
 
     patient_name = serializers.SerializerMethodField()
     translated_comment = serializers.SerializerMethodField()
     therapeut_name = UserInfoSerializer(source='user')
 
     def get_patient_name(self, obj):
+        if hasattr(obj, 'resolved_patient_name'):
+            return obj.resolved_patient_name
         if (obj.clazz == "Patient"):
-            patient = Patient.objects.get(id=obj.reference)
-            return "%s %s" % (patient.family_name, patient.first_name)
+            try:
+                patient = Patient.objects.get(id=obj.reference)
+                return "%s %s" % (patient.family_name, patient.first_name)
+            except ObjectDoesNotExist:
+                pass
         if (obj.clazz == "Examination"):
             try:
                 examination = Examination.objects.get(id=obj.reference)
@@ -334,13 +472,87 @@ class FileImportSerializer(WithPkMixin, serializers.ModelSerializer):
 
     analyze = serializers.SerializerMethodField()
     extract = serializers.SerializerMethodField()
+    checkpoint = serializers.SerializerMethodField()
 
     def get_analyze(self, obj):
         if obj.analyze is not None:
             return obj.analyze
 
     def get_extract(self, obj):
-        return Extractor().extract(obj)
+        if not obj.extract:
+            # Imports uploaded before the extract was saved
+            obj.extract = json.dumps(Extractor().extract(obj))
+            if obj.pk is not None:
+                FileImport.objects.filter(pk=obj.pk).update(
+                    extract=obj.extract)
+        return json.loads(obj.extract)
+
+    def get_checkpoint(self, obj):
+        """ Progress of the integration by file, without the errors """
+        return dict((name, {
+            'line': state.get('line', 1),
+            'imported': state.get('imported', 0),
+            'nb_error': state.get('nb_error', 0),
+            'done': state.get('done', False),
+        }) for (name, state) in obj.get_checkpoint().items())
+
+    def validate_encoding(self, value):
+        if (self.instance is not None and self.instance.checkpoint
+                and value != self.instance.encoding):
+            # The integration continues after the lines already read
+            raise serializers.ValidationError(
+                _('The encoding cannot change once the integration started'))
+        if value:
+            try:
+                codecs.lookup(value)
+            except LookupError:
+                raise serializers.ValidationError(_('Unknown encoding'))
+            if not is_supported_encoding(value):
+                raise serializers.ValidationError(
+                    _('Unsupported encoding'))
+        return value
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    """
+    The progress of an import job : the rate is in rows by second, without
+    the rows integrated before a resumed job, and the eta is the estimated
+    number of seconds left.
+    """
+    status_name = serializers.SerializerMethodField()
+    rate = serializers.SerializerMethodField()
+    eta = serializers.SerializerMethodField()
+    result = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'file_import', 'user', 'status', 'status_name',
+                  'cancel_requested', 'creation_date', 'start_date',
+                  'end_date', 'nb_row_total', 'nb_row_done', 'nb_row_start',
+                  'nb_error', 'rate', 'eta', 'result')
+        read_only_fields = fields
+
+    def get_status_name(self, obj):
+        return ImportJobStatus.dictReverse[obj.status]
+
+    def get_rate(self, obj):
+        if obj.start_date is None:
+            return None
+        end = obj.end_date or timezone.now()
+        elapsed = (end - obj.start_date).total_seconds()
+        if elapsed <= 0:
+            return None
+        return round((obj.nb_row_done - obj.nb_row_start) / elapsed, 1)
+
+    def get_eta(self, obj):
+        rate = self.get_rate(obj)
+        if obj.is_finished() or not rate:
+            return None
+        return int(max(obj.nb_row_total - obj.nb_row_done, 0) / rate)
+
+    def get_result(self, obj):
+        if obj.result:
+            return json.loads(obj.result)
 
 
 class DocumentSerializer(WithPkMixin, serializers.ModelSerializer):
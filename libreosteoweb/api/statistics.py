@@ -13,16 +13,59 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
-from libreosteoweb.models import Patient, Examination
+from libreosteoweb.models import (DailyStatistics, Examination,
+                                  ExaminationStatus, ExaminationType, Invoice,
+                                  InvoiceStatus, Paiment, Patient)
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, IntegerField, Q, Sum, Value, When
+from django.utils import timezone
+from collections import defaultdict, OrderedDict
 from datetime import date, timedelta
 import datetime
 import copy
+import threading
+import uuid
+
+HISTORY_SIZE = 11
+SERIES = ['nb_new_patient', 'nb_examination', 'nb_urgent_return']
+# Columns of the daily rollup
+ROLLUP_SERIES = ('nb_new_patient', 'nb_examination', 'nb_normal_examination',
+                 'nb_continuing_examination', 'nb_return', 'nb_emergency',
+                 'nb_unpaid', 'invoiced_amount')
+# Statistics series and the rollup column they are summed from
+SERIES_COLUMNS = (('nb_new_patient', 'nb_new_patient'),
+                  ('nb_examination', 'nb_examination'),
+                  ('nb_urgent_return', 'nb_return'),
+                  ('nb_non_paid', 'nb_unpaid'))
+STATISTICS_CACHE_KEY = 'libreosteoweb.statistics'
+# Changed on each invalidation, a computation started before an invalidation
+# is stored under a key which is not read anymore
+STATISTICS_VERSION_KEY = 'libreosteoweb.statistics.version'
+GRANULARITIES = ('day', 'week', 'month', 'quarter', 'year')
+REVENUE_SERIES = ('invoiced', 'credit_notes', 'paid', 'outstanding')
+# Paiment mode of the invoices waiting for their paiment when issued
+NOT_PAID = 'notpaid'
+# Bounds the number of parameters of a query (999 on SQLite)
+PERIODS_BY_QUERY = 200
+# Bounds the length of the series
+MAX_PERIODS = 5000
+EXAMINATION_TYPE_COLUMNS = {
+    ExaminationType.NORMAL: 'nb_normal_examination',
+    ExaminationType.CONTINUING: 'nb_continuing_examination',
+    ExaminationType.RETURN: 'nb_return',
+    ExaminationType.EMERGENCY: 'nb_emergency',
+}
+
 
 class Statistics(object):
     def __init__(self, *args, **kwargs):
         # Initialize variable that it should be needed
         self.sub_classes_period = dict(week=WeekPeriod,month=MonthPeriod,year=YearPeriod)
         self.subclass = None
+        self.history_size = kwargs.get('history_size', HISTORY_SIZE)
 
     def define_period_subclass(self, selector=None):
         if selector is None :
@@ -52,39 +95,57 @@ class Statistics(object):
         stats_obj['nb_urgent_return'] = Examination.objects.filter(date__gte = start_date, date__lte=end_date, type = 3).count()
         return stats_obj
 
-    def get_history_statistics(self):
-
-        end_date = date.today()
-        obj_statistics = {
-            'nb_new_patient':0,
-            'nb_urgent_return':0,
-            'nb_non_paid':0,
-            'nb_examination':0
-        }
-        history_statistics = { 
-                'nb_new_patient' : [[],[]],
-                'nb_examination' : [[],[]],
-                'nb_urgent_return': [[],[]]
-                }
+    def get_periods(self, end_date=None):
+        """
+        Give the (start, end) dates of the periods of the history, from
+        the most recent one
+        """
+        if end_date is None:
+            end_date = date.today()
         period = self.subclass()
-        for i in range(1,12) :
+        periods = []
+        for i in range(self.history_size):
             start_of_the_period = period.get_start_of_period(end_date)
-            self.get_statistics(end_date, obj_statistics)
-            history_statistics['nb_new_patient'][0].append("%s - %s" % (start_of_the_period, end_date))
-            history_statistics['nb_new_patient'][1].append(obj_statistics['nb_new_patient'])
-            history_statistics['nb_examination'][0].append("%s - %s" % (start_of_the_period, end_date))
-            history_statistics['nb_examination'][1].append(obj_statistics['nb_examination'])
-            history_statistics['nb_urgent_return'][0].append("%s - %s" % (start_of_the_period, end_date))
-            history_statistics['nb_urgent_return'][1].append(obj_statistics['nb_urgent_return'])
+            periods.append((start_of_the_period, end_date))
             end_date = start_of_the_period - timedelta(days=period.get_timedelta_of_period())
+        return periods
+
+    def get_daily_statistics(self, start, end):
+        """ Rows of the daily rollup between the start and the end days """
+        return list(DailyStatistics.objects.filter(
+            day__gte=start, day__lte=end).values_list('day', *ROLLUP_SERIES))
 
-        history_statistics['nb_new_patient'][0]= history_statistics['nb_new_patient'][0][::-1]
-        history_statistics['nb_new_patient'][1]= history_statistics['nb_new_patient'][1][::-1]
-        history_statistics['nb_examination'][0]= history_statistics['nb_examination'][0][::-1]
-        history_statistics['nb_examination'][1]= history_statistics['nb_examination'][1][::-1]
-        history_statistics['nb_urgent_return'][0]= history_statistics['nb_urgent_return'][0][::-1]
-        history_statistics['nb_urgent_return'][1]= history_statistics['nb_urgent_return'][1][::-1]
-        return history_statistics
+    def count_periods(self, periods, rows=None):
+        """
+        Sum the daily rollup on the periods, so that the cost only depends
+        on the number of days shown.
+        Return a list of values for each series, in the periods order.
+        """
+        values = dict((serie, [0] * len(periods)) for serie in SERIES)
+        values['nb_non_paid'] = [0] * len(periods)
+        if not periods:
+            return values
+        if rows is None:
+            rows = self.get_daily_statistics(min(p[0] for p in periods),
+                                             max(p[1] for p in periods))
+        for row in rows:
+            day = row[0]
+            counts = dict(zip(ROLLUP_SERIES, row[1:]))
+            for (idx, (start, end)) in enumerate(periods):
+                if start <= day <= end:
+                    for (serie, column) in SERIES_COLUMNS:
+                        values[serie][idx] += counts[column]
+                    break
+        return values
+
+    def get_history_statistics(self, periods=None, values=None):
+        if periods is None:
+            periods = self.get_periods()
+        if values is None:
+            values = self.count_periods(periods)
+        labels = ["%s - %s" % (start, end) for (start, end) in periods][::-1]
+        return dict((serie, [list(labels), values[serie][::-1]])
+                    for serie in SERIES)
 
     def compute(self):
         # Do some computation there
@@ -97,11 +158,23 @@ class Statistics(object):
                     'year': None
                   }
                 }
+        all_periods = OrderedDict()
         for period in ['week', 'month', 'year']:
-            # Compute on the period
             self.define_period_subclass(period)
-            result[period] = self.get_statistics()
-            result['history'][period] = self.get_history_statistics()
+            all_periods[period] = self.get_periods()
+        # The rollup is read once for the three granularities
+        days = [day for periods in all_periods.values()
+                for p in periods for day in p]
+        rows = self.get_daily_statistics(min(days), max(days))
+        for (period, periods) in all_periods.items():
+            # Compute on the period, the current period is the most recent
+            # one of the history
+            values = self.count_periods(periods, rows)
+            result['history'][period] = self.get_history_statistics(
+                periods, values)
+            result[period] = {'nb_non_paid': values['nb_non_paid'][0]}
+            for serie in SERIES:
+                result[period][serie] = values[serie][0]
         return result
 
 
@@ -147,3 +220,429 @@ class YearPeriod(object):
     def get_timedelta_of_period(self):
         #1 day from the start of the year to backward to last day of the previous year
         return 1
+
+
+def get_period_start(day, granularity):
+    """ First day of the period of the granularity containing the day """
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    if granularity == 'quarter':
+        return day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+    if granularity == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def get_next_period_start(start, granularity):
+    """
+    First day of the period following the one starting at start, None
+    when it is after the last day of the calendar
+    """
+    if granularity in ('day', 'week'):
+        days = 1 if granularity == 'day' else 7
+        if (date.max - start).days < days:
+            return None
+        return start + timedelta(days=days)
+    months = {'month': 1, 'quarter': 3, 'year': 12}[granularity]
+    month = start.month - 1 + months
+    if start.year + month // 12 > date.max.year:
+        return None
+    return start.replace(year=start.year + month // 12, month=month % 12 + 1,
+                         day=1)
+
+
+def get_period_index(day, granularity):
+    """ Number of the period of the granularity containing the day """
+    if granularity == 'day':
+        return day.toordinal()
+    if granularity == 'week':
+        # The first day of the calendar is a monday
+        return (day.toordinal() - 1) // 7
+    months = {'month': 1, 'quarter': 3, 'year': 12}[granularity]
+    return (day.year * 12 + day.month - 1) // months
+
+
+class SeriesStatistics(object):
+    """
+    Dense series of the rollup columns by period of the granularity, from
+    the start to the end days, for the whole office or some therapeuts.
+    The rollup is read with one query whatever the number of periods.
+    """
+    def __init__(self, start, end, granularity='month', therapeuts=None,
+                 by_therapeut=False):
+        self.start = start
+        self.end = end
+        self.granularity = granularity
+        self.therapeuts = therapeuts
+        self.by_therapeut = by_therapeut
+
+    def get_period_count(self):
+        """ Number of periods of the range, without building them """
+        return (get_period_index(self.end, self.granularity) -
+                get_period_index(self.start, self.granularity) + 1)
+
+    def get_periods(self):
+        """ (start, end) days of the periods, bounded by the range """
+        periods = []
+        period_start = get_period_start(self.start, self.granularity)
+        while period_start is not None and period_start <= self.end:
+            next_start = get_next_period_start(period_start, self.granularity)
+            period_end = self.end
+            if next_start is not None:
+                period_end = min(next_start - timedelta(days=1), self.end)
+            periods.append((max(period_start, self.start), period_end))
+            period_start = next_start
+        return periods
+
+    def get_rows(self):
+        rows = DailyStatistics.objects.filter(day__gte=self.start,
+                                              day__lte=self.end)
+        if self.therapeuts:
+            rows = rows.filter(therapeut__in=self.therapeuts)
+        return rows.values_list('day', 'therapeut', *ROLLUP_SERIES)
+
+    def compute(self):
+        periods = self.get_periods()
+        index = dict((get_period_start(start, self.granularity), idx)
+                     for (idx, (start, end)) in enumerate(periods))
+
+        def new_series():
+            return OrderedDict(
+                (column, [0] * len(periods)) for column in ROLLUP_SERIES)
+
+        series = new_series()
+        by_therapeut = defaultdict(new_series)
+        for row in self.get_rows():
+            idx = index[get_period_start(row[0], self.granularity)]
+            for (column, value) in zip(ROLLUP_SERIES, row[2:]):
+                series[column][idx] += value
+                if self.by_therapeut:
+                    by_therapeut[row[1]][column][idx] += value
+        result = OrderedDict([
+            ('from', self.start),
+            ('to', self.end),
+            ('granularity', self.granularity),
+            ('periods', [OrderedDict([('start', start), ('end', end)])
+                         for (start, end) in periods]),
+            ('series', _round_amounts(series)),
+        ])
+        if self.by_therapeut:
+            # The asked therapeuts have a series even without activity
+            for therapeut in self.therapeuts or []:
+                by_therapeut.setdefault(therapeut, new_series())
+            # The new patients are not attributed to a therapeut
+            result['therapeuts'] = [
+                OrderedDict([
+                    ('therapeut', therapeut),
+                    ('series', _round_amounts(by_therapeut[therapeut])),
+                ])
+                for therapeut in sorted(by_therapeut,
+                                        key=lambda t: (t is None, t))
+            ]
+        return result
+
+
+class RevenueStatistics(SeriesStatistics):
+    """
+    Revenue series by period of the granularity :
+     - invoiced : amount of the invoices issued
+     - credit_notes : amount of the credit notes issued
+     - paid : amount received, the invoices paid when issued (refunded by
+       their credit notes) and the paiments of the others on their date
+     - outstanding : amount of the invoices issued still waiting for their
+       paiment
+    The paid amounts are also given by paiment mode. The amounts are summed
+    by the database, with one query on the invoices and one on the
+    paiments for up to PERIODS_BY_QUERY periods.
+    """
+
+    def get_amounts(self, periods, first):
+        """
+        Give (period index, therapeut, paiment mode, serie, amount) of
+        the periods
+        """
+        invoices = _filter_days(Invoice.objects.all(), 'date', periods[0][0],
+                                periods[-1][1], True)
+        paiments = _filter_days(Paiment.objects.all(), 'date', periods[0][0],
+                                periods[-1][1])
+        if self.therapeuts:
+            invoices = invoices.filter(therapeut_id__in=self.therapeuts)
+            paiments = paiments.filter(
+                invoice__therapeut_id__in=self.therapeuts)
+        invoices = invoices.annotate(
+            period=_get_period_index('date', periods, first, True)).values(
+                'period', 'therapeut_id', 'type', 'status',
+                'paiment_mode').annotate(total=Sum('amount')).order_by()
+        for row in invoices:
+            # The therapeut is unknown on the invoices before its id was kept
+            therapeut = row['therapeut_id'] or None
+            if row['type'] == 'creditnote':
+                yield (row['period'], therapeut, row['paiment_mode'],
+                       'credit_notes', -row['total'])
+            else:
+                yield (row['period'], therapeut, row['paiment_mode'],
+                       'invoiced', row['total'])
+                if row['status'] == InvoiceStatus.WAITING_FOR_PAIEMENT:
+                    yield (row['period'], therapeut, row['paiment_mode'],
+                           'outstanding', row['total'])
+            if row['paiment_mode'] != NOT_PAID:
+                yield (row['period'], therapeut, row['paiment_mode'], 'paid',
+                       row['total'])
+        paiments = paiments.annotate(
+            period=_get_period_index('date', periods, first)).values(
+                'period', 'paiment_mode', 'invoice__therapeut_id').annotate(
+                    total=Sum('amount')).order_by()
+        for row in paiments:
+            yield (row['period'], row['invoice__therapeut_id'] or None,
+                   row['paiment_mode'], 'paid', row['total'])
+
+    def compute(self):
+        periods = self.get_periods()
+
+        def new_series():
+            return OrderedDict(
+                (serie, [0] * len(periods)) for serie in REVENUE_SERIES)
+
+        series = new_series()
+        by_paiment_mode = defaultdict(lambda: [0] * len(periods))
+        by_therapeut = defaultdict(new_series)
+        for first in range(0, len(periods), PERIODS_BY_QUERY):
+            chunk = periods[first:first + PERIODS_BY_QUERY]
+            for (idx, therapeut, mode, serie,
+                 amount) in self.get_amounts(chunk, first):
+                series[serie][idx] += amount or 0
+                if serie == 'paid':
+                    by_paiment_mode[mode][idx] += amount or 0
+                if self.by_therapeut:
+                    by_therapeut[therapeut][serie][idx] += amount or 0
+        result = OrderedDict([
+            ('from', self.start),
+            ('to', self.end),
+            ('granularity', self.granularity),
+            ('periods', [OrderedDict([('start', start), ('end', end)])
+                         for (start, end) in periods]),
+            ('series', _round_amounts(series, REVENUE_SERIES)),
+            ('by_paiment_mode', OrderedDict(
+                (mode, [round(amount, 2) for amount in values])
+                for (mode, values) in sorted(by_paiment_mode.items()))),
+        ])
+        if self.by_therapeut:
+            for therapeut in self.therapeuts or []:
+                by_therapeut.setdefault(therapeut, new_series())
+            result['therapeuts'] = [
+                OrderedDict([
+                    ('therapeut', therapeut),
+                    ('series', _round_amounts(by_therapeut[therapeut],
+                                              REVENUE_SERIES)),
+                ])
+                for therapeut in sorted(by_therapeut,
+                                        key=lambda t: (t is None, t))
+            ]
+        return result
+
+
+def _round_amounts(series, columns=('invoiced_amount', )):
+    for column in columns:
+        series[column] = [round(amount, 2) for amount in series[column]]
+    return series
+
+
+def get_day(value):
+    """ Day of a date or of a datetime in the current timezone """
+    if isinstance(value, datetime.datetime):
+        if timezone.is_aware(value):
+            value = timezone.localtime(value)
+        return value.date()
+    return value
+
+
+def _get_day_lookups(field, start, end, is_datetime=False):
+    """ Lookups of the field values between the start and the end days """
+    if is_datetime:
+        # Bounds on the days of the current timezone
+        if start is not None:
+            start = datetime.datetime.combine(start, datetime.time.min)
+        if end is not None:
+            end = datetime.datetime.combine(end + timedelta(days=1),
+                                            datetime.time.min)
+        if settings.USE_TZ:
+            start = start and timezone.make_aware(start)
+            end = end and timezone.make_aware(end)
+    lookups = {}
+    if start is not None:
+        lookups['%s__gte' % field] = start
+    if end is not None:
+        lookup = '%s__lt' if is_datetime else '%s__lte'
+        lookups[lookup % field] = end
+    return lookups
+
+
+def _filter_days(queryset, field, start, end, is_datetime=False):
+    return queryset.filter(**_get_day_lookups(field, start, end, is_datetime))
+
+
+def _get_period_index(field, periods, first=0, is_datetime=False):
+    """ Expression giving the index of the period of the field value """
+    whens = [
+        When(then=Value(first + idx),
+             **_get_day_lookups(field, start, end, is_datetime))
+        for (idx, (start, end)) in enumerate(periods)
+    ]
+    return Case(*whens, output_field=IntegerField())
+
+
+def compute_daily_statistics(start=None,
+                             end=None,
+                             apps=global_apps,
+                             therapeuts=None):
+    """
+    Compute the daily rollup from the patients, examinations and invoices
+    between the start and the end days (included), all the days when None.
+    With therapeuts, only the rows of these therapeut ids are computed,
+    None being the row of the new patients and of the activity without a
+    known therapeut.
+    Return a dict of the rollup columns by (day, therapeut id), only for
+    the days with an activity.
+    """
+    (known, scope) = _get_therapeuts(therapeuts, apps)
+    return _compute_daily_statistics(start, end, apps, known, scope)
+
+
+def _get_therapeuts(therapeuts, apps):
+    """
+    Give the ids of the known therapeuts and the therapeuts of the rows to
+    compute, None for all of them : the invoices keep the id of a
+    therapeut which may not exist anymore, counted without therapeut.
+    """
+    users = apps.get_model(settings.AUTH_USER_MODEL).objects.values_list(
+        'pk', flat=True)
+    if therapeuts is None:
+        return (set(users), None)
+    known = set(users.filter(pk__in=[t for t in therapeuts if t]))
+    return (known, set(t if t in known else None for t in therapeuts))
+
+
+def _get_therapeut_filter(field, scope):
+    """ Lookup of the rows of the therapeuts of the scope """
+    lookup = Q(**{'%s__in' % field: [t for t in scope if t is not None]})
+    if None in scope:
+        lookup |= Q(**{'%s__isnull' % field: True})
+    return lookup
+
+
+def _compute_daily_statistics(start, end, apps, known, scope):
+    rows = defaultdict(lambda: dict((column, 0) for column in ROLLUP_SERIES))
+    if scope is None or None in scope:
+        patients = _filter_days(
+            apps.get_model('libreosteoweb', 'Patient').objects.all(),
+            'creation_date', start, end)
+        for creation_date in patients.values_list('creation_date',
+                                                  flat=True).iterator():
+            if creation_date is not None:
+                rows[(creation_date, None)]['nb_new_patient'] += 1
+    examinations = _filter_days(
+        apps.get_model('libreosteoweb', 'Examination').objects.all(), 'date',
+        start, end, True)
+    if scope is not None:
+        examinations = examinations.filter(
+            _get_therapeut_filter('therapeut', scope))
+    for (value, therapeut, type, status) in examinations.values_list(
+            'date', 'therapeut', 'type', 'status').iterator():
+        counts = rows[(get_day(value), therapeut)]
+        counts['nb_examination'] += 1
+        if type in EXAMINATION_TYPE_COLUMNS:
+            counts[EXAMINATION_TYPE_COLUMNS[type]] += 1
+        if status == ExaminationStatus.WAITING_FOR_PAIEMENT:
+            counts['nb_unpaid'] += 1
+    # Credit notes have a negative amount
+    invoices = _filter_days(
+        apps.get_model('libreosteoweb', 'Invoice').objects.all(), 'date',
+        start, end, True)
+    if scope is not None:
+        lookup = Q(therapeut_id__in=known)
+        if None in scope:
+            lookup |= ~Q(therapeut_id__in=apps.get_model(
+                settings.AUTH_USER_MODEL).objects.values('pk'))
+        invoices = invoices.filter(lookup)
+    for (value, therapeut, amount) in invoices.values_list(
+            'date', 'therapeut_id', 'amount').iterator():
+        therapeut = therapeut if therapeut in known else None
+        rows[(get_day(value), therapeut)]['invoiced_amount'] += amount or 0
+    return rows
+
+
+def rebuild_daily_statistics(start=None,
+                             end=None,
+                             apps=global_apps,
+                             therapeuts=None):
+    """
+    Replace the daily rollup between the start and the end days (included),
+    or the whole rollup when they are None, for the given therapeut ids or
+    all of them (see compute_daily_statistics).
+    The cached statistics are invalidated once the rollup is committed.
+    Return the number of days with an activity.
+    """
+    model = apps.get_model('libreosteoweb', 'DailyStatistics')
+    (known, scope) = _get_therapeuts(therapeuts, apps)
+    rows = _compute_daily_statistics(start, end, apps, known, scope)
+    with transaction.atomic():
+        previous = _filter_days(model.objects.all(), 'day', start, end)
+        if scope is not None:
+            previous = previous.filter(
+                _get_therapeut_filter('therapeut', scope))
+        previous.delete()
+        model.objects.bulk_create([
+            model(day=day, therapeut_id=therapeut, **counts)
+            for ((day, therapeut), counts) in sorted(
+                rows.items(), key=lambda item: (item[0][0], item[0][1] or 0))
+        ], batch_size=500)
+    # Invalidating before the commit would let a concurrent computation
+    # cache the previous rollup under the new version
+    transaction.on_commit(invalidate_statistics)
+    return len(set(day for (day, therapeut) in rows))
+
+
+def refresh_daily_statistics(values, therapeuts=None):
+    """
+    Update the rollup of the days of the given dates or datetimes, only
+    for the given therapeut ids when not None
+    """
+    for day in set(get_day(value) for value in values if value is not None):
+        rebuild_daily_statistics(day, day, therapeuts=therapeuts)
+
+
+_compute_lock = threading.Lock()
+
+
+def _get_statistics_key():
+    version = cache.get(STATISTICS_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(STATISTICS_VERSION_KEY, version, None)
+        version = cache.get(STATISTICS_VERSION_KEY, version)
+    # The periods change with the day
+    return '%s.%s.%s' % (STATISTICS_CACHE_KEY, version, date.today())
+
+
+def get_cached_statistics():
+    """
+    Give the statistics of the dashboard from the cache, they are computed
+    by only one thread at a time when missing, the others wait for them.
+    The changes of the rollup invalidate them once committed.
+    """
+    key = _get_statistics_key()
+    result = cache.get(key)
+    if result is None:
+        with _compute_lock:
+            result = cache.get(key)
+            if result is None:
+                result = Statistics().compute()
+                cache.set(key, result,
+                          getattr(settings, 'STATISTICS_CACHE_TIMEOUT', 300))
+    return result
+
+
+def invalidate_statistics():
+    cache.set(STATISTICS_VERSION_KEY, uuid.uuid4().hex, None)
@@ -20,8 +20,10 @@ if sys.version_info.major == 2:
     from io import BytesIO as StringIO
 else :
     from io import BytesIO,StringIO
+from collections import OrderedDict
 from datetime import datetime
 from django.utils import timezone
+import json
 import logging
 import os
 import tempfile
@@ -54,25 +56,30 @@ from django.utils.translation import ugettext_lazy as _
 from django.views import View
 from django.views.decorators.cache import never_cache
 from django.views.generic.base import TemplateView
-from django.db.models import Max
+from django.db.models import Count, Max, Sum
 
 from libreosteoweb.api import serializers as apiserializers
 from libreosteoweb import models
 from .exceptions import Forbidden
+from .fieldsets import SparseFieldsetMixin
+from .pagination import DateKeysetPagination, NameKeysetPagination
 from .permissions import StaffRequiredMixin
 from .permissions import (
     IsStaffOrTargetUser, IsStaffOrReadOnlyTargetUser, maintenance_available,
     IsStaffOrTargetUserFactory)
 from .receivers import (
-    block_disconnect_all_signal, receiver_examination, temp_disconnect_signal,
-    receiver_newpatient)
+    block_disconnect_all_signal, receiver_examination, receiver_newpatient)
 from .renderers import (
     ExaminationCSVRenderer, InvoiceCSVRenderer,
     PatientCSVRenderer)
-from .statistics import Statistics
-from .file_integrator import Extractor, IntegratorHandler
+from .statistics import (
+    RevenueStatistics, SeriesStatistics, get_cached_statistics,
+    rebuild_daily_statistics)
+from .file_integrator import Extractor
+from .import_jobs import cancel_import_job, start_import_job
 from .utils import convert_to_long
 from libreosteoweb.api.invoicing import generator as invoicing_generator
+from libreosteoweb.api.invoicing.paiment_means import paiment_means
 from libreosteoweb.api.events.settings import settings_event_tracer
 
 # Get an instance of a logger
@@ -167,22 +174,23 @@ class InvoiceViewHtml(TemplateView):
         context['invoice'] = models.Invoice.objects.get(pk=kwargs['invoiceid'])
         if context['invoice'].paiment_mode != 'notpaid':
             context['paiment_mean'] = _(
-                models.PaimentMean.objects.get(
-                    code=context['invoice'].paiment_mode).text).lower()
+                paiment_means.get_text(
+                    context['invoice'].paiment_mode,
+                    context['invoice'].paiment_mode)).lower()
         else:
             context['paiment_mean'] = _('Not paid')
         context['paiments'] = [p for p in context['invoice'].paiment_set.all()]
         for p in context['paiments']:
-            p.paiment_mode = _(
-                models.PaimentMean.objects.get(
-                    code=p.paiment_mode).text).lower()
+            p.paiment_mode = _(paiment_means.get_text(
+                p.paiment_mode, p.paiment_mode)).lower()
         return context
 
 
-class PatientViewSet(viewsets.ModelViewSet):
+class PatientViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.Patient
     serializer_class = apiserializers.PatientSerializer
     queryset = models.Patient.objects.all()
+    pagination_class = NameKeysetPagination
     renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [
         PatientCSVRenderer,
     ]
@@ -191,7 +199,8 @@ class PatientViewSet(viewsets.ModelViewSet):
     def examinations(self, request, pk=None):
         current_patient = self.get_object()
         examinations = models.Examination.objects.filter(
-            patient=current_patient).order_by('-date')
+            patient=current_patient).select_related('therapeut').annotate(
+                nb_comments=Count('examinationcomment')).order_by('-date')
         return Response(
             apiserializers.ExaminationExtractSerializer(examinations,
                                                         many=True).data)
@@ -225,20 +234,52 @@ class PatientViewSet(viewsets.ModelViewSet):
         return super(PatientViewSet, self).perform_destroy(instance)
 
 
-class RegularDoctorViewSet(viewsets.ModelViewSet):
+class RegularDoctorViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.RegularDoctor
     queryset = models.RegularDoctor.objects.all()
     serializer_class = apiserializers.RegularDoctorSerializer
+    pagination_class = NameKeysetPagination
 
 
 
-class ExaminationViewSet(viewsets.ModelViewSet):
+class ExaminationViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.Examination
     queryset = models.Examination.objects.all()
     serializer_class = apiserializers.ExaminationSerializer
+    pagination_class = DateKeysetPagination
     renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [
         ExaminationCSVRenderer,
     ]
+    summary_actions = ('list', 'unpaid')
+    # Columns needed by the ExaminationUnpaidSerializer
+    unpaid_columns = ('date', 'reason', 'status', 'type', 'patient__id',
+                      'patient__family_name', 'patient__first_name',
+                      'patient__original_name', 'patient__birth_date',
+                      'patient__sex', 'therapeut__id', 'therapeut__username',
+                      'therapeut__email', 'therapeut__first_name',
+                      'therapeut__last_name')
+
+    def is_summary(self):
+        """
+        The lists give a summary without the anatomical findings, the full
+        examination is given on retrieve or via ?representation=full
+        """
+        representation = self.request.query_params.get('representation')
+        if representation is not None and self.request.method == 'GET':
+            return representation == 'summary'
+        return self.action in self.summary_actions
+
+    def get_serializer_class(self):
+        if self.is_summary():
+            return apiserializers.ExaminationSummarySerializer
+        return apiserializers.ExaminationSerializer
+
+    def get_queryset(self):
+        queryset = super(ExaminationViewSet, self).get_queryset()
+        if self.is_summary():
+            queryset = queryset.defer(
+                *models.Examination.FINDINGS_FIELDS)
+        return queryset
 
     @action(detail=True, methods=['post'])
     def invoice(self, request, pk=None):
@@ -264,10 +305,8 @@ class ExaminationViewSet(viewsets.ModelViewSet):
                     current_invoice.status = models.InvoiceStatus.WAITING_FOR_PAIEMENT
                     current_invoice.save()
                     current_examination.save()
-                if invoicing_serializer.data['paiment_mode'] in [
-                        p.code
-                        for p in models.PaimentMean.objects.filter(enable=True)
-                ]:
+                if invoicing_serializer.data[
+                        'paiment_mode'] in paiment_means.get_enabled_codes():
                     current_examination.status = models.ExaminationStatus.INVOICED_PAID
                     current_invoice.status = models.InvoiceStatus.INVOICED_PAID
                     current_invoice.save()
@@ -360,22 +399,60 @@ class ExaminationViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'])
     def unpaid(self, request, pk=None):
+        """
+        The pagination is opt-in with the cursor or page_size parameter :
+        the page of the reconciliation gives the count of the unpaid
+        examinations and the amount due, else the whole list is returned.
+        """
+        paginator = DateKeysetPagination()
+        if not paginator.is_requested(request):
+            unpaid_examinations = self.get_queryset().filter(
+                status=models.ExaminationStatus.WAITING_FOR_PAIEMENT
+            ).order_by('-date')
+            return Response(
+                self.get_serializer(unpaid_examinations, many=True).data)
         unpaid_examinations = models.Examination.objects.filter(
-            status=models.ExaminationStatus.WAITING_FOR_PAIEMENT).order_by(
-                '-date')
+            status=models.ExaminationStatus.WAITING_FOR_PAIEMENT
+        ).select_related('patient', 'therapeut').only(*self.unpaid_columns)
+        page = paginator.paginate_queryset(unpaid_examinations, request,
+                                           view=self)
+        serializer = apiserializers.ExaminationUnpaidSerializer(page,
+                                                                many=True)
         return Response(
-            apiserializers.ExaminationSerializer(unpaid_examinations,
-                                                 many=True).data)
-
-
-class UserViewSet(viewsets.ModelViewSet):
+            OrderedDict([
+                ('count', unpaid_examinations.count()),
+                ('amount_due', self.get_amount_due()),
+                ('next', paginator.get_next_link()),
+                ('results', serializer.data),
+            ]))
+
+    def get_amount_due(self):
+        """
+        Amount of the invoices of the unpaid examinations, less the
+        paiments already received for them
+        """
+        invoices = models.Invoice.objects.filter(
+            status=models.InvoiceStatus.WAITING_FOR_PAIEMENT,
+            examination__status=models.ExaminationStatus.WAITING_FOR_PAIEMENT
+        ).values('pk')
+        # A paiment or an invoice is summed once, whatever its links
+        invoiced = models.Invoice.objects.filter(pk__in=invoices).aggregate(
+            amount=Sum('amount'))['amount'] or 0
+        paiments = models.Paiment.objects.filter(invoice__in=invoices)
+        paid = models.Paiment.objects.filter(
+            pk__in=paiments.values('pk')).aggregate(
+                amount=Sum('amount'))['amount'] or 0
+        return round(invoiced - paid, 2)
+
+
+class UserViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = User
     serializer_class = apiserializers.UserInfoSerializer
     permission_classes = [IsStaffOrTargetUser]
     queryset = User.objects.all()
 
 
-class UserOfficeViewSet(viewsets.ModelViewSet):
+class UserOfficeViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = apiserializers.UserOfficeSerializer
     permission_classes = [IsStaffOrReadOnlyTargetUser]
@@ -397,29 +474,49 @@ class UserOfficeViewSet(viewsets.ModelViewSet):
 class StatisticsView(APIView):
 
     def get(self, request, *args, **kwargs):
-        myStats = Statistics(*args, **kwargs)
-        result = myStats.compute()
+        result = get_cached_statistics()
         response = Response(result, status=status.HTTP_200_OK)
         return response
 
 
-class InvoiceViewSet(viewsets.ReadOnlyModelViewSet):
+class StatisticsSeriesView(APIView):
+    """
+    Series of the activity by period between the from and to days
+    (YYYY-MM-DD), with a granularity among day, week, month, quarter and
+    year. The therapeut parameters restrict them to some therapeuts and
+    by_therapeut adds the series of each therapeut.
+    """
+
+    statistics_class = SeriesStatistics
+
+    def get(self, request, *args, **kwargs):
+        serializer = apiserializers.StatisticsSeriesSerializer(
+            data=request.query_params,
+            context={'statistics_class': self.statistics_class})
+        serializer.is_valid(raise_exception=True)
+        result = serializer.validated_data['statistics'].compute()
+        return Response(result, status=status.HTTP_200_OK)
+
+
+class RevenueStatisticsView(StatisticsSeriesView):
+    """
+    Revenue series (invoiced, credit notes, paid and outstanding amounts)
+    by period, with the parameters of the statistics series. The paid
+    amounts are also given by paiment mode.
+    """
+    statistics_class = RevenueStatistics
+
+
+class InvoiceViewSet(SparseFieldsetMixin, viewsets.ReadOnlyModelViewSet):
     model = models.Invoice
     queryset = models.Invoice.objects.all()
     serializer_class = apiserializers.InvoiceSerializer
+    pagination_class = DateKeysetPagination
     filter_fields = {'date': ['lte', 'gte']}
     renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [
         InvoiceCSVRenderer
     ]
 
-    def get_renderer_context(self):
-        # allows to select which fields we want via ?fields=field1,field2
-        # works only for CSV renderer
-        context = super(InvoiceViewSet, self).get_renderer_context()
-        context['header'] = (self.request.GET['fields'].split(',')
-                             if 'fields' in self.request.GET else None)
-        return context
-
     def get_queryset(self):
         queryset = models.Invoice.objects.all()
         therapeut_id = self.request.query_params.get('therapeut_id', None)
@@ -449,7 +546,7 @@ class InvoiceViewSet(viewsets.ReadOnlyModelViewSet):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
-class OfficeEventViewSet(viewsets.ReadOnlyModelViewSet):
+class OfficeEventViewSet(SparseFieldsetMixin, viewsets.ReadOnlyModelViewSet):
     model = models.OfficeEvent
     serializer_class = apiserializers.OfficeEventSerializer
     queryset = models.OfficeEvent.objects.all()
@@ -468,7 +565,7 @@ class OfficeEventViewSet(viewsets.ReadOnlyModelViewSet):
         return queryset
 
 
-class OfficeSettingsView(viewsets.ModelViewSet):
+class OfficeSettingsView(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.OfficeSettings
     serializer_class = apiserializers.OfficeSettingsSerializer
     permission_classes = [IsStaffOrReadOnlyTargetUser]
@@ -501,7 +598,7 @@ class OfficeSettingsView(viewsets.ModelViewSet):
             raise ParseError(detail=e)
 
 
-class TherapeutSettingsViewSet(viewsets.ModelViewSet):
+class TherapeutSettingsViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.TherapeutSettings
     serializer_class = apiserializers.TherapeutSettingsSerializer
     permission_classes = [
@@ -523,7 +620,7 @@ class TherapeutSettingsViewSet(viewsets.ModelViewSet):
         serializer.save(user=serializer.instance.user)
 
 
-class ExaminationCommentViewSet(viewsets.ModelViewSet):
+class ExaminationCommentViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.ExaminationComment
     serializer_class = apiserializers.ExaminationCommentSerializer
     queryset = models.ExaminationComment.objects.all()
@@ -534,7 +631,7 @@ class ExaminationCommentViewSet(viewsets.ModelViewSet):
         serializer.save(user=self.request.user, date=datetime.today())
 
 
-class FileImportViewSet(viewsets.ModelViewSet):
+class FileImportViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.FileImport
     serializer_class = apiserializers.FileImportSerializer
     queryset = models.FileImport.objects.all()
@@ -570,57 +667,57 @@ class FileImportViewSet(viewsets.ModelViewSet):
         else:
             instance.status = 0
         instance.analyze = status
+        # The rows are sampled once, the serializer gives them back
+        instance.extract = json.dumps(extractor.extract(instance))
         instance.save()
 
-    @action(detail=True, methods=['post', 'get'])
+    @action(detail=True, methods=['post'])
     def integrate(self, request, pk=None):
+        """
+        Start the integration of the files in background, the progress
+        is given by the returned import job.
+        """
         file_import_couple = self.get_object()
-        integrator = IntegratorHandler()
-        nb_line_patient = None
-        nb_line_examination = None
-        response = {
-            'patient': {
-                'imported': 0,
-                'errors': []
-            },
-            'examination': {
-                'imported': 0,
-                'errors': []
-            }
-        }
-        with temp_disconnect_signal(signal=signals.post_save,
-                                    receiver=receiver_newpatient,
-                                    sender=models.Patient):
-            if file_import_couple.file_patient:
-                # Start integration of each patient in the file
-                (nb_line_patient, errors_patient) = integrator.integrate(
-                    file_import_couple.file_patient)
-                response['patient'] = {
-                    'imported': nb_line_patient,
-                    'errors': errors_patient
-                }
-        with temp_disconnect_signal(signal=signals.post_save,
-                                    receiver=receiver_examination,
-                                    sender=models.Examination):
-            if file_import_couple.file_examination:
-                # Start integration of each examination in the file
-                (nb_line_examination,
-                 errors_examination) = integrator.integrate(
-                     file_import_couple.file_examination,
-                     file_additional=file_import_couple.file_patient,
-                     user=request.user)
-                response['examination'] = {
-                    'imported': nb_line_examination,
-                    'errors': errors_examination
-                }
-        integrator.post_processing(files=[
-            file_import_couple.file_patient,
-            file_import_couple.file_examination
-        ])
-        return Response(response, status=status.HTTP_200_OK)
-
-
-class DocumentViewSet(viewsets.ModelViewSet):
+        job = models.ImportJob.objects.create(file_import=file_import_couple,
+                                              user=request.user)
+        start_import_job(job)
+        serializer = apiserializers.ImportJobSerializer(
+            job, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+class ImportJobViewSet(viewsets.ReadOnlyModelViewSet):
+    model = models.ImportJob
+    serializer_class = apiserializers.ImportJobSerializer
+    queryset = models.ImportJob.objects.all()
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        job = cancel_import_job(self.get_object())
+        serializer = self.get_serializer(job)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['post'])
+    def resume(self, request, pk=None):
+        """
+        Start a new job integrating the files of a failed or canceled job,
+        from the rows left by this one.
+        """
+        job = self.get_object()
+        if job.status not in (models.ImportJobStatus.FAILED,
+                              models.ImportJobStatus.CANCELED):
+            raise ValidationError(
+                _('Only a failed or canceled import can be resumed.'))
+        if job.file_import is None:
+            raise ValidationError(_('The files to import have been deleted.'))
+        resumed = models.ImportJob.objects.create(file_import=job.file_import,
+                                                  user=request.user)
+        start_import_job(resumed)
+        serializer = self.get_serializer(resumed)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+class DocumentViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.Document
     queryset = models.Document.objects.all()
 
@@ -636,7 +733,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
             return apiserializers.DocumentSerializer
 
 
-class PatientDocumentViewSet(viewsets.ModelViewSet):
+class PatientDocumentViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.PatientDocument
     serializer_class = apiserializers.PatientDocumentSerializer
     filter_fields = ['patient']
@@ -659,7 +756,7 @@ class PatientDocumentViewSet(viewsets.ModelViewSet):
         return apiserializers.PatientDocumentSerializer
 
 
-class PaimentMeanViewSet(viewsets.ModelViewSet):
+class PaimentMeanViewSet(SparseFieldsetMixin, viewsets.ModelViewSet):
     model = models.PaimentMean
     serializer_class = apiserializers.PaimentMeanSerializer
     queryset = models.PaimentMean.objects.all()
@@ -763,6 +860,8 @@ class LoadDump(View):
                     logger.info("Clearing the fixture")
                     os.remove(fixture)
                     settings.FIXTURE_DIRS = previous
+                    # The receivers do not handle the loaded rows
+                    rebuild_daily_statistics()
                     logger.info("Could restore signals")
                 logger.info("end of reloading.")
                 return HttpResponse(content=u'reloaded')
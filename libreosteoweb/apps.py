@@ -16,6 +16,7 @@
 from django.apps import AppConfig
 from sqlite3 import OperationalError
 import logging
+import os
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -26,11 +27,18 @@ class LibreosteoConfig(AppConfig):
 
     def ready(self):
         import libreosteoweb.api.receivers
+        from libreosteoweb.api.import_worker import WORKER_ENVIRONMENT_KEY
+        if os.environ.get(WORKER_ENVIRONMENT_KEY):
+            # The processes validating the imported rows do not maintain
+            # the database
+            return
         import libreosteoweb.models as models
         file_import_list = models.FileImport.objects.all()
         try:
             for f in file_import_list:
-                f.delete()
+                # An interrupted integration can be resumed
+                if not f.is_resumable():
+                    f.delete()
         except Exception:
             logger.debug("Exception when purging files at starting application")
     
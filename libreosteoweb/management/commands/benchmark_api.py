@@ -0,0 +1,147 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Time the main API endpoints and count their queries.
+
+    python manage.py benchmark_api --output before.json
+    python manage.py benchmark_api --output after.json --compare before.json
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+from timeit import default_timer
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from libreosteoweb import models
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the main API endpoints and save the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output',
+                            default=None,
+                            help='JSON file receiving the results')
+        parser.add_argument('--compare',
+                            default=None,
+                            help='JSON file of a previous run to compare to')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--username',
+                            default=None,
+                            help='User of the requests, a superuser if empty')
+
+    def handle(self, *args, **options):
+        client = Client()
+        client.force_login(self.get_user(options['username']))
+        results = OrderedDict()
+        for (name, url) in self.get_endpoints():
+            results[name] = self.benchmark(client, url, options['repeat'])
+            self.stdout.write(
+                "%-22s %8.1f ms %5d queries" %
+                (name, results[name]['median_ms'], results[name]['queries']))
+        report = OrderedDict([
+            ('date', timezone.now().isoformat()),
+            ('database', self.get_database_size()),
+            ('results', results),
+        ])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        if options['compare']:
+            with open(options['compare']) as previous:
+                self.compare(json.load(previous), report)
+
+    def get_user(self, username):
+        users = User.objects.all()
+        if username is None:
+            users = users.filter(is_superuser=True)
+        else:
+            users = users.filter(username=username)
+        user = users.first()
+        if user is None:
+            raise CommandError('No user found to run the requests')
+        return user
+
+    def get_endpoints(self):
+        endpoints = [
+            ('statistics', reverse('statistics_view')),
+            ('events_feed', reverse('officeevent-list') + '?limit=20'),
+            ('invoices_list', reverse('invoice-list') + '?page_size=50'),
+            ('examinations_unpaid', reverse('examination-unpaid')),
+        ]
+        busiest = models.Examination.objects.values('patient').annotate(
+            nb=Count('id')).order_by('-nb').first()
+        if busiest is not None:
+            patient = models.Patient.objects.get(pk=busiest['patient'])
+            examination = models.Examination.objects.filter(
+                patient=patient).order_by('-date').first()
+            endpoints += [
+                ('patient_timeline',
+                 reverse('patient-examinations', kwargs={'pk': patient.pk})),
+                ('examination_detail',
+                 reverse('examination-detail', kwargs={'pk':
+                                                       examination.pk})),
+                ('search',
+                 reverse('search_view') + '?q=%s' % patient.family_name),
+            ]
+        return endpoints
+
+    def get_database_size(self):
+        return OrderedDict(
+            (model.__name__, model.objects.count())
+            for model in (models.Patient, models.Examination, models.Invoice,
+                          models.OfficeEvent, models.Document))
+
+    def benchmark(self, client, url, repeat):
+        # The first request fills the caches, it is not measured
+        client.get(url)
+        timings = []
+        for i in range(max(repeat, 1)):
+            with CaptureQueriesContext(connection) as queries:
+                start = default_timer()
+                response = client.get(url)
+                timings.append((default_timer() - start) * 1000)
+        timings.sort()
+        return OrderedDict([
+            ('url', url),
+            ('status', response.status_code),
+            ('queries', len(queries)),
+            ('min_ms', timings[0]),
+            ('median_ms', timings[len(timings) // 2]),
+            ('max_ms', timings[-1]),
+            ('size', len(response.content)),
+        ])
+
+    def compare(self, previous, current):
+        self.stdout.write("\n%-22s %10s %10s %8s %8s" %
+                          ('endpoint', 'before ms', 'after ms', 'ratio',
+                           'queries'))
+        for (name, result) in current['results'].items():
+            before = previous['results'].get(name)
+            if before is None:
+                continue
+            self.stdout.write(
+                "%-22s %10.1f %10.1f %7.2fx %4d/%-4d" %
+                (name, before['median_ms'], result['median_ms'],
+                 before['median_ms'] / max(result['median_ms'], 0.001),
+                 before['queries'], result['queries']))
@@ -0,0 +1,358 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Build a synthetic practice to reproduce the load of a production office.
+
+    python manage.py generate_practice --patients 20000 --examinations 300000
+
+The rows are inserted with bulk_create, so that no signal is sent : the
+search index has to be rebuilt afterwards with `rebuild_index`. The daily
+statistics are rebuilt at the end of the generation.
+"""
+from __future__ import unicode_literals
+from datetime import date, timedelta
+import random
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from libreosteoweb import models
+from libreosteoweb.api.invoicing.generator import Generator
+from libreosteoweb.api.statistics import rebuild_daily_statistics
+
+FAMILY_NAMES = [
+    'Martin', 'Bernard', 'Thomas', 'Petit', 'Robert', 'Richard', 'Durand',
+    'Dubois', 'Moreau', 'Laurent', 'Simon', 'Michel', 'Lefebvre', 'Leroy',
+    'Roux', 'David', 'Bertrand', 'Morel', 'Fournier', 'Girard', 'Bonnet',
+    'Dupont', 'Lambert', 'Fontaine', 'Rousseau', 'Vincent', 'Muller',
+    'Lefevre', 'Faure', 'Andre', 'Mercier', 'Blanc', 'Guerin', 'Boyer',
+    'Garnier', 'Chevalier', 'Francois', 'Legrand', 'Gauthier', 'Garcia'
+]
+FIRST_NAMES = [
+    'Jean', 'Marie', 'Pierre', 'Nathalie', 'Michel', 'Isabelle', 'Philippe',
+    'Sylvie', 'Alain', 'Catherine', 'Nicolas', 'Sophie', 'Julien', 'Camille',
+    'Lucas', 'Emma', 'Louis', 'Chloe', 'Hugo', 'Lea', 'Jean-Luc', 'Anne-Marie'
+]
+CITIES = [('75001', 'Paris'), ('69001', 'Lyon'), ('13001', 'Marseille'),
+          ('31000', 'Toulouse'), ('33000', 'Bordeaux'), ('44000', 'Nantes')]
+REASONS = [
+    'Lombalgie', 'Cervicalgie', 'Dorsalgie', 'Sciatique', 'Entorse',
+    'Migraine', 'Troubles digestifs', 'Suivi grossesse', 'Torticolis',
+    'Tendinite', 'Suivi nourrisson', 'Douleur epaule'
+]
+FINDINGS = [
+    'Restriction de mobilite', 'Fixation en flexion', 'Fixation en extension',
+    'Tension tissulaire', 'Douleur a la palpation', 'Dysfonction corrigee',
+    'Perte de mobilite', 'RAS'
+]
+PAIMENT_MODES = ['check', 'cash', 'ecard']
+CURRENCY = 'EUR'
+AMOUNT = 55.0
+
+
+class _Request(object):
+    """ Stands for the request of the invoice generator """
+    def __init__(self, user):
+        self.user = user
+
+
+class Command(BaseCommand):
+    help = ('Generate a synthetic practice (patients, examinations, invoices '
+            'with cancel chains, comments, documents and events)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=20000)
+        parser.add_argument('--examinations', type=int, default=300000)
+        parser.add_argument('--therapeuts', type=int, default=3)
+        parser.add_argument('--documents', type=int, default=200)
+        parser.add_argument('--years',
+                            type=int,
+                            default=5,
+                            help='History covered by the practice')
+        parser.add_argument('--cancel-ratio',
+                            type=float,
+                            default=0.02,
+                            help='Ratio of invoices canceled by a credit note')
+        parser.add_argument('--unpaid-ratio',
+                            type=float,
+                            default=0.1,
+                            help='Ratio of invoices not paid when issued')
+        parser.add_argument('--regularized-ratio',
+                            type=float,
+                            default=0.7,
+                            help='Ratio of the unpaid invoices paid later')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.options = options
+        self.now = timezone.now()
+        self.start = self.now - timedelta(days=365 * options['years'])
+        self.office_settings = self.get_office_settings()
+        self.therapeuts = self.get_therapeuts(options['therapeuts'])
+        self.findings_fields = models.Examination.FINDINGS_FIELDS
+
+        patients = self.generate_patients(options['patients'])
+        self.stdout.write("%d patients created" % len(patients))
+        nb_examinations = 0
+        while nb_examinations < options['examinations']:
+            size = min(options['batch_size'],
+                       options['examinations'] - nb_examinations)
+            with transaction.atomic():
+                self.generate_examinations(patients, size)
+            nb_examinations += size
+            self.stdout.write("%d examinations created" % nb_examinations)
+        self.generate_documents(patients, options['documents'])
+        self.office_settings.save()
+        # The rows are created in bulk, without the statistics receivers
+        rebuild_daily_statistics()
+        self.stdout.write(
+            self.style.SUCCESS("Practice generated, run rebuild_index to "
+                               "index the patients"))
+
+    def get_office_settings(self):
+        office_settings = models.OfficeSettings.objects.first()
+        if office_settings is None:
+            office_settings = models.OfficeSettings(office_siret='12345678',
+                                                    currency=CURRENCY,
+                                                    amount=AMOUNT)
+            office_settings.save()
+        return office_settings
+
+    def get_therapeuts(self, number):
+        therapeuts = []
+        for i in range(1, number + 1):
+            user, created = User.objects.get_or_create(
+                username='therapeut%d' % i,
+                defaults={
+                    'first_name': self.random.choice(FIRST_NAMES),
+                    'last_name': self.random.choice(FAMILY_NAMES),
+                })
+            if created:
+                user.set_password('therapeut%d' % i)
+                user.save()
+            settings, _ = models.TherapeutSettings.objects.get_or_create(
+                user=user, defaults={'adeli': '%09d' % user.pk})
+            therapeuts.append((user, Generator(self.office_settings,
+                                               settings)))
+        return therapeuts
+
+    def next_id(self, model):
+        """ The primary keys are given, as bulk_create does not return them
+        on every database """
+        return (model.objects.aggregate(Max('pk'))['pk__max'] or 0) + 1
+
+    def random_date(self, start):
+        delta = (self.now - start).total_seconds()
+        return start + timedelta(seconds=self.random.random() * delta)
+
+    def generate_patients(self, number):
+        patient_id = self.next_id(models.Patient)
+        event_user = self.therapeuts[0][0]
+        patients = []
+        for idx in range(0, number, self.options['batch_size']):
+            batch = []
+            events = []
+            for i in range(idx, min(idx + self.options['batch_size'],
+                                    number)):
+                zipcode, city = self.random.choice(CITIES)
+                created = self.random_date(self.start)
+                patient = models.Patient(
+                    id=patient_id,
+                    family_name=self.random.choice(FAMILY_NAMES),
+                    first_name=self.random.choice(FIRST_NAMES),
+                    birth_date=date(self.random.randint(1930, 2020),
+                                    self.random.randint(1, 12),
+                                    self.random.randint(1, 28)),
+                    sex=self.random.choice(['M', 'F']),
+                    address_street='%d rue de la Paix' %
+                    self.random.randint(1, 200),
+                    address_zipcode=zipcode,
+                    address_city=city,
+                    phone='01%08d' % self.random.randint(0, 99999999),
+                    numSS='%013d' % self.random.randint(0, 10**13 - 1),
+                    medical_history=self.random.choice(REASONS),
+                    creation_date=created.date())
+                patient.created = created
+                batch.append(patient)
+                events.append(
+                    models.OfficeEvent(date=created,
+                                       clazz=models.Patient.__name__,
+                                       type=models.Patient.TYPE_NEW_PATIENT,
+                                       comment='New patient created',
+                                       reference=patient_id,
+                                       user=event_user))
+                patient_id += 1
+            with transaction.atomic():
+                models.Patient.objects.bulk_create(batch)
+                models.OfficeEvent.objects.bulk_create(events)
+            patients.extend(batch)
+        return patients
+
+    def generate_examinations(self, patients, number):
+        examination_id = self.next_id(models.Examination)
+        examinations = []
+        events = []
+        comments = []
+        for i in range(number):
+            patient = self.random.choice(patients)
+            therapeut = self.random.choice(self.therapeuts)[0]
+            examination = models.Examination(
+                id=examination_id,
+                date=self.random_date(patient.created),
+                reason=self.random.choice(REASONS),
+                reason_description=self.random.choice(REASONS),
+                diagnosis=self.random.choice(FINDINGS),
+                treatments=self.random.choice(FINDINGS),
+                status=models.Examination.EXAMINATION_INVOICED_PAID,
+                type=self.random.choice([1] * 14 + [2] * 3 + [3] * 2 + [4]),
+                patient=patient,
+                therapeut=therapeut)
+            for field in self.random.sample(self.findings_fields,
+                                            self.random.randint(5, 40)):
+                setattr(examination, field, self.random.choice(FINDINGS))
+            examinations.append(examination)
+            events.append(
+                models.OfficeEvent(date=examination.date,
+                                   clazz=models.Examination.__name__,
+                                   type=examination.type,
+                                   comment='New examination',
+                                   reference=examination_id,
+                                   user=therapeut))
+            for c in range(self.random.choice([0] * 8 + [1, 2])):
+                comments.append(
+                    models.ExaminationComment(
+                        user=therapeut,
+                        comment=self.random.choice(FINDINGS),
+                        date=examination.date,
+                        examination=examination))
+            examination_id += 1
+        invoices, links, paiments, paiment_links = self.build_invoices(
+            examinations)
+        models.Examination.objects.bulk_create(examinations)
+        models.OfficeEvent.objects.bulk_create(events)
+        models.ExaminationComment.objects.bulk_create(comments)
+        models.Invoice.objects.bulk_create(invoices)
+        models.Examination.invoices.through.objects.bulk_create(links)
+        models.Paiment.objects.bulk_create(paiments)
+        models.Paiment.invoice.through.objects.bulk_create(paiment_links)
+
+    def build_invoices(self, examinations):
+        """ Invoice the examinations, some invoices are canceled by a credit
+        note and issued again, others are not paid when issued : most of
+        them are regularized later by a paiment, as in update_paiement """
+        invoice_id = self.next_id(models.Invoice)
+        paiment_id = self.next_id(models.Paiment)
+        invoices = []
+        links = []
+        paiments = []
+        paiment_links = []
+        generators = dict((user.pk, generator)
+                          for (user, generator) in self.therapeuts)
+
+        def add_invoice(invoice, invoice_date, examination=None):
+            invoice.id = invoice_id + len(invoices)
+            invoice.date = invoice_date
+            invoices.append(invoice)
+            if examination is not None:
+                links.append(
+                    models.Examination.invoices.through(
+                        examination_id=examination.pk,
+                        invoice_id=invoice.id))
+            return invoice
+
+        def add_paiment(invoice, paiment_mode, paiment_date):
+            paiment = models.Paiment(id=paiment_id + len(paiments),
+                                     amount=invoice.amount,
+                                     currency=invoice.currency,
+                                     paiment_mode=paiment_mode,
+                                     date=paiment_date)
+            paiments.append(paiment)
+            paiment_links.append(
+                models.Paiment.invoice.through(paiment_id=paiment.id,
+                                               invoice_id=invoice.id))
+
+        for examination in examinations:
+            if self.random.random() < 0.05:
+                examination.status = models.Examination.EXAMINATION_NOT_INVOICED
+                examination.status_reason = 'Not invoiced'
+                continue
+            generator = generators[examination.therapeut.pk]
+            request = _Request(examination.therapeut)
+            invoice_data = {
+                'amount': AMOUNT,
+                'paiment_mode': self.random.choice(PAIMENT_MODES)
+            }
+            invoice = add_invoice(
+                generator.generate_invoice(examination, invoice_data,
+                                           request), examination.date,
+                examination)
+            if self.random.random() < self.options['cancel_ratio']:
+                cancel_date = min(examination.date + timedelta(days=2),
+                                  self.now)
+                credit_note = add_invoice(generator.cancel_invoice(invoice),
+                                          cancel_date)
+                credit_note.dateExamination = examination.date
+                invoice.status = models.InvoiceStatus.CANCELED
+                invoice.canceled_by = credit_note
+                invoice = add_invoice(
+                    generator.generate_invoice(examination, invoice_data,
+                                               request), cancel_date,
+                    examination)
+            if self.random.random() >= self.options['unpaid_ratio']:
+                invoice.status = models.InvoiceStatus.INVOICED_PAID
+                continue
+            invoice.paiment_mode = 'notpaid'
+            if self.random.random() < self.options['regularized_ratio']:
+                invoice.status = models.InvoiceStatus.INVOICED_PAID
+                paiment_date = min(
+                    invoice.date +
+                    timedelta(days=self.random.randint(1, 60)), self.now)
+                add_paiment(invoice, invoice_data['paiment_mode'],
+                            paiment_date.date())
+            else:
+                examination.status = models.Examination.EXAMINATION_WAITING_FOR_PAIEMENT
+                invoice.status = models.InvoiceStatus.WAITING_FOR_PAIEMENT
+        # The credit notes are inserted before the invoices they cancel
+        invoices.sort(key=lambda i: i.canceled_by_id is not None)
+        return (invoices, links, paiments, paiment_links)
+
+    def generate_documents(self, patients, number):
+        attachment_types = list(
+            models.PatientDocument.AttachmentType.dictReverse.keys())
+        for i in range(number):
+            patient = self.random.choice(patients)
+            name = default_storage.save(
+                'documents/report_%d.txt' % patient.pk,
+                ContentFile(('Report of %s %s' % (
+                    patient.family_name, patient.first_name)).encode('utf-8')))
+            with transaction.atomic():
+                document = models.Document.objects.create(
+                    document_file=name,
+                    title='Report %d' % (i + 1),
+                    internal_date=self.now,
+                    mime_type='text/plain',
+                    user=self.therapeuts[0][0])
+                models.PatientDocument.objects.create(
+                    patient=patient,
+                    document=document,
+                    attachment_type=self.random.choice(attachment_types))
+        self.stdout.write("%d documents created" % number)
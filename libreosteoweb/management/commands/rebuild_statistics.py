@@ -0,0 +1,53 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Rebuild the daily statistics from the patients, examinations and invoices,
+after rows were written without the receivers (bulk import, raw SQL).
+
+    python manage.py rebuild_statistics
+    python manage.py rebuild_statistics --start 2018-01-01 --end 2018-12-31
+"""
+from __future__ import unicode_literals
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from libreosteoweb.api.statistics import rebuild_daily_statistics
+
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError('Invalid day %s, expected YYYY-MM-DD' % value)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily statistics rollup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start',
+                            type=parse_day,
+                            default=None,
+                            help='First day to rebuild, the oldest if empty')
+        parser.add_argument('--end',
+                            type=parse_day,
+                            default=None,
+                            help='Last day to rebuild, the latest if empty')
+
+    def handle(self, *args, **options):
+        nb_days = rebuild_daily_statistics(options['start'], options['end'])
+        self.stdout.write(
+            self.style.SUCCESS("%d days of activity rebuilt" % nb_days))
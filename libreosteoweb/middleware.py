@@ -18,9 +18,14 @@ from django.conf import settings
 from re import compile
 from django.contrib.auth import get_user_model
 from django.core.urlresolvers import reverse
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.utils import CursorWrapper
+import heapq
 import logging
+import time
 
 logger = logging.getLogger(__name__)
+slow_request_logger = logging.getLogger('libreosteoweb.slow_requests')
 
 
 
@@ -94,3 +99,102 @@ class LoginRequiredMiddleware(object):
                 return HttpResponseRedirect(
                     get_login_url() + "?next=" + request.path)
         logger.info("user [%s] authenticated" % request.user)
+
+
+class QueryRecorder(object):
+    """ Number and time of the queries, with the slowest SQL statements """
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.time = 0.0
+        self.slowest = []
+
+    def record(self, sql, duration):
+        self.count += 1
+        self.time += duration
+        heapq.heappush(self.slowest, (duration, self.count, sql))
+        if len(self.slowest) > self.size:
+            heapq.heappop(self.slowest)
+
+
+class InstrumentedCursorWrapper(CursorWrapper):
+    """
+    Records the statements executed by the cursor, without their
+    parameters : they would contain the data of the patients.
+    """
+    def __init__(self, cursor, db, recorder):
+        super(InstrumentedCursorWrapper, self).__init__(cursor, db)
+        self.recorder = recorder
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(InstrumentedCursorWrapper, self).execute(sql, params)
+        finally:
+            self.recorder.record(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(InstrumentedCursorWrapper,
+                         self).executemany(sql, param_list)
+        finally:
+            self.recorder.record(sql, time.time() - start)
+
+
+class QueryInstrumentationMiddleware(object):
+    """
+    Middleware that records the SQL queries of each request when
+    QUERY_INSTRUMENTATION is set. The number of queries and the time spent
+    are given in the X-Query-Count and Server-Timing response headers.
+
+    The requests longer than SLOW_REQUEST_THRESHOLD (in seconds) are logged
+    with their SLOW_REQUEST_QUERIES slowest statements on the
+    libreosteoweb.slow_requests logger, without the parameters.
+    """
+    CURSOR_FACTORIES = ('make_cursor', 'make_debug_cursor')
+
+    def process_request(self, request):
+        if not getattr(settings, 'QUERY_INSTRUMENTATION', False):
+            return
+        recorder = QueryRecorder(getattr(settings, 'SLOW_REQUEST_QUERIES', 5))
+        db = connections[DEFAULT_DB_ALIAS]
+        # The connections are by thread, the cursors of the other requests
+        # are not wrapped
+        previous = dict((name, db.__dict__.get(name))
+                        for name in self.CURSOR_FACTORIES)
+        for name in self.CURSOR_FACTORIES:
+            setattr(db, name,
+                    self.wrap_cursor_factory(getattr(db, name), db, recorder))
+        request._instrumentation = (time.time(), recorder, db, previous)
+
+    def wrap_cursor_factory(self, factory, db, recorder):
+        def make_cursor(cursor):
+            return InstrumentedCursorWrapper(factory(cursor), db, recorder)
+        return make_cursor
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_instrumentation'):
+            return response
+        (start, recorder, db, previous) = request._instrumentation
+        del request._instrumentation
+        for (name, factory) in previous.items():
+            if factory is None:
+                delattr(db, name)
+            else:
+                setattr(db, name, factory)
+        duration = time.time() - start
+        response['X-Query-Count'] = str(recorder.count)
+        response['Server-Timing'] = (
+            'db;dur=%.1f;desc="%d queries", total;dur=%.1f' %
+            (recorder.time * 1000, recorder.count, duration * 1000))
+        if duration >= getattr(settings, 'SLOW_REQUEST_THRESHOLD', 1.0):
+            self.log_slow_request(request, duration, recorder)
+        return response
+
+    def log_slow_request(self, request, duration, recorder):
+        slowest = sorted(recorder.slowest, reverse=True)
+        slow_request_logger.warning(
+            "%s %s took %.3fs, %d queries in %.3fs\n%s", request.method,
+            request.path, duration, recorder.count, recorder.time,
+            "\n".join("  %.3fs %s" % (d, sql) for (d, n, sql) in slowest))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0040_paiment_date'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['family_name', 'first_name', 'id'], name='patient_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='examination',
+            index=models.Index(fields=['date', 'id'], name='examination_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['date', 'id'], name='invoice_date_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0041_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='examination',
+            name='examination_date_idx',
+        ),
+        migrations.AddIndex(
+            model_name='examination',
+            index=models.Index(fields=['date', 'id', 'type'], name='examination_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['creation_date'], name='patient_creation_date_idx'),
+        ),
+    ]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+# Values of the models when the migration was written : the backfill does
+# not use the application code, which follows the current models
+EXAMINATION_TYPE_COLUMNS = {
+    1: 'nb_normal_examination',
+    2: 'nb_continuing_examination',
+    3: 'nb_return',
+    4: 'nb_emergency',
+}
+EXAMINATION_WAITING_FOR_PAIEMENT = 1
+COLUMNS = ('nb_new_patient', 'nb_examination', 'nb_normal_examination',
+           'nb_continuing_examination', 'nb_return', 'nb_emergency',
+           'nb_unpaid', 'invoiced_amount')
+
+
+def get_day(value):
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.date()
+
+
+def build_daily_statistics(apps, schema_editor):
+    """ Rollup of the existing patients, examinations and invoices by day """
+    model = apps.get_model('libreosteoweb', 'DailyStatistics')
+    rows = defaultdict(lambda: dict((column, 0) for column in COLUMNS))
+    patients = apps.get_model('libreosteoweb', 'Patient').objects.exclude(
+        creation_date=None)
+    for creation_date in patients.values_list('creation_date',
+                                              flat=True).iterator():
+        rows[creation_date]['nb_new_patient'] += 1
+    examinations = apps.get_model('libreosteoweb', 'Examination').objects
+    for (value, type, status) in examinations.values_list(
+            'date', 'type', 'status').iterator():
+        counts = rows[get_day(value)]
+        counts['nb_examination'] += 1
+        if type in EXAMINATION_TYPE_COLUMNS:
+            counts[EXAMINATION_TYPE_COLUMNS[type]] += 1
+        if status == EXAMINATION_WAITING_FOR_PAIEMENT:
+            counts['nb_unpaid'] += 1
+    invoices = apps.get_model('libreosteoweb', 'Invoice').objects
+    for (value, amount) in invoices.values_list('date',
+                                                'amount').iterator():
+        rows[get_day(value)]['invoiced_amount'] += amount or 0
+    model.objects.all().delete()
+    model.objects.bulk_create([
+        model(day=key, **counts)
+        for (key, counts) in sorted(rows.items(), key=lambda item: item[0])
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0042_statistics_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True, verbose_name='Day')),
+                ('nb_new_patient', models.IntegerField(default=0, verbose_name='New patients')),
+                ('nb_examination', models.IntegerField(default=0, verbose_name='Examinations')),
+                ('nb_normal_examination', models.IntegerField(default=0, verbose_name='Normal examinations')),
+                ('nb_continuing_examination', models.IntegerField(default=0, verbose_name='Continuing examinations')),
+                ('nb_return', models.IntegerField(default=0, verbose_name='Returns')),
+                ('nb_emergency', models.IntegerField(default=0, verbose_name='Emergencies')),
+                ('nb_unpaid', models.IntegerField(default=0, verbose_name='Unpaid examinations')),
+                ('invoiced_amount', models.FloatField(default=0, verbose_name='Invoiced amount')),
+            ],
+        ),
+        migrations.RunPython(build_daily_statistics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+# Values of the models when the migration was written : the backfill does
+# not use the application code, which follows the current models
+EXAMINATION_TYPE_COLUMNS = {
+    1: 'nb_normal_examination',
+    2: 'nb_continuing_examination',
+    3: 'nb_return',
+    4: 'nb_emergency',
+}
+EXAMINATION_WAITING_FOR_PAIEMENT = 1
+COLUMNS = ('nb_new_patient', 'nb_examination', 'nb_normal_examination',
+           'nb_continuing_examination', 'nb_return', 'nb_emergency',
+           'nb_unpaid', 'invoiced_amount')
+
+
+def get_day(value):
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.date()
+
+
+def build_daily_statistics(apps, schema_editor):
+    """
+    Rollup of the existing patients, examinations and invoices by day and
+    therapeut
+    """
+    model = apps.get_model('libreosteoweb', 'DailyStatistics')
+    users = set(
+        apps.get_model(settings.AUTH_USER_MODEL).objects.values_list(
+            'pk', flat=True))
+    rows = defaultdict(lambda: dict((column, 0) for column in COLUMNS))
+    patients = apps.get_model('libreosteoweb', 'Patient').objects.exclude(
+        creation_date=None)
+    for creation_date in patients.values_list('creation_date',
+                                              flat=True).iterator():
+        rows[(creation_date, None)]['nb_new_patient'] += 1
+    examinations = apps.get_model('libreosteoweb', 'Examination').objects
+    for (value, therapeut, type, status) in examinations.values_list(
+            'date', 'therapeut', 'type', 'status').iterator():
+        counts = rows[(get_day(value), therapeut)]
+        counts['nb_examination'] += 1
+        if type in EXAMINATION_TYPE_COLUMNS:
+            counts[EXAMINATION_TYPE_COLUMNS[type]] += 1
+        if status == EXAMINATION_WAITING_FOR_PAIEMENT:
+            counts['nb_unpaid'] += 1
+    invoices = apps.get_model('libreosteoweb', 'Invoice').objects
+    for (value, therapeut, amount) in invoices.values_list(
+            'date', 'therapeut_id', 'amount').iterator():
+        therapeut = therapeut if therapeut in users else None
+        rows[(get_day(value), therapeut)]['invoiced_amount'] += amount or 0
+    model.objects.all().delete()
+    model.objects.bulk_create([
+        model(day=key[0], therapeut_id=key[1], **counts)
+        for (key, counts) in sorted(
+            rows.items(), key=lambda item: (item[0][0], item[0][1] or 0))
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('libreosteoweb', '0043_dailystatistics'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dailystatistics',
+            name='day',
+            field=models.DateField(db_index=True, verbose_name='Day'),
+        ),
+        migrations.AddField(
+            model_name='dailystatistics',
+            name='therapeut',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Therapeut'),
+        ),
+        migrations.RunPython(build_daily_statistics, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0044_dailystatistics_therapeut'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='paiment',
+            index=models.Index(fields=['date'], name='paiment_date_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('libreosteoweb', '0045_paiment_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.SmallIntegerField(default=0, verbose_name='Status')),
+                ('cancel_requested', models.BooleanField(default=False, verbose_name='Cancel requested')),
+                ('creation_date', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+                ('start_date', models.DateTimeField(blank=True, null=True, verbose_name='Start date')),
+                ('end_date', models.DateTimeField(blank=True, null=True, verbose_name='End date')),
+                ('nb_row_total', models.IntegerField(default=0, verbose_name='Rows to integrate')),
+                ('nb_row_done', models.IntegerField(default=0, verbose_name='Integrated rows')),
+                ('nb_error', models.IntegerField(default=0, verbose_name='Errors')),
+                ('result', models.TextField(blank=True, verbose_name='Result')),
+                ('file_import', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='libreosteoweb.FileImport', verbose_name='File import')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+        ),
+    ]
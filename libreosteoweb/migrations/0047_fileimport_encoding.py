@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0046_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileimport',
+            name='encoding',
+            field=models.CharField(blank=True, max_length=32, verbose_name='Encoding'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0047_fileimport_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileimport',
+            name='extract',
+            field=models.TextField(blank=True, verbose_name='Extract'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0048_fileimport_extract'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileimport',
+            name='checkpoint',
+            field=models.TextField(blank=True, verbose_name='Checkpoint'),
+        ),
+    ]
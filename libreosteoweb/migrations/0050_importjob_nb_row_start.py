@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0049_fileimport_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='nb_row_start',
+            field=models.IntegerField(default=0, verbose_name='Rows integrated before'),
+        ),
+    ]
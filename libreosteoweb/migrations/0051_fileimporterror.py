@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0050_importjob_nb_row_start'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileImportError',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=16, verbose_name='File')),
+                ('line', models.IntegerField(verbose_name='Line')),
+                ('errors', models.TextField(verbose_name='Errors')),
+                ('file_import', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='libreosteoweb.FileImport', verbose_name='File import')),
+            ],
+        ),
+    ]
@@ -20,6 +20,7 @@ from django.core.exceptions import ValidationError
 from django.core.exceptions import NON_FIELD_ERRORS
 from datetime import date, datetime
 from libreosteoweb.api.utils import enum
+import json
 import mimetypes
 
 # import the logging library
@@ -125,6 +126,14 @@ class Patient(models.Model):
     TYPE_NEW_PATIENT = 1
     TYPE_UPDATE_PATIENT = 2
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['family_name', 'first_name', 'id'],
+                         name='patient_name_idx'),
+            models.Index(fields=['creation_date'],
+                         name='patient_creation_date_idx'),
+        ]
+
 
 class Children(models.Model):
     """
@@ -489,6 +498,70 @@ class Examination(models.Model):
     TYPE_RETURN_I18N = _('Return')
     TYPE_EMERGENCY_I18N = _('Emergency')
 
+    # The anatomical findings (skeleton and organs), left out of the
+    # examination summary
+    FINDINGS_FIELDS = (
+        'OsTempD', 'SphenoideD', 'OsParietalD', 'OsFrontal', 'OsZygomatiqueD',
+        'MaxilaireSup', 'OsNez', 'Mandible', 'OsZygomatiqueG', 'OsTempG',
+        'SphenoideG', 'OsParietalG', 'Crane', 'AtmD', 'AtmG', 'EpauleD',
+        'ClaviculeD', 'OmoplateD', 'HumerusD', 'BrasD', 'CoudeD', 'CubitusD',
+        'RadiusD', 'PoignetD', 'PisiformeD', 'PyramidalD', 'OsCrochuD',
+        'SemiLunaireD', 'GrandOsD', 'ScaphoideD', 'TrapezoideD', 'TrapezeD',
+        'Metacarpe5D', 'P1Seg5D', 'P2Seg5D', 'P3Seg5D', 'Metacarpe4D',
+        'P1Seg4D', 'P2Seg4D', 'P3Seg4D', 'Metacarpe3D', 'P1Seg3D', 'P2Seg3D',
+        'P3Seg3D', 'Metacarpe2D', 'P1Seg2D', 'P2Seg2D', 'P3Seg2D',
+        'Metacarpe1D', 'P1PouceD', 'P3PouceD', 'MainD', 'Cote1D', 'Cote2D',
+        'Cote3D', 'Cote4D', 'Cote5D', 'Cote6D', 'Cote7D', 'Cote8D', 'Cote9D',
+        'Cote10D', 'Cote11D', 'Cote12D', 'Cote1G', 'Cote2G', 'Cote3G',
+        'Cote4G', 'Cote5G', 'Cote6G', 'Cote7G', 'Cote8G', 'Cote9G', 'Cote10G',
+        'Cote11G', 'Cote12G', 'Manubrium', 'CorpsSternal', 'ProcessusXiphoide',
+        'GrilCostalD', 'GrilCostalG', 'Sternum', 'ClaviculeG', 'OmoplateG',
+        'HumerusG', 'CubitusG', 'RadiusG', 'BrasG', 'EpauleG', 'CoudeG',
+        'PoignetG', 'PisiformeG', 'PyramidalG', 'OsCrochuG', 'SemiLunaireG',
+        'GrandOsG', 'ScaphoideG', 'TrapezoideG', 'TrapezeG', 'Metacarpe5G',
+        'P1Seg5G', 'P2Seg5G', 'P3Seg5G', 'Metacarpe4G', 'P1Seg4G', 'P2Seg4G',
+        'P3Seg4G', 'Metacarpe3G', 'P1Seg3G', 'P2Seg3G', 'P3Seg3G',
+        'Metacarpe2G', 'P1Seg2G', 'P2Seg2G', 'P3Seg2G', 'Metacarpe1G',
+        'P1PouceG', 'P3PouceG', 'MainG', 'Cervicales', 'Thoraciques',
+        'Lombaires', 'C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'Th1', 'Th2',
+        'Th3', 'Th4', 'Th5', 'Th6', 'Th7', 'Th8', 'Th9', 'Th10', 'Th11',
+        'Th12', 'L1', 'L2', 'L3', 'L4', 'L5', 'Sacrum', 'IlionD', 'IschionD',
+        'OsPubienD', 'Coccyx', 'IlioinG', 'OsPubienG', 'IschionG', 'Bassin',
+        'HancheD', 'HancheG', 'SacroIliaqueD', 'SacroIliaqueG', 'FemurD',
+        'PatellaD', 'FibulaD', 'TibiaD', 'TalusD', 'CalcuneusD', 'OsCuboideD',
+        'OsNaviculaireD', 'JambeD', 'GenouD', 'ChevilleD', 'Cuneiforme1D',
+        'Cuneiforme2D', 'Cuneiforme3D', 'Metatarsien1D', 'Metatarsien2D',
+        'Metatarsien3D', 'Metatarsien4D', 'Metatarsien5D', 'Phalange1D',
+        'Phalange2D', 'Phalange3D', 'Phalange4D', 'Phalange5D', 'Phalangine2D',
+        'Phalangine3D', 'Phalangine4D', 'Phalangine5D', 'Phalangette1D',
+        'Phalangette2D', 'Phalangette3D', 'Phalangette4D', 'Phalangette5D',
+        'PiedD', 'FemurG', 'PatellaG', 'FibulaG', 'TibiaG', 'TalusG',
+        'CalcuneusG', 'OsCuboideG', 'OsNaviculaireG', 'JambeG', 'GenouG',
+        'ChevilleG', 'Cuneiforme1G', 'Cuneiforme2G', 'Cuneiforme3G',
+        'Metatarsien1G', 'Metatarsien2G', 'Metatarsien3G', 'Metatarsien4G',
+        'Metatarsien5G', 'Phalange1G', 'Phalange2G', 'Phalange3G',
+        'Phalange4G', 'Phalange5G', 'Phalangine2G', 'Phalangine3G',
+        'Phalangine4G', 'Phalangine5G', 'Phalangette1G', 'Phalangette2G',
+        'Phalangette3G', 'Phalangette4G', 'Phalangette5G', 'PiedG', 'Foie',
+        'Rate', 'VesiculeBiliaire', 'Pancreas', 'Oesophage', 'Estomac',
+        'Duodenum', 'ColonTransverse', 'ColonAscendant', 'ColonDescendant',
+        'Rectum', 'Jujenum', 'Ileon', 'ColonSimoide', 'InstestinGrele',
+        'Colon', 'Appendice', 'RainDroit', 'RainGauche', 'Vessie',
+        'TractusUrinaire', 'VessieM', 'Protaste', 'Penis', 'TesticuleDroite',
+        'TesticuleGauche', 'GenitalM', 'Vagin', 'ColUterus', 'Uterus',
+        'OvaireDroite', 'OvaireGauche', 'GenitalF', 'UterusVagin',
+    )
+
+    # Not mapped field, invoices resolved in bulk for list rendering
+    _invoice_chain = None
+
+    class Meta:
+        indexes = [
+            # The type is covered for the statistics
+            models.Index(fields=['date', 'id', 'type'],
+                         name='examination_date_idx'),
+        ]
+
     def __unicode__(self):
         return "%s %s" % (self.patient, self.date)
 
@@ -501,31 +574,47 @@ class Examination(models.Model):
             return self._resolve_invoice(invoice.canceled_by)
         return invoice if invoice.type == 'invoice' else None
 
-    def _get_invoices_list(self):
+    def set_invoice_chain(self, invoices):
+        """ Use this setting method to give the invoices attached to this
+            examination, most recent first, with their canceled_by links
+            already loaded (see api.invoicing.chain).
+            Not mapped in DB only for the runtime"""
+        self._invoice_chain = self._compute_invoice_chain(invoices)
+
+    def _get_invoice_chain(self):
+        if self._invoice_chain is not None:
+            return self._invoice_chain
+        return self._compute_invoice_chain(
+            list(self.invoices.all().order_by('-date')))
+
+    def _compute_invoice_chain(self, invoices):
+        """ Return a tuple (last_invoice, invoices_list) from the invoices
+            attached to this examination, ordered from the most recent """
+        if len(invoices) == 0:
+            return (None, [])
+        if invoices[0].canceled_by is not None:
+            last_invoice = self._resolve_invoice(invoices[0])
+        else:
+            last_invoice = invoices[0]
         invoices_list = []
-        if self.invoices is not None and self.invoices.all().count() > 0:
-            invoices = self.invoices.all().order_by('date')
-            for invoice in invoices:
-                current_invoice = invoice
+        for invoice in reversed(invoices):
+            current_invoice = invoice
+            invoices_list.append(current_invoice)
+            while current_invoice.canceled_by is not None:
+                current_invoice = current_invoice.canceled_by
                 invoices_list.append(current_invoice)
-                while current_invoice.canceled_by is not None:
-                    current_invoice = current_invoice.canceled_by
-                    invoices_list.append(current_invoice)
-        last_invoice = self._get_last_invoice()
         invoices_list.reverse()
         if last_invoice is not None:
-            invoices_list.remove(self._get_last_invoice())
-        return invoices_list
+            invoices_list.remove(last_invoice)
+        return (last_invoice, invoices_list)
+
+    def _get_invoices_list(self):
+        return self._get_invoice_chain()[1]
 
     invoices_list = property(_get_invoices_list)
 
     def _get_last_invoice(self):
-        if self.invoices.all().count() == 0:
-            return None
-        invoices = self.invoices.all().order_by('-date')
-        if invoices.first().canceled_by is not None:
-            return self._resolve_invoice(invoices.first())
-        return self.invoices.latest('date')
+        return self._get_invoice_chain()[0]
 
     last_invoice = property(_get_last_invoice)
 
@@ -643,6 +732,8 @@ class Invoice(models.Model):
                             default='invoice')
 
     def _get_paiments_list(self):
+        if hasattr(self, 'prefetched_paiments'):
+            return self.prefetched_paiments
         return self.paiment_set.all().order_by('-date')
 
     paiments_list = property(_get_paiments_list)
@@ -653,6 +744,9 @@ class Invoice(models.Model):
 
     class Meta:
         ordering = ['-date']
+        indexes = [
+            models.Index(fields=['date', 'id'], name='invoice_date_idx'),
+        ]
 
 
 class PaimentMean(models.Model):
@@ -678,6 +772,11 @@ class Paiment(models.Model):
     paiment_mode = models.CharField(_('Paiment mode'), max_length=10)
     date = models.DateField(_('Date'))
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['date'], name='paiment_date_idx'),
+        ]
+
 
 class OfficeEvent(models.Model):
     """
@@ -699,6 +798,30 @@ class OfficeEvent(models.Model):
             self.date = datetime.today()
 
 
+class DailyStatistics(models.Model):
+    """
+    This class implements the rollup of the office activity by day and
+    therapeut, it is kept up to date by the receivers and read by the
+    statistics. The new patients are not attributed to a therapeut.
+    """
+    day = models.DateField(_('Day'), db_index=True)
+    therapeut = models.ForeignKey(User,
+                                  verbose_name=_('Therapeut'),
+                                  blank=True,
+                                  null=True,
+                                  on_delete=models.SET_NULL)
+    nb_new_patient = models.IntegerField(_('New patients'), default=0)
+    nb_examination = models.IntegerField(_('Examinations'), default=0)
+    nb_normal_examination = models.IntegerField(_('Normal examinations'),
+                                                default=0)
+    nb_continuing_examination = models.IntegerField(
+        _('Continuing examinations'), default=0)
+    nb_return = models.IntegerField(_('Returns'), default=0)
+    nb_emergency = models.IntegerField(_('Emergencies'), default=0)
+    nb_unpaid = models.IntegerField(_('Unpaid examinations'), default=0)
+    invoiced_amount = models.FloatField(_('Invoiced amount'), default=0)
+
+
 class OfficeSettings(models.Model):
     """
     This class implements model for the settings into the application
@@ -801,8 +924,29 @@ class FileImport(models.Model):
                                  blank=True,
                                  default=None,
                                  null=True)
+    # Encoding of the files, detected when empty
+    encoding = models.CharField(_('Encoding'), max_length=32, blank=True)
+    # Random rows of the files by line number as JSON, kept from the upload
+    extract = models.TextField(_('Extract'), blank=True)
+    # Progress of the integration by file as JSON, to continue it if stopped
+    checkpoint = models.TextField(_('Checkpoint'), blank=True)
     analyze = None
 
+    def get_checkpoint(self):
+        if not self.checkpoint:
+            return {}
+        return json.loads(self.checkpoint)
+
+    def is_resumable(self):
+        """ True when the integration of the files started but stopped """
+        checkpoint = self.get_checkpoint()
+        if not checkpoint:
+            return False
+        return any(
+            bool(f) and not checkpoint.get(name, {}).get('done', False)
+            for (name, f) in (('patient', self.file_patient),
+                              ('examination', self.file_examination)))
+
     def delete(self, *args, **kwargs):
         """
         Delete media file too.
@@ -817,6 +961,62 @@ class FileImport(models.Model):
         if bool(self.file_examination):
             storage_examination.delete(path_examination)
 
+
+class FileImportError(models.Model):
+    """
+    Errors of a row of a file of a file import, added with the checkpoint
+    of its chunk
+    """
+    file_import = models.ForeignKey(FileImport,
+                                    verbose_name=_('File import'),
+                                    on_delete=models.CASCADE)
+    # The file of the file import : patient or examination
+    name = models.CharField(_('File'), max_length=16)
+    line = models.IntegerField(_('Line'))
+    # The errors of the row as JSON
+    errors = models.TextField(_('Errors'))
+
+
+ImportJobStatus = enum('ImportJobStatus', 'PENDING', 'RUNNING', 'DONE',
+                       'FAILED', 'CANCELED')
+
+
+class ImportJob(models.Model):
+    """
+    This class implements the integration of a file import, run in the
+    background. The progress is saved after each chunk of rows.
+    """
+    file_import = models.ForeignKey(FileImport,
+                                    verbose_name=_('File import'),
+                                    blank=True,
+                                    null=True,
+                                    on_delete=models.SET_NULL)
+    user = models.ForeignKey(User,
+                             verbose_name=_('User'),
+                             blank=True,
+                             null=True,
+                             on_delete=models.SET_NULL)
+    status = models.SmallIntegerField(_('Status'),
+                                      default=ImportJobStatus.PENDING)
+    cancel_requested = models.BooleanField(_('Cancel requested'),
+                                           default=False)
+    creation_date = models.DateTimeField(_('Creation date'),
+                                         auto_now_add=True)
+    start_date = models.DateTimeField(_('Start date'), blank=True, null=True)
+    end_date = models.DateTimeField(_('End date'), blank=True, null=True)
+    nb_row_total = models.IntegerField(_('Rows to integrate'), default=0)
+    nb_row_done = models.IntegerField(_('Integrated rows'), default=0)
+    # Rows integrated by the previous jobs of the file import
+    nb_row_start = models.IntegerField(_('Rows integrated before'),
+                                       default=0)
+    nb_error = models.IntegerField(_('Errors'), default=0)
+    # The report of the integration as JSON, when finished
+    result = models.TextField(_('Result'), blank=True)
+
+    def is_finished(self):
+        return self.status in (ImportJobStatus.DONE, ImportJobStatus.FAILED,
+                               ImportJobStatus.CANCELED)
+
 import mimetypes
 
 class Document(models.Model):
@@ -0,0 +1,105 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from libreosteoweb.models import (Patient, Examination, Invoice,
+                                  InvoiceStatus, OfficeEvent, Paiment,
+                                  PatientDocument)
+from libreosteoweb.api.invoicing.chain import InvoiceChainResolver
+
+
+class TestGeneratePractice(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root)
+
+    def generate(self, **options):
+        call_command('generate_practice',
+                     stdout=StringIO(),
+                     seed=1,
+                     batch_size=20,
+                     **options)
+
+    def test_generate_practice(self):
+        self.generate(patients=10,
+                      examinations=50,
+                      documents=2,
+                      cancel_ratio=0.2)
+        self.assertEqual(Patient.objects.count(), 10)
+        self.assertEqual(Examination.objects.count(), 50)
+        self.assertEqual(PatientDocument.objects.count(), 2)
+        self.assertEqual(OfficeEvent.objects.count(), 60)
+        canceled = Invoice.objects.filter(status=InvoiceStatus.CANCELED)
+        self.assertTrue(canceled.exists())
+        for invoice in canceled:
+            self.assertEqual(invoice.canceled_by.type, 'creditnote')
+        examinations = InvoiceChainResolver().resolve(
+            Examination.objects.filter(invoices__in=canceled))
+        for examination in examinations:
+            self.assertEqual(examination.last_invoice.type, 'invoice')
+            self.assertEqual(len(examination.invoices_list), 2)
+
+    def test_paiments_of_regularized_invoices(self):
+        self.generate(patients=10,
+                      examinations=50,
+                      documents=0,
+                      unpaid_ratio=0.5,
+                      regularized_ratio=0.5)
+        paiments = Paiment.objects.all()
+        self.assertTrue(paiments.exists())
+        for paiment in paiments:
+            invoice = paiment.invoice.get()
+            self.assertEqual(invoice.paiment_mode, 'notpaid')
+            self.assertEqual(invoice.status, InvoiceStatus.INVOICED_PAID)
+            self.assertNotEqual(paiment.paiment_mode, 'notpaid')
+            self.assertGreaterEqual(paiment.date, invoice.date.date())
+        self.assertTrue(
+            Invoice.objects.filter(
+                status=InvoiceStatus.WAITING_FOR_PAIEMENT).exists())
+
+    def test_generate_twice(self):
+        self.generate(patients=5, examinations=10, documents=0)
+        self.generate(patients=5, examinations=10, documents=0)
+        self.assertEqual(Patient.objects.count(), 10)
+        self.assertEqual(Examination.objects.count(), 20)
+
+    def test_benchmark_api(self):
+        self.generate(patients=5, examinations=20, documents=0)
+        User.objects.create_superuser("test", "test@test.com", "testpw")
+        output = os.path.join(self.media_root, 'benchmark.json')
+        call_command('benchmark_api',
+                     stdout=StringIO(),
+                     output=output,
+                     repeat=1)
+        with open(output) as result_file:
+            report = json.load(result_file)
+        self.assertEqual(report['database']['Examination'], 20)
+        for name in ['patient_timeline', 'examination_detail',
+                     'invoices_list', 'statistics', 'events_feed', 'search']:
+            self.assertEqual(report['results'][name]['status'], 200)
+            self.assertGreater(report['results'][name]['queries'], 0)
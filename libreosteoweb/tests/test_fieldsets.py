@@ -0,0 +1,132 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.contrib.auth.models import User
+from libreosteoweb.models import Patient, Examination
+from datetime import datetime
+from django.db.models import signals
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_examination,
+                                         receiver_newpatient)
+
+
+class ExaminationsTestCase(APITestCase):
+    def setUp(self):
+        receivers_senders = [(receiver_examination, Examination),
+                             (receiver_newpatient, Patient)]
+        with block_disconnect_all_signal(signal=signals.post_save,
+                                         receivers_senders=receivers_senders):
+            self.user = User.objects.create_superuser("test", "test@test.com",
+                                                      "testpw")
+            self.patient = Patient.objects.create(
+                family_name="Picard",
+                first_name="Jean-Luc",
+                birth_date=datetime(1935, 7, 13))
+            for i in range(3):
+                self.examination = Examination.objects.create(
+                    date=datetime.now(),
+                    reason="reason %s" % i,
+                    OsTempD="finding",
+                    status=0,
+                    type=1,
+                    patient=self.patient,
+                    therapeut=self.user)
+        self.client.login(username='test', password='testpw')
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return (response, [q['sql'] for q in queries])
+
+
+class TestSparseFieldset(ExaminationsTestCase):
+    def test_list_selected_fields(self):
+        response, queries = self.get(
+            reverse('examination-list') + '?fields=id,date,reason,status')
+        self.assertEqual(len(response.data), 3)
+        for examination in response.data:
+            self.assertEqual(set(examination.keys()),
+                             set(['id', 'date', 'reason', 'status']))
+        examination_queries = [
+            q for q in queries if 'libreosteoweb_examination' in q
+        ]
+        self.assertEqual(len(examination_queries), 1)
+        self.assertNotIn('OsTempD', examination_queries[0])
+        self.assertNotIn('libreosteoweb_invoice', ' '.join(queries))
+
+    def test_retrieve_excluded_fields(self):
+        response, queries = self.get(
+            reverse('examination-detail', kwargs={'pk': self.examination.pk})
+            + '?exclude=OsTempD,invoices_list')
+        self.assertNotIn('OsTempD', response.data)
+        self.assertNotIn('invoices_list', response.data)
+        self.assertEqual(response.data['reason'], 'reason 2')
+        self.assertNotIn('"OsTempD"', ' '.join(queries))
+
+    def test_nested_field_selects_parent(self):
+        response, _ = self.get(
+            reverse('examination-list') +
+            '?fields=date,patient_detail.family_name')
+        self.assertEqual(response.data[0]['patient_detail']['family_name'],
+                         'Picard')
+
+    def test_without_parameter_all_fields(self):
+        response, _ = self.get(reverse('patient-list'))
+        self.assertIn('medical_history', response.data[0])
+        self.assertEqual(response.data[0]['family_name'], 'Picard')
+
+
+class TestExaminationRepresentation(ExaminationsTestCase):
+    def test_findings_fields(self):
+        fields = set(f.name for f in Examination._meta.concrete_fields)
+        for name in Examination.FINDINGS_FIELDS:
+            self.assertIn(name, fields)
+        self.assertEqual(len(set(Examination.FINDINGS_FIELDS)),
+                         len(Examination.FINDINGS_FIELDS))
+        self.assertNotIn('reason', Examination.FINDINGS_FIELDS)
+
+    def test_list_summary(self):
+        response, queries = self.get(reverse('examination-list'))
+        self.assertEqual(len(response.data), 3)
+        self.assertNotIn('OsTempD', response.data[0])
+        self.assertNotIn('PiedG', response.data[0])
+        self.assertIn('prescipteur', response.data[0])
+        self.assertIn('conclusion', response.data[0])
+        self.assertIn('invoices_list', response.data[0])
+        self.assertNotIn('"OsTempD"', ' '.join(queries))
+
+    def test_list_full_on_request(self):
+        response, _ = self.get(
+            reverse('examination-list') + '?representation=full')
+        self.assertEqual(response.data[0]['OsTempD'], 'finding')
+
+    def test_retrieve_full(self):
+        response, _ = self.get(
+            reverse('examination-detail', kwargs={'pk': self.examination.pk}))
+        self.assertEqual(response.data['OsTempD'], 'finding')
+
+    def test_unpaid_summary(self):
+        Examination.objects.filter(pk=self.examination.pk).update(
+            status=Examination.EXAMINATION_WAITING_FOR_PAIEMENT)
+        response, queries = self.get(reverse('examination-unpaid'))
+        self.assertEqual(len(response.data), 1)
+        self.assertNotIn('OsTempD', response.data[0])
+        self.assertNotIn('"OsTempD"', ' '.join(queries))
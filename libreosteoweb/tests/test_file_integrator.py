@@ -14,8 +14,19 @@
 # You should have received a copy of the GNU General Public License
 # along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
 # -*- coding: utf-8 -*-
+from datetime import date
+import io
+import multiprocessing
+import os
+import tempfile
+
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from libreosteoweb.api import file_integrator
+from libreosteoweb.api.serializers import ExaminationSerializer, PatientSerializer
+from libreosteoweb.models import Examination, OfficeEvent, Patient
 try:
     from unittest.mock import mock_open
     from unittest.mock import patch
@@ -74,6 +85,118 @@ class TestFileIntegrator(TestCase):
 		self.assertTrue(c1 != c2)
 
 
+	def test_file_content_cache_by_content(self):
+		header = 'Nom;Prenom;Nom de Famille'
+		files = []
+		for i in range(2):
+			f = MagicMock()
+			f.read.return_value = header
+			f.__iter__.return_value = [header, 'a;b;c']
+			files.append(f)
+		cache = file_integrator.FileContentCache()
+		c1 = cache.get_content(files[0])
+		with patch.object(file_integrator.FileContentAdapter, '_get_reader') as get_reader:
+			c2 = cache.get_content(files[1])
+			self.assertFalse(get_reader.called)
+		self.assertEquals(1, len(cache))
+		self.assertEquals(2, c2['nb_row'])
+		self.assertIs(files[1], c2.file)
+		cache.discard(files[0])
+		self.assertEquals((0, 0), (len(cache), cache.size))
+
+	def test_file_content_cache_drops_the_least_recently_used(self):
+		files = []
+		for header in ('a;b', 'c;d', 'e;f'):
+			f = MagicMock()
+			f.read.return_value = header
+			f.__iter__.return_value = [header]
+			files.append(f)
+		cache = file_integrator.FileContentCache(max_size=1)
+		cache.get_content(files[0])
+		cache.max_size = 2 * cache.size
+		cache.get_content(files[1])
+		cache.get_content(files[0])
+		cache.get_content(files[2])
+		self.assertEquals(2, len(cache))
+		self.assertLessEqual(cache.size, cache.max_size)
+		with patch.object(file_integrator.FileContentAdapter, '_get_reader') as get_reader:
+			cache.get_content(files[0])
+			self.assertFalse(get_reader.called)
+
+	def test_file_digest_computed_once_by_file(self):
+		(fd, path) = tempfile.mkstemp()
+		os.close(fd)
+		self.addCleanup(os.remove, path)
+		f = MagicMock()
+		f.path = path
+		cache = file_integrator.FileContentCache()
+		with patch.object(file_integrator, 'get_file_digest', side_effect=['d1', 'd2']) as get_file_digest:
+			self.assertEquals('d1', cache.get_digest(f))
+			self.assertEquals('d1', cache.get_digest(f))
+			self.assertEquals(1, get_file_digest.call_count)
+			with io.open(path, 'wb') as changed:
+				changed.write(b'Nom;Prenom')
+			self.assertEquals('d2', cache.get_digest(f))
+
+	def test_file_content_parsed_without_the_lock(self):
+		cache = file_integrator.FileContentCache()
+		f = MagicMock()
+		f.read.return_value = 'a;b'
+		f.__iter__.return_value = ['a;b']
+		get_content = file_integrator.FileContentAdapter.get_content
+
+		def parse(adapter):
+			self.assertTrue(cache._lock.acquire(False))
+			cache._lock.release()
+			return get_content(adapter)
+
+		with patch.object(file_integrator.FileContentAdapter, 'get_content', parse):
+			cache.get_content(f)
+		self.assertEquals(1, len(cache))
+
+	def test_supported_encoding(self):
+		for encoding in ('utf-8', 'utf-8-sig', 'iso-8859-1', 'cp1252'):
+			self.assertTrue(file_integrator.is_supported_encoding(encoding), encoding)
+		for encoding in ('utf-16', 'utf-16-le', 'utf-32', 'utf-7', 'cp037', 'base64', 'unknown'):
+			self.assertFalse(file_integrator.is_supported_encoding(encoding), encoding)
+
+	def test_detect_encoding(self):
+		self.assertEquals('utf-8', file_integrator.detect_encoding(u'Prénom;Nom'.encode('utf-8')))
+		# The sample may end in the middle of a character
+		self.assertEquals('utf-8', file_integrator.detect_encoding(u'Prénom;é'.encode('utf-8')[:-1]))
+		self.assertEquals('utf-8-sig', file_integrator.detect_encoding(u'\ufeffPrénom'.encode('utf-8')))
+		self.assertEquals('iso-8859-1', file_integrator.detect_encoding(u'Prénom;Nom'.encode('iso-8859-1')))
+
+	def test_file_content_adapter_decodes_the_lines(self):
+		lines = [u'Nom;Prénom'.encode('utf-8'), u'Hélène;Noël'.encode('utf-8'), u'Zoé;Loïc'.encode('iso-8859-1')]
+
+		f = MagicMock()
+		# The encoding is detected on the first lines only
+		f.read.return_value = b'\n'.join(lines[:2])
+		f.__iter__.return_value = lines
+
+		adapter = file_integrator.FileContentAdapter(f).get_content()
+		self.assertEquals('utf-8', adapter['encoding'])
+		self.assertEquals([u'Nom', u'Prénom'], adapter['header'])
+		self.assertEquals([(2, [u'Hélène', u'Noël']), (3, [u'Zoé', u'Loïc'])], list(adapter.iter_rows()))
+
+		adapter = file_integrator.FileContentAdapter(f, encoding='iso-8859-1').get_content()
+		self.assertEquals([u'Nom', u'PrÃ©nom'], adapter['header'])
+
+	def test_extract_file_samples_the_rows(self):
+		rows = [(line, ['a%d' % line, 'b']) for line in range(2, 102)]
+		content = Mock()
+		content.iter_rows.side_effect = lambda: iter(rows)
+		extractor = file_integrator.Extractor()
+		with patch.object(file_integrator.FileContentProxy, 'get_content', return_value=content):
+			result = extractor.extract_file(MagicMock())
+			self.assertEquals(5, len(result))
+			for (line, row) in result.items():
+				self.assertEquals(['a%s' % line, 'b'], row)
+			self.assertEquals(3, len(extractor.extract_file(MagicMock(), size=3)))
+			rows = rows[:2]
+			self.assertEquals(['2', '3'], sorted(extractor.extract_file(MagicMock())))
+
 	def test_analyzertype(self):
 		content = {}
 		content['header'] = ['nom de famille', 'prenom', 'date de naissance']
@@ -121,10 +244,174 @@ class TestFileIntegrator(TestCase):
 		result = adapter.get_content()
 		self.assertEquals(1, result['nb_row'])
 		self.assertEquals(['Nom', 'Prenom', 'Nom de Famille'], result['header'])
-		self.assertEquals([], result['content'])
+		self.assertEquals([], list(result.iter_rows()))
+
+	def test_file_content_adapter_streams_the_rows(self):
+		lines = ['Nom;Prenom;Nom de Famille'] + ['a%d;b;c' % i for i in range(7)]
+
+		f = MagicMock()
+		f.read.return_value = '\n'.join(lines)
+		f.__iter__.return_value = lines
+
+		adapter = file_integrator.FileContentAdapter(f).get_content()
+		self.assertEquals(8, adapter['nb_row'])
+		self.assertNotIn('content', adapter)
+		rows = list(adapter.iter_rows())
+		self.assertEquals((2, ['a0', 'b', 'c']), rows[0])
+		self.assertEquals((8, ['a6', 'b', 'c']), rows[-1])
+		chunks = list(adapter.iter_chunks(size=3))
+		self.assertEquals([3, 3, 1], [len(c) for c in chunks])
+		self.assertEquals(rows, [r for c in chunks for r in c])
+
+	def test_file_content_adapter_sniffs_a_prefix(self):
+		header = 'Nom;Prenom;Nom de Famille'
+
+		f = MagicMock()
+		f.read.return_value = header
+		f.__iter__.return_value = (header,)
+
+		file_integrator.FileContentAdapter(f).get_content()
+		f.read.assert_called_with(file_integrator._CSV_SNIFF_SIZE)
 
 
 	def tearDown(self):
 		self.patcher.stop()
 
 
+class TestIntegratorPatient(TestCase):
+	def get_row(self, family_name, birth_date='01/02/1980'):
+		return ['1', family_name, '', 'Jean', birth_date, 'M'] + [''] * 18
+
+	def test_integrate_chunk_in_bulk(self):
+		integrator = file_integrator.IntegratorPatient(serializer_class=PatientSerializer)
+		chunk = [
+			(2, self.get_row('Dupont')),
+			(3, self.get_row('DUPONT')),
+			(4, self.get_row('Martin', birth_date='31/02/1980')),
+			(5, self.get_row('Durand')),
+		]
+		(nb_line, errors) = integrator.integrate_chunk(chunk)
+		self.assertEquals(2, nb_line)
+		self.assertEquals([3, 4], [line for (line, error) in errors])
+		self.assertIn('non_field_errors', errors[0][1])
+		self.assertEquals(['Dupont', 'Durand'],
+			sorted(Patient.objects.values_list('family_name', flat=True)))
+
+	def test_bulk_insert_sets_the_primary_keys(self):
+		patient = Patient(family_name='Before', first_name='Jean', birth_date=date(1980, 2, 1))
+		patient.set_user_operation(User.objects.create_superuser("test", "test@test.com", "testpw"))
+		patient.save()
+		integrator = file_integrator.IntegratorPatient(serializer_class=PatientSerializer)
+		integrator.load_identities()
+		with patch.object(file_integrator, 'update_search_index') as update_search_index:
+			integrator.integrate_chunk([(i, self.get_row('Family%d' % i)) for i in range(2, 5)])
+		indexed = update_search_index.call_args[0][1]
+		self.assertEquals(['Family2', 'Family3', 'Family4'],
+			sorted(indexed.values_list('family_name', flat=True)))
+
+	def test_integrate_chunk_reuses_the_serializer(self):
+		integrator = file_integrator.IntegratorPatient(serializer_class=PatientSerializer)
+		validator = integrator.get_validator()
+		integrator.integrate_chunk([(2, self.get_row('Dupont'))])
+		self.assertIs(validator, integrator.get_validator())
+		(nb_line, errors) = integrator.integrate_chunk([(2, self.get_row('Dupont'))])
+		self.assertEquals(0, nb_line)
+		self.assertEquals(2, errors[0][0])
+
+	def test_integrate_chunk_finds_the_existing_patients(self):
+		patient = Patient(family_name='Dupont', first_name='Jean', birth_date=date(1980, 2, 1))
+		patient.set_user_operation(User.objects.create_superuser("test", "test@test.com", "testpw"))
+		patient.save()
+		serializer = PatientSerializer(data=file_integrator.FilePatientFactory().get_data(self.get_row('DUPONT')))
+		self.assertFalse(serializer.is_valid())
+		integrator = file_integrator.IntegratorPatient(serializer_class=PatientSerializer)
+		integrator.load_identities()
+		(nb_line, errors) = integrator.integrate_chunk([(2, self.get_row('DUPONT'))])
+		self.assertEquals(0, nb_line)
+		self.assertEquals([(2, serializer.errors)], errors)
+
+	def test_validate_chunks_in_a_process_pool(self):
+		chunks = [[(line, self.get_row('Family%d' % line)) for line in range(start, start + 10)]
+			for start in range(2, 52, 10)]
+		chunks[2][3] = (25, self.get_row('Martin', birth_date='31/02/1980'))
+		content = Mock()
+		content.iter_chunks.side_effect = lambda: iter(chunks)
+		integrator = file_integrator.IntegratorPatient(serializer_class=PatientSerializer)
+		expected = list(integrator.validate_chunks(content))
+		with patch.object(file_integrator.IntegratorPatient, 'get_workers', return_value=2):
+			result = list(integrator.validate_chunks(content))
+		self.assertEquals(expected, result)
+		self.assertEquals([10] * 5, [nb_row for (nb_row, last_line, valid, errors) in result])
+		self.assertEquals([11, 21, 31, 41, 51], [last_line for (nb_row, last_line, valid, errors) in result])
+		self.assertEquals([25], [line for (nb_row, last_line, valid, errors) in result for (line, e) in errors])
+		resumed = list(integrator.validate_chunks(content, start_line=25))
+		self.assertEquals([6, 10, 10], [nb_row for (nb_row, last_line, valid, errors) in resumed])
+		self.assertEquals([], resumed[0][3])
+
+	def test_validate_chunks_without_the_process_pool(self):
+		chunks = [[(line, self.get_row('Family%d' % line)) for line in range(start, start + 10)]
+			for start in range(2, 52, 10)]
+		chunks[2][3] = (25, self.get_row('Martin', birth_date='31/02/1980'))
+		content = Mock()
+		content.iter_chunks.side_effect = lambda: iter(chunks)
+		integrator = file_integrator.IntegratorPatient(serializer_class=PatientSerializer)
+		expected = list(integrator.validate_chunks(content))
+		pool = Mock()
+		pool.apply_async.return_value.get.side_effect = multiprocessing.TimeoutError()
+		context = Mock()
+		context.Pool.return_value = pool
+		with patch.object(file_integrator.IntegratorPatient, 'get_workers', return_value=2), \
+				patch.object(file_integrator, '_get_pool_context', return_value=context):
+			self.assertEquals(expected, list(integrator.validate_chunks(content)))
+			pool.terminate.assert_called_once_with()
+			pool.apply_async.return_value.get.assert_called_once_with(file_integrator.IMPORT_WORKER_TIMEOUT)
+			context.Pool.side_effect = OSError()
+			self.assertEquals(expected, list(integrator.validate_chunks(content)))
+
+	def test_integrate_chunk_does_not_query_by_row(self):
+		integrator = file_integrator.IntegratorPatient(serializer_class=PatientSerializer)
+		integrator.load_identities()
+		with CaptureQueriesContext(connection) as one_row:
+			integrator.integrate_chunk([(2, self.get_row('Family'))])
+		with CaptureQueriesContext(connection) as many_rows:
+			integrator.integrate_chunk([(i, self.get_row('Family%d' % i)) for i in range(10)])
+		self.assertEquals(len(one_row), len(many_rows))
+
+
+class TestIntegratorExamination(TestCase):
+	def setUp(self):
+		self.user = user = User.objects.create_superuser("test", "test@test.com", "testpw")
+		self.patients = []
+		for (family_name, first_name) in (('Dupont', 'Jean'), ('Martin', 'Marie-Anne')):
+			patient = Patient(family_name=family_name, first_name=first_name, birth_date=date(1980, 2, 1))
+			patient.set_user_operation(user)
+			patient.save()
+			self.patients.append(patient)
+
+	def test_patient_table(self):
+		rows = [
+			(2, ['1', ' DUPONT ', '', 'jean', '01/02/1980']),
+			(3, ['2', 'martin', '', 'MARIE-ANNE', '01/02/1980']),
+			(4, ['3', 'Durand', '', 'Paul', '01/02/1980']),
+			(5, ['4', 'Dupont', '', 'Jean', '31/02/1980']),
+		]
+		integrator = file_integrator.IntegratorExamination()
+		content = Mock()
+		content.iter_rows.return_value = iter(rows)
+		with patch.object(integrator.extractor, 'get_content', return_value=content):
+			with self.assertNumQueries(1):
+				integrator._build_patient_table(Mock())
+		self.assertEquals({1: self.patients[0].pk, 2: self.patients[1].pk}, integrator.patient_table)
+		with self.assertRaises(ValueError):
+			integrator.get_patient(3, Mock())
+
+	def test_no_office_event_for_the_imported_examinations(self):
+		integrator = file_integrator.IntegratorExamination(serializer_class=ExaminationSerializer)
+		integrator.patient_table = {1: self.patients[0].pk, 2: self.patients[1].pk}
+		row = ['02/02/2011', 'reason', 'desc'] + ['x'] * 10
+		OfficeEvent.objects.all().delete()
+		(nb_line, errors) = integrator.integrate_chunk([(2, ['1'] + row), (3, ['2'] + row)],
+			file_additional=Mock(), user=self.user)
+		self.assertEquals((2, []), (nb_line, errors))
+		self.assertEquals(2, Examination.objects.count())
+		self.assertFalse(OfficeEvent.objects.exists())
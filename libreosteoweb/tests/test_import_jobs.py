@@ -0,0 +1,294 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import json
+import shutil
+import tempfile
+
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from django.db import DatabaseError
+from libreosteoweb.models import (Examination, FileImport, ImportJob,
+                                  ImportJobStatus, OfficeEvent, Patient)
+from libreosteoweb.api.file_integrator import (FileImportCheckpoint,
+                                               IntegrationCanceled)
+from libreosteoweb.api.serializers import ImportJobSerializer
+from libreosteoweb.api.import_jobs import (ImportJobProgress,
+                                           interrupt_import_jobs,
+                                           run_import_job)
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+PATIENT_HEADER = ('Numero;Nom de Famille;Nom de jeune fille;Prenom;'
+                  'Date de naissance (JJ/MM/AAAA);Sex (M/F);Rue;'
+                  'Complement dadresse;code postal;ville;email;Telephone;'
+                  'Mobile;Profession;Loisirs;Fumeur (O/N);Lateralite;'
+                  'Informations importantes;Traitement en cours;'
+                  'Antecedents chirurgicaux;Antecedents medicaux;'
+                  'Antecedents familiaux;Antecedents traumatiques;'
+                  'CR medicaux')
+EXAMINATION_HEADER = ('Numero patient;Date;Motif;Description;ORL;Visceral;'
+                      'Pulmo;Uro-gyneco;Periphery;Etat general;'
+                      'Examen medical;Diagnostic;Traitements;Conclusion')
+
+
+class TestImportJob(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        self.user = User.objects.create_superuser("test", "test@test.com",
+                                                  "testpw")
+        self.client.login(username='test', password='testpw')
+        patients = [PATIENT_HEADER] + [
+            '%d;Family%d;;Name%d;02/02/1960;F;rue;;75000;Paris;;;;;;N;D;;;;;;;'
+            % (i, i, i) for i in range(1, 4)
+        ]
+        examinations = [EXAMINATION_HEADER] + [
+            '%d;02/02/2011;reason;desc;x;x;x;x;x;x;x;x;x;x' % i
+            for i in (1, 2, 2)
+        ]
+        self.file_import = FileImport()
+        self.file_import.file_patient.save(
+            'patients.csv', ContentFile('\n'.join(patients)), save=False)
+        self.file_import.file_examination.save(
+            'examinations.csv', ContentFile('\n'.join(examinations)),
+            save=False)
+        self.file_import.save()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root)
+
+    def get_job(self, job_id):
+        response = self.client.get(
+            reverse('importjob-detail', kwargs={'pk': job_id}))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    @patch('libreosteoweb.api.views.start_import_job')
+    def test_integrate_in_background(self, start_import_job):
+        response = self.client.post(
+            reverse('fileimport-integrate',
+                    kwargs={'pk': self.file_import.pk}))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status_name'], 'PENDING')
+        self.assertEqual(start_import_job.call_count, 1)
+        self.assertEqual(Patient.objects.count(), 0)
+
+        run_import_job(response.data['id'])
+        job = self.get_job(response.data['id'])
+        self.assertEqual(job['status_name'], 'DONE')
+        self.assertEqual(job['nb_row_total'], 6)
+        self.assertEqual(job['nb_row_done'], 6)
+        self.assertEqual(job['nb_row_start'], 0)
+        self.assertEqual(job['nb_error'], 0)
+        self.assertIsNone(job['eta'])
+        self.assertEqual(job['result']['patient']['imported'], 3)
+        self.assertEqual(job['result']['examination']['imported'], 3)
+        self.assertEqual(Patient.objects.count(), 3)
+        self.assertEqual(Examination.objects.count(), 3)
+
+    def test_integrate_only_with_post(self):
+        response = self.client.get(
+            reverse('fileimport-integrate',
+                    kwargs={'pk': self.file_import.pk}))
+        self.assertEqual(response.status_code, 405)
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_integrate_one_by_one_with_the_receivers(self):
+        # The bulk insert is rolled back
+        with patch('libreosteoweb.api.file_integrator._set_inserted_pks',
+                   side_effect=DatabaseError()):
+            job = self.run_job()
+        self.assertEqual(job['result']['patient']['imported'], 3)
+        self.assertEqual(job['result']['examination']['imported'], 3)
+        # The imported patients and examinations have no office event
+        self.assertEqual(Examination.objects.count(), 3)
+        self.assertFalse(OfficeEvent.objects.exists())
+
+    def test_cancel_a_pending_job(self):
+        job = ImportJob.objects.create(file_import=self.file_import,
+                                       user=self.user)
+        response = self.client.post(
+            reverse('importjob-cancel', kwargs={'pk': job.pk}))
+        self.assertEqual(response.data['status_name'], 'CANCELED')
+        run_import_job(job.pk)
+        self.assertEqual(Patient.objects.count(), 0)
+
+    def test_cancel_a_running_job(self):
+        job = ImportJob.objects.create(file_import=self.file_import,
+                                       user=self.user,
+                                       status=ImportJobStatus.RUNNING)
+        progress = ImportJobProgress(job)
+        progress(2, 1)
+        response = self.client.post(
+            reverse('importjob-cancel', kwargs={'pk': job.pk}))
+        self.assertEqual(response.data['status_name'], 'RUNNING')
+        self.assertTrue(response.data['cancel_requested'])
+        with self.assertRaises(IntegrationCanceled):
+            progress(2, 0)
+        job.refresh_from_db()
+        self.assertEqual((job.nb_row_done, job.nb_error), (4, 1))
+
+    def test_rate_of_a_resumed_job(self):
+        job = ImportJob(file_import=self.file_import,
+                        status=ImportJobStatus.RUNNING,
+                        start_date=timezone.now() - timedelta(seconds=10),
+                        nb_row_total=200,
+                        nb_row_done=150,
+                        nb_row_start=100)
+        serializer = ImportJobSerializer(job)
+        self.assertEqual(serializer.data['rate'], 5.0)
+        self.assertEqual(serializer.data['eta'], 10)
+
+    def test_checkpoint_adds_the_errors(self):
+        checkpoint = FileImportCheckpoint(self.file_import, 'patient')
+        checkpoint.save(3, 1, [(2, {'birth_date': ['invalid']})])
+        size = len(self.file_import.checkpoint)
+        checkpoint.save(5, 0, [(4, ['invalid']), (5, ['invalid'])])
+        self.assertEqual(len(self.file_import.checkpoint), size)
+        resumed = FileImportCheckpoint(
+            FileImport.objects.get(pk=self.file_import.pk), 'patient')
+        self.assertEqual((resumed.line, resumed.imported, resumed.nb_error),
+                         (5, 1, 3))
+        self.assertEqual(resumed.get_errors(),
+                         [(2, {'birth_date': ['invalid']}), (4, ['invalid']),
+                          (5, ['invalid'])])
+        self.assertEqual(
+            FileImportCheckpoint(self.file_import, 'examination').get_errors(),
+            [])
+
+    def test_interrupted_jobs(self):
+        job = ImportJob.objects.create(file_import=self.file_import,
+                                       status=ImportJobStatus.RUNNING)
+        self.assertEqual(interrupt_import_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJobStatus.FAILED)
+        self.assertIsNotNone(job.end_date)
+
+    def test_running_jobs_kept_when_django_is_set_up(self):
+        # The management commands set django up while the server runs
+        job = ImportJob.objects.create(status=ImportJobStatus.RUNNING)
+        apps.get_app_config('libreosteoweb').ready()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJobStatus.RUNNING)
+
+    def test_extract_saved_at_upload(self):
+        with open(self.file_import.file_patient.path, 'rb') as patients:
+            response = self.client.post(reverse('fileimport-list'),
+                                        {'file_patient': patients},
+                                        format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sorted(response.data['extract']['patient']),
+                         ['2', '3', '4'])
+        with patch('libreosteoweb.api.serializers.Extractor') as extractor:
+            response = self.client.get(
+                reverse('fileimport-detail',
+                        kwargs={'pk': response.data['id']}))
+            self.assertFalse(extractor.called)
+        self.assertEqual(response.data['extract']['patient']['2'][1],
+                         'Family1')
+
+    def test_unsupported_encoding_rejected_at_upload(self):
+        for (encoding, status_code) in (('utf-16', 400), ('unknown', 400),
+                                        ('cp1252', 201)):
+            with open(self.file_import.file_patient.path, 'rb') as patients:
+                response = self.client.post(reverse('fileimport-list'),
+                                            {'file_patient': patients,
+                                             'encoding': encoding},
+                                            format='multipart')
+            self.assertEqual(response.status_code, status_code, encoding)
+
+    def run_job(self):
+        job = ImportJob.objects.create(file_import=self.file_import,
+                                       user=self.user)
+        run_import_job(job.pk)
+        return self.get_job(job.pk)
+
+    def test_integrate_again_does_not_import_twice(self):
+        job = self.run_job()
+        self.assertEqual(job['status_name'], 'DONE')
+        self.file_import.refresh_from_db()
+        self.assertFalse(self.file_import.is_resumable())
+        again = self.run_job()
+        self.assertEqual(again['status_name'], 'DONE')
+        self.assertEqual(again['result'], job['result'])
+        self.assertEqual(Patient.objects.count(), 3)
+        self.assertEqual(Examination.objects.count(), 3)
+
+    def test_checkpoint_summary_read_only(self):
+        self.run_job()
+        self.file_import.refresh_from_db()
+        checkpoint = self.file_import.checkpoint
+        url = reverse('fileimport-detail', kwargs={'pk': self.file_import.pk})
+        response = self.client.patch(url, {'checkpoint': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['checkpoint']['patient'], {
+            'line': 4,
+            'imported': 3,
+            'nb_error': 0,
+            'done': True
+        })
+        self.file_import.refresh_from_db()
+        self.assertEqual(self.file_import.checkpoint, checkpoint)
+        response = self.client.patch(url, {'encoding': 'cp1252'})
+        self.assertEqual(response.status_code, 400)
+
+    @patch('libreosteoweb.api.views.start_import_job')
+    def test_resume_a_canceled_job(self, start_import_job):
+        job = self.run_job()
+        # The job stopped after the first examination
+        Examination.objects.filter(patient__family_name='Family2').delete()
+        self.file_import.refresh_from_db()
+        checkpoint = self.file_import.get_checkpoint()
+        checkpoint['examination'] = {
+            'line': 2,
+            'imported': 1,
+            'nb_error': 0,
+            'done': False
+        }
+        FileImport.objects.filter(pk=self.file_import.pk).update(
+            checkpoint=json.dumps(checkpoint))
+        ImportJob.objects.filter(pk=job['id']).update(
+            status=ImportJobStatus.CANCELED)
+        self.assertTrue(
+            FileImport.objects.get(pk=self.file_import.pk).is_resumable())
+
+        response = self.client.post(
+            reverse('importjob-resume', kwargs={'pk': job['id']}))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(start_import_job.call_count, 1)
+        run_import_job(response.data['id'])
+        resumed = self.get_job(response.data['id'])
+        self.assertEqual(resumed['status_name'], 'DONE')
+        self.assertEqual(resumed['nb_row_done'], 6)
+        self.assertEqual(resumed['nb_row_start'], 4)
+        self.assertEqual(resumed['result']['patient']['imported'], 3)
+        self.assertEqual(resumed['result']['examination']['imported'], 3)
+        self.assertEqual(Patient.objects.count(), 3)
+        self.assertEqual(Examination.objects.count(), 3)
+
+        response = self.client.post(
+            reverse('importjob-resume', kwargs={'pk': resumed['id']}))
+        self.assertEqual(response.status_code, 400)
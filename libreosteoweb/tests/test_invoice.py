@@ -15,13 +15,17 @@
 # -*- coding: utf-8 -*-
 from django.urls import reverse
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
 from django.contrib.auth.models import User
 from libreosteoweb.models import (TherapeutSettings, OfficeSettings, Invoice,
                                   Patient, Examination, InvoiceStatus,
-                                  ExaminationStatus)
+                                  ExaminationStatus, Paiment, PaimentMean)
+from libreosteoweb.api.invoicing.chain import InvoiceChainResolver
+from libreosteoweb.api.invoicing.paiment_means import paiment_means
 from datetime import datetime
+from django.db import connection, transaction
 from django.db.models import signals
+from django.test.utils import CaptureQueriesContext
 from libreosteoweb.api.receivers import (block_disconnect_all_signal,
                                          receiver_examination,
                                          receiver_newpatient)
@@ -380,3 +384,250 @@ class TestRegularizeNotPaidInvoice(APITestCase):
                          ExaminationStatus.INVOICED_PAID)
 
 
+
+
+class InvoicesTestCase(APITestCase):
+    def setUp(self):
+        receivers_senders = [(receiver_examination, Examination),
+                             (receiver_newpatient, Patient)]
+        with block_disconnect_all_signal(signal=signals.post_save,
+                                         receivers_senders=receivers_senders):
+            self.user = User.objects.create_superuser("test", "test@test.com",
+                                                      "testpw")
+            self.client.login(username='test', password='testpw')
+            self.p1 = Patient.objects.create(family_name="Picard",
+                                             first_name="Jean-Luc",
+                                             birth_date=datetime(1935, 7, 13))
+            self.e1 = Examination.objects.create(date=datetime.now(),
+                                                 status=0,
+                                                 type=1,
+                                                 patient=self.p1)
+            self.e2 = Examination.objects.create(date=datetime.now(),
+                                                 status=0,
+                                                 type=1,
+                                                 patient=self.p1)
+
+    def create_invoice(self, number, amount=50, canceled_by=None):
+        return Invoice.objects.create(
+            date=datetime.now(),
+            dateExamination=datetime.now(),
+            amount=amount,
+            number=number,
+            canceled_by=canceled_by,
+            type='invoice' if amount > 0 else 'creditnote')
+
+    def create_chain(self, examination, length):
+        """ Attach an invoice canceled length times to the examination """
+        invoices = []
+        canceled_by = None
+        for i in range(length, 0, -1):
+            amount = 50 if i % 2 else -50
+            canceled_by = self.create_invoice(u'%s' % i, amount, canceled_by)
+            invoices.append(canceled_by)
+        examination.invoices.add(canceled_by)
+        return invoices[::-1]
+
+
+class TestInvoiceChainResolver(InvoicesTestCase):
+    def test_resolve_same_as_lazy_evaluation(self):
+        self.create_chain(self.e1, 3)
+        self.create_chain(self.e2, 2)
+        self.e2.invoices.add(self.create_invoice(u'10'))
+        expected = dict((e.pk, (e.last_invoice, e.invoices_list))
+                        for e in Examination.objects.all())
+
+        examinations = InvoiceChainResolver().resolve(
+            Examination.objects.all())
+        with self.assertNumQueries(0):
+            for e in examinations:
+                self.assertEqual(e.last_invoice, expected[e.pk][0])
+                self.assertEqual(e.invoices_list, expected[e.pk][1])
+                self.assertEqual(list(e.last_invoice.paiments_list), [])
+
+    def test_resolve_canceled_invoice(self):
+        (invoice, credit_note) = self.create_chain(self.e1, 2)
+        examination = InvoiceChainResolver().resolve(
+            Examination.objects.filter(pk=self.e1.pk))[0]
+        self.assertIsNone(examination.last_invoice)
+        self.assertEqual(examination.invoices_list, [credit_note, invoice])
+
+    def test_list_queries_does_not_depend_on_chain_length(self):
+        self.create_chain(self.e1, 1)
+        self.create_chain(self.e2, 1)
+        with CaptureQueriesContext(connection) as short_chain:
+            response = self.client.get(reverse('examination-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        Invoice.objects.all().delete()
+        self.create_chain(self.e1, 5)
+        self.create_chain(self.e2, 4)
+        with CaptureQueriesContext(connection) as long_chain:
+            response = self.client.get(reverse('examination-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The paiment means registry is only loaded by the first request
+        self.assertEqual(self.count_invoice_queries(short_chain),
+                         self.count_invoice_queries(long_chain))
+
+    def count_invoice_queries(self, queries):
+        return len([
+            q for q in queries.captured_queries
+            if 'paimentmean' not in q['sql']
+        ])
+
+
+class TestPaimentMeanRegistry(APITransactionTestCase):
+    def setUp(self):
+        paiment_means.clear()
+
+    def tearDown(self):
+        paiment_means.clear()
+
+    def test_registry_loaded_once(self):
+        PaimentMean.objects.create(code='transfer', text='Transfer')
+        self.assertEqual(paiment_means.get_text('transfer'), 'Transfer')
+        with self.assertNumQueries(0):
+            self.assertEqual(paiment_means.get_text('transfer'), 'Transfer')
+            self.assertIn('transfer', paiment_means.get_enabled_codes())
+            self.assertEqual(paiment_means.get_text('unknown'), 'n/a')
+
+    def test_registry_invalidated_on_change(self):
+        paiment_mean = PaimentMean.objects.create(code='transfer',
+                                                  text='Transfer')
+        self.assertIn('transfer', paiment_means.get_enabled_codes())
+        paiment_mean.enable = False
+        paiment_mean.text = 'Bank transfer'
+        paiment_mean.save()
+        self.assertNotIn('transfer', paiment_means.get_enabled_codes())
+        self.assertEqual(paiment_means.get_text('transfer'), 'Bank transfer')
+        paiment_mean.delete()
+        self.assertIsNone(paiment_means.get('transfer'))
+
+    def test_registry_kept_on_rollback(self):
+        PaimentMean.objects.create(code='transfer', text='Transfer')
+        self.assertEqual(paiment_means.get_text('transfer'), 'Transfer')
+        try:
+            with transaction.atomic():
+                PaimentMean.objects.filter(code='transfer').update(
+                    text='Bank transfer')
+                PaimentMean.objects.get(code='transfer').save()
+                self.assertEqual(paiment_means.get_text('transfer'),
+                                 'Bank transfer')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(paiment_means.get_text('transfer'), 'Transfer')
+
+    def test_registry_changed_in_the_transaction(self):
+        paiment_mean = PaimentMean.objects.create(code='transfer',
+                                                  text='Transfer')
+        self.assertEqual(paiment_means.get_text('transfer'), 'Transfer')
+        with transaction.atomic():
+            paiment_mean.text = 'Bank transfer'
+            paiment_mean.save()
+            self.assertEqual(paiment_means.get_text('transfer'),
+                             'Bank transfer')
+        self.assertEqual(paiment_means.get_text('transfer'), 'Bank transfer')
+        with self.assertNumQueries(0):
+            paiment_means.get_text('transfer')
+
+    def test_registry_enabled_code(self):
+        PaimentMean.objects.create(code='transfer', text='Old', enable=False)
+        PaimentMean.objects.create(code='transfer', text='Transfer')
+        self.assertIn('transfer', paiment_means.get_enabled_codes())
+        self.assertEqual(paiment_means.get_text('transfer'), 'Transfer')
+
+
+class TestInvoiceView(InvoicesTestCase):
+    def test_unknown_paiment_mean(self):
+        invoice = self.create_invoice(u'1')
+        invoice.paiment_mode = 'unknown'
+        invoice.save()
+        response = self.client.get(
+            reverse('invoice_view', kwargs={'invoiceid': invoice.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['paiment_mean'], 'unknown')
+
+
+class TestUnpaidExaminations(InvoicesTestCase):
+    def add_unpaid(self, amount):
+        examination = Examination.objects.create(
+            date=datetime.now(),
+            status=ExaminationStatus.WAITING_FOR_PAIEMENT,
+            type=1,
+            patient=self.p1,
+            therapeut=self.user)
+        invoice = self.create_invoice(u'%s' % examination.pk, amount)
+        invoice.status = InvoiceStatus.WAITING_FOR_PAIEMENT
+        invoice.save()
+        examination.invoices.add(invoice)
+        return examination
+
+    def get_unpaid(self, url=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url or reverse('examination-unpaid'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return (response.data, len(queries))
+
+    def test_unpaid_list_without_pagination(self):
+        self.add_unpaid(50)
+        self.add_unpaid(30)
+        (data, _) = self.get_unpaid()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0]['last_invoice']['amount'], 30)
+        self.assertIn('invoices_list', data[0])
+
+    def test_unpaid_totals(self):
+        self.add_unpaid(50)
+        self.add_unpaid(30)
+        (data, _) = self.get_unpaid(
+            reverse('examination-unpaid') + '?page_size=10')
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['amount_due'], 80)
+        self.assertIsNone(data['next'])
+        self.assertEqual(len(data['results']), 2)
+        result = data['results'][0]
+        self.assertEqual(result['patient_detail']['family_name'], 'Picard')
+        self.assertEqual(result['last_invoice']['amount'], 30)
+        self.assertNotIn('OsTempD', result)
+        self.assertNotIn('invoices_list', result)
+
+    def test_amount_due_less_the_paiments(self):
+        first = self.add_unpaid(50).invoices.get()
+        second = self.add_unpaid(30).invoices.get()
+        paiment = Paiment.objects.create(amount=20,
+                                         currency='EUR',
+                                         paiment_mode='cash',
+                                         date=datetime.today())
+        paiment.invoice.add(first)
+        # A paiment of several invoices is subtracted once
+        paiment = Paiment.objects.create(amount=15,
+                                         currency='EUR',
+                                         paiment_mode='cash',
+                                         date=datetime.today())
+        paiment.invoice.add(first, second)
+        (data, _) = self.get_unpaid(
+            reverse('examination-unpaid') + '?page_size=10')
+        self.assertEqual(data['amount_due'], 45)
+
+    def test_unpaid_paginated(self):
+        for i in range(5):
+            self.add_unpaid(10)
+        (data, _) = self.get_unpaid(
+            reverse('examination-unpaid') + '?page_size=2')
+        self.assertEqual(data['count'], 5)
+        self.assertEqual(data['amount_due'], 50)
+        self.assertEqual(len(data['results']), 2)
+        ids = [e['id'] for e in data['results']]
+        while data['next'] is not None:
+            (data, _) = self.get_unpaid(data['next'])
+            ids.extend(e['id'] for e in data['results'])
+        self.assertEqual(len(set(ids)), 5)
+
+    def test_unpaid_queries_does_not_depend_on_rows(self):
+        url = reverse('examination-unpaid') + '?page_size=10'
+        self.add_unpaid(10)
+        self.get_unpaid(url)
+        (_, few) = self.get_unpaid(url)
+        for i in range(5):
+            self.add_unpaid(10)
+        (_, many) = self.get_unpaid(url)
+        self.assertEqual(few, many)
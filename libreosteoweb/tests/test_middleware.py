@@ -0,0 +1,83 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.contrib.auth.models import User
+from django.db.models import signals
+from libreosteoweb.models import Patient
+from libreosteoweb.api.receivers import (receiver_newpatient,
+                                         temp_disconnect_signal)
+from datetime import date
+
+
+@override_settings(QUERY_INSTRUMENTATION=True)
+class TestQueryInstrumentationMiddleware(APITestCase):
+    def setUp(self):
+        User.objects.create_superuser("test", "test@test.com", "testpw")
+        self.client.login(username='test', password='testpw')
+        with temp_disconnect_signal(signal=signals.post_save,
+                                    receiver=receiver_newpatient,
+                                    sender=Patient):
+            self.patient = Patient.objects.create(
+                family_name='Picard',
+                first_name='Jean-Luc',
+                birth_date=date(1935, 7, 13))
+
+    def test_headers(self):
+        db = connections[DEFAULT_DB_ALIAS]
+        with CaptureQueriesContext(db) as queries:
+            response = self.client.get(reverse('patient-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(int(response['X-Query-Count']), len(queries))
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('total;dur=', response['Server-Timing'])
+        self.assertNotIn('make_cursor', db.__dict__)
+        self.assertNotIn('make_debug_cursor', db.__dict__)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0, SLOW_REQUEST_QUERIES=1)
+    def test_slow_request_logged(self):
+        with self.assertLogs('libreosteoweb.slow_requests',
+                             level='WARNING') as logs:
+            self.client.get(
+                reverse('patient-detail', kwargs={'pk': self.patient.pk}))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('/api/patients', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0, SLOW_REQUEST_QUERIES=100)
+    def test_slow_request_without_parameters(self):
+        with self.assertLogs('libreosteoweb.slow_requests',
+                             level='WARNING') as logs:
+            self.client.patch(
+                reverse('patient-detail', kwargs={'pk': self.patient.pk}),
+                {'family_name': 'Kirk'})
+        self.assertIn('UPDATE', logs.output[0])
+        self.assertNotIn('Kirk', logs.output[0])
+        self.assertNotIn('Jean-Luc', logs.output[0])
+
+    def test_fast_request_not_logged(self):
+        with self.assertRaises(AssertionError):
+            with self.assertLogs('libreosteoweb.slow_requests'):
+                self.client.get(reverse('patient-list'))
+
+    @override_settings(QUERY_INSTRUMENTATION=False)
+    def test_disabled(self):
+        response = self.client.get(reverse('patient-list'))
+        self.assertNotIn('X-Query-Count', response)
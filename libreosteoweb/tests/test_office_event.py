@@ -0,0 +1,88 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.contrib.auth.models import User
+from libreosteoweb.models import Patient, Examination, OfficeEvent
+from datetime import datetime
+from django.db.models import signals
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_examination,
+                                         receiver_newpatient)
+
+
+class TestOfficeEventFeed(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("test", "test@test.com",
+                                                  "testpw")
+        self.client.login(username='test', password='testpw')
+
+    def add_patient(self, family_name, nb_examinations=1):
+        receivers_senders = [(receiver_examination, Examination),
+                             (receiver_newpatient, Patient)]
+        with block_disconnect_all_signal(signal=signals.post_save,
+                                         receivers_senders=receivers_senders):
+            patient = Patient.objects.create(family_name=family_name,
+                                             first_name="James",
+                                             birth_date=datetime(1924, 1, 1))
+            self.add_event(Patient, patient.id)
+            for i in range(nb_examinations):
+                examination = Examination.objects.create(date=datetime.now(),
+                                                         status=0,
+                                                         type=1,
+                                                         patient=patient)
+                self.add_event(Examination, examination.id)
+        return patient
+
+    def add_event(self, clazz, reference):
+        return OfficeEvent.objects.create(date=datetime.now(),
+                                          clazz=clazz.__name__,
+                                          type=1,
+                                          reference=reference,
+                                          user=self.user)
+
+    def get_events(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('officeevent-list'),
+                                       {'limit': 50})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return (response.data['results'], len(queries))
+
+    def test_events_patient_name(self):
+        self.add_patient("Bond", nb_examinations=2)
+        events, _ = self.get_events()
+        self.assertEqual(len(events), 3)
+        for event in events:
+            self.assertEqual(event['patient_name'], "Bond James")
+            self.assertEqual(event['therapeut_name']['username'], "test")
+
+    def test_events_with_deleted_reference(self):
+        patient = self.add_patient("Bond", nb_examinations=1)
+        Examination.objects.filter(patient=patient).delete()
+        patient.delete()
+        events, _ = self.get_events()
+        self.assertEqual([e['patient_name'] for e in events], ["", ""])
+
+    def test_events_queries_does_not_depend_on_page_size(self):
+        self.add_patient("Bond", nb_examinations=1)
+        _, nb_queries_short = self.get_events()
+        for name in ["Picard", "Kirk", "Sisko"]:
+            self.add_patient(name, nb_examinations=3)
+        _, nb_queries_long = self.get_events()
+        self.assertEqual(nb_queries_short, nb_queries_long)
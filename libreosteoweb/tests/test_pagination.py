@@ -0,0 +1,69 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.contrib.auth.models import User
+from libreosteoweb.models import Patient
+from datetime import datetime
+from django.db.models import signals
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_newpatient)
+
+
+class TestKeysetPagination(APITestCase):
+    def setUp(self):
+        receivers_senders = [(receiver_newpatient, Patient)]
+        with block_disconnect_all_signal(signal=signals.post_save,
+                                         receivers_senders=receivers_senders):
+            User.objects.create_superuser("test", "test@test.com", "testpw")
+            # Same names to check the ordering on the id tie-breaker
+            for i in range(7):
+                Patient.objects.create(family_name="Smith",
+                                       first_name="John",
+                                       birth_date=datetime(1980, 1, 1))
+            for name in ["Adams", "Zola", "Martin"]:
+                Patient.objects.create(family_name=name,
+                                       first_name="Jane",
+                                       birth_date=datetime(1980, 1, 1))
+        self.client.login(username='test', password='testpw')
+
+    def test_without_parameter_returns_list(self):
+        response = self.client.get(reverse('patient-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsInstance(response.data, list)
+        self.assertEqual(len(response.data), 10)
+
+    def test_follow_next_link(self):
+        url = reverse('patient-list') + '?page_size=3'
+        ids = []
+        nb_pages = 0
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 3)
+            ids.extend(p['id'] for p in response.data['results'])
+            url = response.data['next']
+            nb_pages += 1
+        self.assertEqual(nb_pages, 4)
+        expected = list(
+            Patient.objects.order_by('family_name', 'first_name',
+                                     'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('patient-list') + '?cursor=foo')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,89 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.contrib.auth.models import User
+from libreosteoweb.models import (Patient, Examination, ExaminationComment,
+                                  TherapeutSettings, OfficeSettings)
+from datetime import datetime
+from django.db.models import signals
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_examination,
+                                         receiver_newpatient)
+
+
+class TestPatientTimeline(APITestCase):
+    def setUp(self):
+        receivers_senders = [(receiver_examination, Examination),
+                             (receiver_newpatient, Patient)]
+        with block_disconnect_all_signal(signal=signals.post_save,
+                                         receivers_senders=receivers_senders):
+            self.user = User.objects.create_superuser("test", "test@test.com",
+                                                      "testpw")
+            TherapeutSettings.objects.create(adeli="12345",
+                                             siret="12345",
+                                             user=self.user)
+            OfficeSettings.objects.create(office_siret="12345",
+                                          currency='EUR',
+                                          amount=50)
+            self.client.login(username='test', password='testpw')
+            self.p1 = Patient.objects.create(family_name="Picard",
+                                             first_name="Jean-Luc",
+                                             birth_date=datetime(1935, 7, 13))
+            self.p2 = Patient.objects.create(family_name="Bond",
+                                             first_name="James",
+                                             birth_date=datetime(1924, 1, 1))
+
+    def add_examinations(self, patient, number, nb_comments=2):
+        with block_disconnect_all_signal(
+                signal=signals.post_save,
+                receivers_senders=[(receiver_examination, Examination)]):
+            for i in range(number):
+                examination = Examination.objects.create(date=datetime.now(),
+                                                         status=0,
+                                                         type=1,
+                                                         patient=patient,
+                                                         therapeut=self.user)
+                for c in range(nb_comments):
+                    ExaminationComment.objects.create(
+                        comment="comment %s" % c,
+                        examination=examination,
+                        user=self.user)
+
+    def get_timeline(self, patient):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('patient-examinations', kwargs={'pk': patient.pk}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return (response, len(queries))
+
+    def test_timeline_comments_count(self):
+        self.add_examinations(self.p1, 3, nb_comments=2)
+        response, _ = self.get_timeline(self.p1)
+        self.assertEqual(len(response.data), 3)
+        for examination in response.data:
+            self.assertEqual(examination['comments'], 2)
+            self.assertEqual(examination['therapeut']['username'], 'test')
+
+    def test_timeline_queries_does_not_depend_on_examinations(self):
+        self.add_examinations(self.p1, 1)
+        self.add_examinations(self.p2, 10)
+        _, nb_queries_short = self.get_timeline(self.p1)
+        _, nb_queries_long = self.get_timeline(self.p2)
+        self.assertEqual(nb_queries_short, nb_queries_long)
@@ -0,0 +1,427 @@
+# This file is part of Libreosteo.
+#
+# Libreosteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreosteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreosteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from datetime import date, datetime, time, timedelta
+from io import StringIO
+import random
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import signals
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase, APITransactionTestCase
+from libreosteoweb.models import (DailyStatistics, Examination, Invoice,
+                                  InvoiceStatus, Paiment, Patient)
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_examination,
+                                         receiver_newpatient)
+from libreosteoweb.api.statistics import (ROLLUP_SERIES, RevenueStatistics,
+                                          _get_statistics_key,
+                                          SeriesStatistics, Statistics,
+                                          compute_daily_statistics,
+                                          get_cached_statistics,
+                                          invalidate_statistics,
+                                          rebuild_daily_statistics)
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class TestStatistics(TestCase):
+    def setUp(self):
+        receivers_senders = [(receiver_examination, Examination),
+                             (receiver_newpatient, Patient)]
+        rand = random.Random(42)
+        today = date.today()
+        with block_disconnect_all_signal(signal=signals.post_save,
+                                         receivers_senders=receivers_senders):
+            for i in range(60):
+                creation_date = today - timedelta(days=rand.randint(0, 900))
+                patient = Patient.objects.create(family_name="Family %s" % i,
+                                                 first_name="Name",
+                                                 birth_date=date(1980, 1, 1),
+                                                 creation_date=creation_date)
+                for j in range(5):
+                    day = today - timedelta(days=rand.randint(0, 900))
+                    Examination.objects.create(
+                        date=timezone.make_aware(
+                            datetime.combine(
+                                day, time(rand.randint(0, 23),
+                                          rand.randint(0, 59)))),
+                        status=0,
+                        type=rand.choice([1, 2, 3, 4]),
+                        patient=patient)
+
+    def expected(self, period):
+        """ Statistics computed with a count per period """
+        statistics = Statistics()
+        statistics.define_period_subclass(period)
+        history = dict((serie, [[], []]) for serie in
+                       ['nb_new_patient', 'nb_examination', 'nb_urgent_return'])
+        for (start, end) in statistics.get_periods()[::-1]:
+            values = statistics.get_statistics(end)
+            # get_statistics gives the values from the start of the period
+            values = statistics.compute_statistics(
+                start, datetime.combine(end, time.max), values)
+            for serie in history:
+                history[serie][0].append("%s - %s" % (start, end))
+                history[serie][1].append(values[serie])
+        return history
+
+    def test_same_as_count_per_period(self):
+        result = Statistics().compute()
+        for period in ['week', 'month', 'year']:
+            expected = self.expected(period)
+            self.assertEqual(result['history'][period], expected)
+            for serie in expected:
+                self.assertEqual(result[period][serie], expected[serie][1][-1])
+            self.assertEqual(result[period]['nb_non_paid'], 0)
+        self.assertGreater(sum(result['history']['year']['nb_examination'][1]),
+                           0)
+
+    def test_queries_does_not_depend_on_history_size(self):
+        with self.assertNumQueries(1):
+            Statistics().compute()
+        with self.assertNumQueries(1):
+            Statistics(history_size=20).compute()
+
+    def get_rollup(self):
+        return list(
+            DailyStatistics.objects.order_by('day').values_list(
+                'day', *ROLLUP_SERIES))
+
+    def get_day_value(self, day, column):
+        row = DailyStatistics.objects.filter(day=day).first()
+        return getattr(row, column) if row is not None else 0
+
+    def test_rollup_follows_the_changes(self):
+        examination = Examination.objects.order_by('date').first()
+        day = timezone.localtime(examination.date).date()
+        previous_day = day - timedelta(days=1)
+        nb_examination = self.get_day_value(day, 'nb_examination')
+        examination.date = examination.date - timedelta(days=1)
+        examination.status = 1
+        examination.save()
+        self.assertEqual(self.get_day_value(day, 'nb_examination'),
+                         nb_examination - 1)
+        self.assertEqual(self.get_day_value(previous_day, 'nb_unpaid'), 1)
+        examination.delete()
+        self.assertEqual(self.get_day_value(previous_day, 'nb_unpaid'), 0)
+
+    def test_rebuild_gives_the_same_rollup(self):
+        rollup = self.get_rollup()
+        self.assertGreater(len(rollup), 0)
+        DailyStatistics.objects.all().delete()
+        call_command('rebuild_statistics', stdout=StringIO())
+        self.assertEqual(self.get_rollup(), rollup)
+
+
+class TestStatisticsView(APITransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_superuser("test", "test@test.com",
+                                                  "testpw")
+        self.client.login(username='test', password='testpw')
+        self.patient = Patient(family_name="Family",
+                               first_name="Name",
+                               birth_date=date(1980, 1, 1),
+                               creation_date=date.today())
+        self.patient.set_user_operation(self.user)
+        self.patient.save()
+
+    def get_statistics(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('statistics_view'))
+        return len(queries), response.data
+
+    def test_served_from_the_cache(self):
+        (queries, first) = self.get_statistics()
+        (cached_queries, second) = self.get_statistics()
+        self.assertEqual(first, second)
+        self.assertLess(cached_queries, queries)
+        self.assertEqual(first['year']['nb_new_patient'], 1)
+
+    def test_invalidated_by_the_changes(self):
+        (queries, result) = self.get_statistics()
+        self.assertEqual(result['year']['nb_examination'], 0)
+        examination = Examination.objects.create(date=timezone.now(),
+                                                 status=0,
+                                                 type=1,
+                                                 patient=self.patient,
+                                                 therapeut=self.user)
+        (queries, result) = self.get_statistics()
+        self.assertEqual(result['year']['nb_examination'], 1)
+        examination.delete()
+        (queries, result) = self.get_statistics()
+        self.assertEqual(result['year']['nb_examination'], 0)
+
+    def test_computation_started_before_an_invalidation_is_not_served(self):
+        compute = Statistics.compute
+
+        def compute_then_invalidate(instance):
+            result = compute(instance)
+            invalidate_statistics()
+            return result
+
+        with patch.object(Statistics, 'compute', compute_then_invalidate):
+            get_cached_statistics()
+        with self.assertNumQueries(1):
+            get_cached_statistics()
+
+    def test_computation_concurrent_to_a_transaction_is_not_served(self):
+        # The rollup read by a concurrent request before the commit
+        before_commit = Statistics().compute()
+        with transaction.atomic():
+            Examination.objects.create(date=timezone.now(),
+                                       status=0,
+                                       type=1,
+                                       patient=self.patient,
+                                       therapeut=self.user)
+            # The concurrent request caches it before the commit
+            cache.set(_get_statistics_key(), before_commit)
+            self.assertEqual(
+                get_cached_statistics()['year']['nb_examination'], 0)
+        self.assertEqual(get_cached_statistics()['year']['nb_examination'],
+                         1)
+
+
+class TestStatisticsSeries(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("test", "test@test.com",
+                                                  "testpw")
+        self.other = User.objects.create_user("other", "other@test.com",
+                                              "otherpw")
+        self.client.login(username='test', password='testpw')
+        patient = Patient(family_name="Family",
+                          first_name="Name",
+                          birth_date=date(1980, 1, 1),
+                          creation_date=date(2018, 2, 10))
+        patient.set_user_operation(self.user)
+        patient.save()
+        for (day, therapeut, type) in [(date(2018, 1, 15), self.user, 1),
+                                       (date(2018, 3, 20), self.user, 3),
+                                       (date(2018, 3, 21), self.other, 1),
+                                       (date(2019, 1, 2), self.other, 4)]:
+            Examination.objects.create(date=timezone.make_aware(
+                datetime.combine(day, time(10, 0))),
+                                       status=0,
+                                       type=type,
+                                       patient=patient,
+                                       therapeut=therapeut)
+
+    def get_series(self, **params):
+        return self.client.get(reverse('statistics_series_view'), params)
+
+    def test_dense_series(self):
+        response = self.get_series(**{
+            'from': '2018-01-10',
+            'to': '2018-12-31',
+            'granularity': 'quarter'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['start'] for p in response.data['periods']], [
+            date(2018, 1, 10),
+            date(2018, 4, 1),
+            date(2018, 7, 1),
+            date(2018, 10, 1)
+        ])
+        series = response.data['series']
+        self.assertEqual(series['nb_examination'], [3, 0, 0, 0])
+        self.assertEqual(series['nb_return'], [1, 0, 0, 0])
+        self.assertEqual(series['nb_new_patient'], [1, 0, 0, 0])
+        self.assertNotIn('therapeuts', response.data)
+
+    def test_by_therapeut(self):
+        response = self.get_series(**{
+            'from': '2018-01-01',
+            'to': '2019-12-31',
+            'granularity': 'year',
+            'by_therapeut': 'true'
+        })
+        therapeuts = dict((t['therapeut'], t['series']['nb_examination'])
+                          for t in response.data['therapeuts'])
+        self.assertEqual(therapeuts, {
+            self.user.pk: [2, 0],
+            self.other.pk: [1, 1],
+            None: [0, 0]
+        })
+        response = self.get_series(**{
+            'from': '2018-01-01',
+            'to': '2019-12-31',
+            'granularity': 'month',
+            'therapeut': self.other.pk
+        })
+        self.assertEqual(len(response.data['periods']), 24)
+        self.assertEqual(sum(response.data['series']['nb_examination']), 2)
+
+    def test_queries_does_not_depend_on_periods(self):
+        with self.assertNumQueries(1):
+            SeriesStatistics(date(2014, 1, 1), date(2018, 12, 31), 'day',
+                             by_therapeut=True).compute()
+
+    def test_invalid_parameters(self):
+        for params in [{'granularity': 'decade'},
+                       {'from': '2019-01-01', 'to': '2018-01-01'},
+                       {'from': 'yesterday'},
+                       {'from': '1900-01-01', 'granularity': 'day'},
+                       {'from': '0001-01-01', 'to': '9999-12-30',
+                        'granularity': 'day'},
+                       {'from': '9999-01-01', 'to': '9999-12-31'}]:
+            self.assertEqual(self.get_series(**params).status_code, 400)
+
+    def test_period_count(self):
+        rand = random.Random(42)
+        for granularity in ['day', 'week', 'month', 'quarter', 'year']:
+            for i in range(20):
+                start = date(2018, 1, 1) + timedelta(days=rand.randint(0, 800))
+                end = start + timedelta(days=rand.randint(0, 800))
+                statistics = SeriesStatistics(start, end, granularity)
+                self.assertEqual(statistics.get_period_count(),
+                                 len(statistics.get_periods()))
+
+    def test_end_of_the_calendar(self):
+        for granularity in ['day', 'week', 'month', 'quarter', 'year']:
+            response = self.get_series(**{
+                'from': '9999-01-01',
+                'to': '9999-12-30',
+                'granularity': granularity
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['periods'][-1]['end'],
+                             date(9999, 12, 30))
+
+    def get_rollup(self):
+        return sorted(
+            (day, therapeut or 0, tuple(counts[c] for c in ROLLUP_SERIES))
+            for ((day, therapeut), counts) in compute_daily_statistics().items()
+            if any(counts.values()))
+
+    def test_refresh_by_therapeut(self):
+        examination = Examination.objects.get(therapeut=self.other,
+                                              type=1)
+        examination.therapeut = self.user
+        examination.save()
+        Examination.objects.create(date=examination.date,
+                                   status=1,
+                                   type=1,
+                                   patient=examination.patient,
+                                   therapeut=self.other)
+        rollup = sorted(
+            (row[0], row[1] or 0, tuple(row[2:]))
+            for row in DailyStatistics.objects.values_list(
+                'day', 'therapeut', *ROLLUP_SERIES))
+        self.assertEqual(rollup, self.get_rollup())
+        with CaptureQueriesContext(connection) as queries:
+            rebuild_daily_statistics(date(2018, 3, 21), date(2018, 3, 21),
+                                     therapeuts=[self.other.pk])
+        # Only the therapeut is read, not every user
+        for query in queries.captured_queries:
+            if 'FROM "auth_user"' in query['sql']:
+                self.assertIn('WHERE', query['sql'])
+        self.assertEqual(rollup, self.get_rollup())
+
+
+class TestRevenueStatistics(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("test", "test@test.com",
+                                                  "testpw")
+        self.other = User.objects.create_user("other", "other@test.com",
+                                              "otherpw")
+        self.client.login(username='test', password='testpw')
+        self.create_invoice(date(2018, 1, 10), 50, 'cash',
+                            InvoiceStatus.INVOICED_PAID, self.user)
+        self.create_invoice(date(2018, 1, 20), 40, 'notpaid',
+                            InvoiceStatus.WAITING_FOR_PAIEMENT, self.other)
+        paid_later = self.create_invoice(date(2018, 2, 5), 60, 'notpaid',
+                                         InvoiceStatus.INVOICED_PAID,
+                                         self.user)
+        paiment = Paiment.objects.create(amount=60,
+                                         currency='EUR',
+                                         paiment_mode='check',
+                                         date=date(2018, 3, 1))
+        paiment.invoice.add(paid_later)
+        canceled = self.create_invoice(date(2018, 2, 10), 30, 'cash',
+                                       InvoiceStatus.CANCELED, self.other)
+        canceled.canceled_by = self.create_invoice(
+            date(2018, 2, 12), -30, 'cash', InvoiceStatus.INVOICED_PAID,
+            self.other, 'creditnote')
+        canceled.save()
+
+    def create_invoice(self, day, amount, paiment_mode, status, therapeut,
+                       type='invoice'):
+        value = timezone.make_aware(datetime.combine(day, time(10, 0)))
+        return Invoice.objects.create(date=value,
+                                      dateExamination=value,
+                                      amount=amount,
+                                      currency='EUR',
+                                      paiment_mode=paiment_mode,
+                                      status=status,
+                                      therapeut_id=therapeut.pk,
+                                      type=type)
+
+    def get_revenue(self, **params):
+        params.update({'from': '2018-01-01', 'to': '2018-03-31'})
+        response = self.client.get(reverse('statistics_revenue_view'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_revenue_series(self):
+        result = self.get_revenue()
+        self.assertEqual(
+            dict(result['series']), {
+                'invoiced': [90, 90, 0],
+                'credit_notes': [0, 30, 0],
+                'paid': [50, 0, 60],
+                'outstanding': [40, 0, 0],
+            })
+        self.assertEqual(dict(result['by_paiment_mode']), {
+            'cash': [50, 0, 0],
+            'check': [0, 0, 60]
+        })
+
+    def test_revenue_by_therapeut(self):
+        result = self.get_revenue(by_therapeut='true')
+        therapeuts = dict((t['therapeut'], dict(t['series']))
+                          for t in result['therapeuts'])
+        self.assertEqual(
+            therapeuts[self.user.pk], {
+                'invoiced': [50, 60, 0],
+                'credit_notes': [0, 0, 0],
+                'paid': [50, 0, 60],
+                'outstanding': [0, 0, 0],
+            })
+        self.assertEqual(
+            therapeuts[self.other.pk], {
+                'invoiced': [40, 30, 0],
+                'credit_notes': [0, 30, 0],
+                'paid': [0, 0, 0],
+                'outstanding': [40, 0, 0],
+            })
+        result = self.get_revenue(therapeut=self.user.pk)
+        self.assertEqual(result['series']['invoiced'], [50, 60, 0])
+
+    def test_queries_by_chunk_of_periods(self):
+        with self.assertNumQueries(2):
+            RevenueStatistics(date(2018, 1, 1), date(2018, 12, 31),
+                              'month').compute()
+        with self.assertNumQueries(4):
+            RevenueStatistics(date(2018, 1, 1), date(2018, 12, 31),
+                              'day').compute()
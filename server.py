@@ -24,6 +24,7 @@ from cherrypy.process import wspbus, plugins
 from cherrypy import _cplogging, _cperror
 from django.conf import settings
 from Libreosteo.standalone import application
+from libreosteoweb.api.import_jobs import interrupt_import_jobs
 from django.http import HttpResponseServerError
 try:
     import ConfigParser
@@ -95,6 +96,13 @@ class Server(object):
         if hasattr(engine, "console_control_handler"):
             engine.console_control_handler.subscribe()
 
+        # Only the server runs the import jobs : those left unfinished by
+        # its previous run are failed before it starts new ones
+        try:
+            interrupt_import_jobs()
+        except Exception:
+            logger.exception("Exception when interrupting the import jobs")
+
         try :
             engine.start()
         except Exception as e :
@@ -258,6 +266,15 @@ if __name__ == '__main__':
                     'backupCount':20,
                     'encoding':'utf8'
                     },
+                'slow_requests' : {
+                    'level':'WARNING',
+                    'class':'logging.handlers.RotatingFileHandler',
+                    'formatter': 'standard',
+                    'filename':os.path.join(DATA_FOLDER, 'slow_requests.log'),
+                    'maxBytes':10485760,
+                    'backupCount':5,
+                    'encoding':'utf8'
+                    },
 	    },
 	    'loggers': {
 	        '': {
@@ -279,6 +296,11 @@ if __name__ == '__main__':
                     'level': 'INFO',
                     'propagate' : True
                     },
+                'libreosteoweb.slow_requests': {
+                    'handlers': ['slow_requests'],
+                    'level': 'WARNING',
+                    'propagate' : False
+                    },
 	        'cherrypy.access': {
 	            'handlers': ['cherrypy_access'],
 	            'level': 'INFO',
@@ -38,6 +38,7 @@ from cherrypy.process import wspbus, plugins
 from cherrypy import _cplogging, _cperror
 from django.conf import settings
 from Libreosteo.standalone import application
+from libreosteoweb.api.import_jobs import interrupt_import_jobs
 from django.http import HttpResponseServerError
 import webbrowser
 import patch
@@ -98,6 +99,13 @@ class Server(object):
         if hasattr(engine, "console_control_handler"):
             engine.console_control_handler.subscribe()
 
+        # Only the server runs the import jobs : those left unfinished by
+        # its previous run are failed before it starts new ones
+        try:
+            interrupt_import_jobs()
+        except Exception:
+            logging.exception("Exception when interrupting the import jobs")
+
         try :
             engine.start()
         except :